@@ -12,18 +12,150 @@ or
 
 The corresponding data is looked up in `quilt_modules/$user/$package.h5`
 in ancestors of the current directory.
+
+Tables are DataFrames, read as they're accessed. Set $QUILT_LAZY_TABLES to a
+non-zero value to get LazyTables instead, which only read the tables once
+they're used; e.g., to look at the shapes and columns of a package's tables
+without reading them.
 """
 
 import imp
 import os.path
 import sys
 
+import pandas as pd
+
 from .tools.build import get_store
-from .tools.core import GroupNode
-from .tools.store import PackageStore
+from .tools.core import GroupNode, TableNode
+from .tools.store import PackageStore, StoreException
 
 __path__ = []  # Required for submodules to work
 
+def lazy_tables_enabled():
+    """
+    Returns True if accessing a table returns a LazyTable rather than a
+    DataFrame; set $QUILT_LAZY_TABLES to a non-zero value to turn it on.
+    """
+    return os.environ.get('QUILT_LAZY_TABLES', '0') not in ('', '0')
+
+class LazyTable(object):
+    """
+    Stands in for a table's DataFrame without reading it; returned for
+    tables with $QUILT_LAZY_TABLES (see `lazy_tables_enabled`).
+
+    `shape`, `columns` and `dtypes` come from the package's metadata (for
+    packages built with it). Anything else - or an explicit `load()` -
+    reads the DataFrame, once, and passes the call on to it.
+    """
+    def __init__(self, store, path, node):
+        self._store = store
+        self._path = path
+        self._node = node
+        self._df = None
+
+    def load(self):
+        """
+        Returns the DataFrame, reading it if necessary.
+        """
+        if self._df is None:
+            self._df = self._store.read_table(self._node)
+        return self._df
+
+    @property
+    def loaded(self):
+        """
+        True if the DataFrame has been read.
+        """
+        return self._df is not None
+
+    @property
+    def shape(self):
+        """
+        (rows, columns) of the table.
+        """
+        shape = self._node.metadata.get('q_shape')
+        if shape is None or self.loaded:
+            return self.load().shape
+        return tuple(shape)
+
+    @property
+    def columns(self):
+        """
+        The table's column names.
+        """
+        columns = self._node.metadata.get('q_columns')
+        if columns is None or self.loaded:
+            return self.load().columns
+        return pd.Index(columns)
+
+    @property
+    def dtypes(self):
+        """
+        The table's column types.
+        """
+        dtypes = self._node.metadata.get('q_dtypes')
+        if dtypes is None or self.loaded:
+            return self.load().dtypes
+        return pd.Series([_pandas_dtype(dtype) for dtype in dtypes],
+                         index=self._node.metadata['q_columns'])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        if not self.loaded:
+            shape = self._node.metadata.get('q_shape')
+            size = ' %dx%d' % tuple(shape) if shape is not None else ''
+            return '<LazyTable %s%s (not loaded)>' % (self._path, size)
+        return repr(self._df)
+
+    def __dir__(self):
+        return sorted(set(dir(type(self))) | set(dir(self.load())))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __array__(self, dtype=None):
+        return self.load().__array__(dtype)
+
+    def _repr_html_(self):
+        return self.load()._repr_html_()
+
+def _pandas_dtype(name):
+    try:
+        return pd.api.types.pandas_dtype(name)
+    except TypeError:
+        return name
+
+def _proxy_operator(name):
+    def method(self, *args):
+        return getattr(self.load(), name)(*args)
+    method.__name__ = name
+    return method
+
+for _name in ['__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__',
+              '__add__', '__radd__', '__sub__', '__rsub__', '__mul__', '__rmul__',
+              '__truediv__', '__rtruediv__', '__div__', '__rdiv__', '__floordiv__',
+              '__rfloordiv__', '__mod__', '__rmod__', '__pow__', '__rpow__',
+              '__and__', '__rand__', '__or__', '__ror__', '__xor__', '__rxor__',
+              '__neg__', '__invert__', '__abs__']:
+    if hasattr(pd.DataFrame, _name):
+        setattr(LazyTable, _name, _proxy_operator(_name))
+
 class DataNode(object):
     """
     Represents either the root of the store or a group, similar to nodes
@@ -50,41 +182,79 @@ class DataNode(object):
         output = [cinfo, finfo, pinfo] + spaths
         return '\n'.join(output)
 
+    def __dir__(self):
+        """
+        Includes the children, for tab-completion.
+        """
+        return sorted(set(dir(type(self))) | set(self.__dict__) | set(self._keys()))
+
+    def _children(self):
+        """
+        child nodes of this group in the package's contents, without
+        reading any tables
+        """
+        group = self._store.get_node(self._prefix)
+        assert isinstance(group, GroupNode), "{type} {grp}".format(type=type(group), grp=group)
+        return group.children
+
     def _dfs(self):
         """
         every child key referencing a dataframe
         """
-        pref = self._prefix + '/'
-        return [k for k in self._keys()
-                if not isinstance(self._get_store_obj(pref + k), DataNode)]
+        return [k for k, node in self._children().items()
+                if not isinstance(node, GroupNode)]
 
     def _get_store_obj(self, path):
         try:
-            obj = self._store.get(path)
-        except KeyError:
+            node = self._store.get_node(path)
+        except (KeyError, StoreException):
             # No such group or table
             raise AttributeError("No such table or group: %s" % path)
 
-        if isinstance(obj, GroupNode):
+        if isinstance(node, GroupNode):
             return DataNode(self._store, path)
+        elif isinstance(node, TableNode) and lazy_tables_enabled():
+            return LazyTable(self._store, path, node)
         else:
-            return obj
+            return self._store.get(path)
+
+    def _lazy(self, name):
+        """
+        Returns a LazyTable for a table, which only reads it when it's
+        used - e.g., to look at its shape, columns or dtypes. It isn't a
+        DataFrame, though: use its `load()` to pass it to pandas.
+        """
+        path = self._prefix + '/' + name
+        try:
+            node = self._store.get_node(path)
+        except (KeyError, StoreException):
+            raise AttributeError("No such table or group: %s" % path)
+        if not isinstance(node, TableNode):
+            raise AttributeError("Not a table: %s" % path)
+        return LazyTable(self._store, path, node)
+
+    def _read(self, name, columns=None, filters=None):
+        """
+        Reads only some of the columns and/or rows of a table.
+
+        `filters` is a list of (column, op, value) tuples, e.g.,
+        `[('year', '>=', 2000), ('state', 'in', ['CA', 'WA'])]`.
+        """
+        path = self._prefix + '/' + name
+        return self._store.get(path, columns=columns, filters=filters)
 
     def _groups(self):
         """
         every child key referencing a group that is not a dataframe
         """
-        pref = self._prefix + '/'
-        return [k for k in self._keys()
-                if isinstance(self._get_store_obj(pref + k), DataNode)]
+        return [k for k, node in self._children().items()
+                if isinstance(node, GroupNode)]
 
     def _keys(self):
         """
         keys directly accessible on this object via getattr or .
         """
-        group = self._store.get(self._prefix)
-        assert isinstance(group, GroupNode), "{type} {grp}".format(type=type(group), grp=group)
-        return group.children.keys()
+        return self._children().keys()
 
 
 class FakeLoader(object):
@@ -3,7 +3,9 @@ Test the build process
 """
 #TODO: we should really test the CLI interface itself, rather than
 #the functions that cli calls
+import json
 import os
+import shutil
 
 try:
     import fastparquet
@@ -12,14 +14,18 @@ except ImportError:
 
 try:
     import pyarrow
+    import pyarrow.parquet
 except ImportError:
     pyarrow = None
 
+import pandas as pd
 import pytest
+import yaml
 
-from quilt.tools import build
+from quilt.tools import build, cache, metrics, store
 from quilt.tools.const import PackageFormat
-from .utils import QuiltTestCase
+from quilt.tools.hashing import digest_file, hash_cache
+from .utils import QuiltTestCase, patch
 
 
 PACKAGE = 'groot'
@@ -101,6 +107,613 @@ class BuildTest(QuiltTestCase):
         del os.environ["QUILT_PACKAGE_FORMAT"]
         # TODO add more integrity checks, incl. negative test cases
 
+    def test_build_transaction(self):
+        """
+        Test that the contents are written once, at the end of the build.
+        """
+        mydir = os.path.dirname(__file__)
+        path = os.path.join(mydir, './build_simple.yml')
+        with patch('quilt.tools.store.json.dump', wraps=json.dump) as mock_dump:
+            build.build_package('test_hdf5', 'simple', path)
+        contents_dumps = [call for call in mock_dump.call_args_list
+                          if call[0][1].name.endswith('simple.json.tmp')]
+        assert len(contents_dumps) == 1
+
+        pkg_obj = store.get_store('test_hdf5', 'simple')
+        assert list(pkg_obj.get_contents().children) == ['foo']
+
+        # A failed build leaves the old contents alone.
+        bad_path = os.path.join(mydir, './build_failover.yml')
+        with open(bad_path) as fd:
+            bad_yaml = fd.read()
+        with open('bad.yml', 'w') as fd:
+            fd.write(bad_yaml.replace('data/bad.csv', 'data/missing.csv'))
+        with self.assertRaises(IOError):
+            build.build_package('test_hdf5', 'simple', 'bad.yml')
+        assert list(pkg_obj.get_contents().children) == ['foo']
+
+    def test_build_parallel(self):
+        """
+        Test that a parallel build produces the same package as a serial one.
+        """
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            foo=['csv', os.path.join(mydir, 'data/foo.csv')],
+            nested=dict(
+                nuts=['csv', os.path.join(mydir, 'data/nuts.csv')],
+                tsv=['tsv', os.path.join(mydir, 'data/10KRows13Cols.tsv')],
+            )
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+
+        build.build_package('test_hdf5', 'serial', 'build.yml')
+        build.build_package('test_hdf5', 'parallel', 'build.yml', jobs=2)
+
+        serial = store.get_store('test_hdf5', 'serial')
+        parallel = store.get_store('test_hdf5', 'parallel')
+        for path in ['foo', 'nested/nuts', 'nested/tsv']:
+            assert serial.get(path).equals(parallel.get(path))
+        assert list(parallel.get_contents().children) == ['foo', 'nested']
+
+    def test_build_cache(self):
+        """
+        Test that unchanged source files are not parsed again.
+        """
+        mydir = os.path.dirname(__file__)
+        with open('nuts.csv', 'w') as fd:
+            fd.write('a,b\n1,2\n')
+        tables = dict(
+            foo=['csv', os.path.join(mydir, 'data/foo.csv')],
+            nuts=['csv', 'nuts.csv'],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+
+        # The sources are hashed while they're parsed, not read again.
+        with patch('quilt.tools.build.digest_file') as mock_digest:
+            build.build_package('test_hdf5', 'cached', 'build.yml', chunksize=1000)
+            build.build_package('test_hdf5', 'cached', 'build.yml')
+            assert not mock_digest.called
+        pkg_obj = store.get_store('test_hdf5', 'cached')
+        old_contents = pkg_obj.get_contents()
+        with open(pkg_obj.build_cache_path()) as fd:
+            entry = json.load(fd)[os.path.abspath('nuts.csv')]
+        assert entry['content_hash'] == digest_file('nuts.csv')
+
+        # Change one of the files.
+        with open('nuts.csv', 'w') as fd:
+            fd.write('a,b\n3,4\n')
+
+        with patch('quilt.tools.build._file_to_data_frame',
+                   wraps=build._file_to_data_frame) as mock_read:
+            build.build_package('test_hdf5', 'cached', 'build.yml')
+            assert [call[0][1] for call in mock_read.call_args_list] == ['nuts.csv']
+
+        new_contents = pkg_obj.get_contents()
+        assert new_contents.children['foo'] == old_contents.children['foo']
+        assert new_contents.children['nuts'] != old_contents.children['nuts']
+        assert pkg_obj.get('nuts')['a'][0] == 3
+
+    def _build_streaming(self, owner, read_object):
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            tsv=['tsv', os.path.join(mydir, 'data/10KRows13Cols.tsv')],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+
+        build.build_package(owner, 'whole', 'build.yml')
+        build.build_package(owner, 'streamed', 'build.yml', chunksize=3000)
+
+        whole_store = store.get_store(owner, 'whole')
+        streamed_store = store.get_store(owner, 'streamed')
+        whole_hash = whole_store.get_contents().children['tsv'].hashes[0]
+        streamed_hash = streamed_store.get_contents().children['tsv'].hashes[0]
+        whole = read_object(whole_store.file([whole_hash]))
+        streamed = read_object(streamed_store.file([streamed_hash]))
+        assert len(streamed) == len(whole)
+        assert (streamed.values == whole.values).all()
+
+        assert digest_file(streamed_store.file([streamed_hash])) == streamed_hash
+
+    def test_build_streaming_hdf5(self):
+        """
+        Test building a table in chunks.
+        """
+        self._build_streaming('test_hdf5', lambda path: pd.read_hdf(path, 'df'))
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_streaming_arrow(self):
+        """
+        Test building a table in chunks of row groups.
+        """
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value):
+            self._build_streaming('test_arrow', lambda path: pyarrow.parquet.read_table(path).to_pandas())
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_streaming_feather(self):
+        """
+        Test building a table in chunks of record batches.
+        """
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.FEATHER.value):
+            self._build_streaming('test_feather',
+                                  lambda path: pyarrow.ipc.open_file(path).read_pandas())
+
+    def _build_streaming_drift(self, owner):
+        # Strings get longer, ints only get missing values late in the file,
+        # a column of ints turns into text, and one is missing in the first chunk.
+        df = pd.DataFrame(dict(
+            a=[float('nan') if i == 45 else i for i in range(50)],
+            b=['x' * (i // 2 + 1) for i in range(50)],
+            c=['\u00e9' * (i // 10 + 1) for i in range(50)],
+            d=[str(i) if i < 25 else 'v%d' % i for i in range(50)],
+            e=[float('nan') if i < 10 else 's%d' % i for i in range(50)],
+        ))
+        df.to_csv('drift.csv', index=False, na_rep='nan')
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(drift=['csv', 'drift.csv'])), fd)
+
+        build.build_package(owner, 'drift', 'build.yml', chunksize=10)
+        pkg_obj = store.get_store(owner, 'drift')
+        assert pkg_obj.get('drift').equals(df)
+        assert pkg_obj.get_contents().children['drift'].metadata['q_dtypes'][0] == 'float64'
+
+    def test_build_streaming_drift_hdf5(self):
+        """
+        Test streaming chunks whose strings grow and whose dtypes change.
+        """
+        self._build_streaming_drift('test_hdf5')
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_streaming_drift_arrow(self):
+        """
+        Test streaming chunks whose dtypes change into Parquet row groups.
+        """
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value):
+            self._build_streaming_drift('test_arrow')
+
+    def test_build_shards(self):
+        """
+        Test splitting a table into several objects.
+        """
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            tsv=['tsv', os.path.join(mydir, 'data/10KRows13Cols.tsv')],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+
+        build.build_package('test_hdf5', 'whole', 'build.yml')
+        build.build_package('test_hdf5', 'sharded', 'build.yml', shard_rows=3000)
+        build.build_package('test_hdf5', 'streamed', 'build.yml', chunksize=2000, shard_rows=3000)
+
+        whole = store.get_store('test_hdf5', 'whole').get('tsv')
+        for package in ['sharded', 'streamed']:
+            pkg_obj = store.get_store('test_hdf5', package)
+            assert len(pkg_obj.get_contents().children['tsv'].hashes) == 4
+            assert pkg_obj.get('tsv').equals(whole)
+
+        with self.assertRaises(build.BuildException):
+            build.build_package('test_hdf5', 'bad', 'build.yml', shard_rows=10, shard_size=10)
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_shards_changed_rows(self):
+        """
+        Test that changing some rows only changes the shards containing them.
+        """
+        df = pd.DataFrame(dict(a=range(100), b=['x'] * 100))
+        df.to_csv('rows.csv', index=False)
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(rows=['csv', 'rows.csv'])), fd)
+
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value):
+            build.build_package('test_arrow', 'rows', 'build.yml', shard_rows=25)
+            pkg_obj = store.get_store('test_arrow', 'rows')
+            old_hashes = pkg_obj.get_contents().children['rows'].hashes
+
+            df.loc[60, 'b'] = 'y'
+            df.to_csv('rows.csv', index=False)
+            build.build_package('test_arrow', 'rows', 'build.yml', shard_rows=25)
+            new_hashes = pkg_obj.get_contents().children['rows'].hashes
+
+        assert len(new_hashes) == 4
+        assert [old == new for old, new in zip(old_hashes, new_hashes)] == [True, True, False, True]
+        shard = pyarrow.parquet.read_table(pkg_obj.file([new_hashes[2]])).to_pandas()
+        assert shard['b'][60] == 'y'
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_content_defined_shards(self):
+        """
+        Test that inserting rows only changes the content-defined shards around them.
+        """
+        df = pd.DataFrame(dict(a=range(2000), b=['x%d' % (i * 7 % 13) for i in range(2000)]))
+        df.to_csv('rows.csv', index=False)
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(rows=['csv', 'rows.csv'])), fd)
+
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value):
+            build.build_package('test_arrow', 'rows', 'build.yml', shard_rows=100,
+                                content_defined=True)
+            build.build_package('test_arrow', 'streamed', 'build.yml', chunksize=300,
+                                shard_rows=100, content_defined=True)
+            pkg_obj = store.get_store('test_arrow', 'rows')
+            old_hashes = pkg_obj.get_contents().children['rows'].hashes
+            assert pkg_obj.get('rows').equals(df)
+            streamed = store.get_store('test_arrow', 'streamed')
+            assert streamed.get_contents().children['rows'].hashes == old_hashes
+
+            lengths = [len(pkg_obj.dataframe([objhash])) for objhash in old_hashes]
+            assert all(25 <= length <= 400 for length in lengths[:-1])
+            assert 5 <= len(old_hashes) <= 80
+
+            # Filtered and projected reads keep the rows' labels in the whole table.
+            result = pkg_obj.get('rows', filters=[('b', '==', 'x3')])
+            assert result.equals(df[df['b'] == 'x3'])
+            assert list(pkg_obj.get('rows', columns=['a']).index) == list(df.index)
+
+            # The shards for a size don't depend on the chunks the file is read in.
+            build.build_package('test_arrow', 'sized', 'build.yml', shard_size=2000,
+                                content_defined=True)
+            build.build_package('test_arrow', 'sized_streamed', 'build.yml', chunksize=7,
+                                shard_size=2000, content_defined=True)
+            sized = store.get_store('test_arrow', 'sized').get_contents().children['rows']
+            sized_streamed = store.get_store('test_arrow', 'sized_streamed').get_contents()
+            assert sized_streamed.children['rows'].hashes == sized.hashes
+
+            new_df = pd.concat([df.iloc[:1000], df.iloc[:5], df.iloc[1000:]], ignore_index=True)
+            new_df.to_csv('rows.csv', index=False)
+            build.build_package('test_arrow', 'rows', 'build.yml', shard_rows=100,
+                                content_defined=True)
+            new_hashes = pkg_obj.get_contents().children['rows'].hashes
+            assert pkg_obj.get('rows').equals(new_df)
+
+        assert len(set(old_hashes) - set(new_hashes)) <= 2
+        assert len(set(new_hashes) - set(old_hashes)) <= 2
+
+        with self.assertRaises(build.BuildException):
+            build.build_package('test_arrow', 'bad', 'build.yml', content_defined=True)
+
+    def test_build_reuse_shards(self):
+        """
+        Test that shards with unchanged rows are reused, even if the format
+        (HDF5) doesn't reproduce them byte for byte.
+        """
+        df = pd.DataFrame(dict(a=range(1000), b=['x%d' % (i % 7) for i in range(1000)]))
+        df.to_csv('rows.csv', index=False)
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(rows=['csv', 'rows.csv'])), fd)
+
+        build.build_package('test_hdf5', 'rows', 'build.yml', shard_rows=100,
+                            content_defined=True)
+        pkg_obj = store.get_store('test_hdf5', 'rows')
+        old_hashes = pkg_obj.get_contents().children['rows'].hashes
+
+        new_df = pd.concat([df, df.iloc[:10]], ignore_index=True)
+        new_df.to_csv('rows.csv', index=False)
+        build.build_package('test_hdf5', 'rows', 'build.yml', shard_rows=100,
+                            content_defined=True)
+        new_hashes = pkg_obj.get_contents().children['rows'].hashes
+
+        assert new_hashes[:len(old_hashes) - 1] == old_hashes[:-1]
+        assert pkg_obj.get('rows').equals(new_df)
+
+    def _read_columns_filters(self, owner, **kwargs):
+        df = pd.DataFrame(dict(a=range(100), b=['x', 'y'] * 50, c=[1.5] * 100))
+        df.to_csv('abc.csv', index=False)
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(abc=['csv', 'abc.csv'])), fd)
+        build.build_package(owner, 'abc', 'build.yml', **kwargs)
+
+        pkg_obj = store.get_store(owner, 'abc')
+        result = pkg_obj.get('abc', columns=['b', 'a'], filters=[('a', '>=', 90), ('b', '==', 'x')])
+        assert list(result.columns) == ['b', 'a']
+        assert list(result['a']) == [90, 92, 94, 96, 98]
+
+        result = pkg_obj.get('abc', columns=['b'], filters=[('a', '<', 3)])
+        assert list(result.columns) == ['b']
+        assert len(result) == 3
+
+        assert len(pkg_obj.get('abc', filters=[('a', 'in', [1, 2, 300])])) == 2
+        assert list(pkg_obj.get('abc', columns=['c', 'a']).columns) == ['c', 'a']
+        with self.assertRaises(store.StoreException):
+            pkg_obj.get('abc', filters=[('a', '~', 1)])
+        with self.assertRaises(store.StoreException):
+            pkg_obj.get('abc', columns=['nope'])
+        return pkg_obj
+
+    def test_read_columns_filters_hdf5(self):
+        """
+        Test reading some columns and rows of HDF5 tables, in both formats;
+        the filters on table-format (streamed) objects are passed to PyTables.
+        """
+        self._read_columns_filters('test_hdf5')
+        pkg_obj = self._read_columns_filters('test_hdf5', chunksize=30)
+        hashes = pkg_obj.get_node('/abc').hashes
+        with patch('pandas.HDFStore.select', autospec=True,
+                   side_effect=pd.HDFStore.select) as mock_select:
+            df = pkg_obj.dataframe(hashes, filters=[('a', '>=', 90), ('b', 'in', ['x'])])
+            assert list(df['a']) == [90, 92, 94, 96, 98]
+        assert mock_select.call_args[1]['where'] == ['a >= 90', "b == ['x']"]
+
+        from quilt.data.test_hdf5 import abc
+        assert list(abc._read('abc', columns=['a'], filters=[('b', '!=', 'x')])['a'][:2]) == [1, 3]
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_read_columns_filters_arrow(self):
+        """
+        Test that reading filtered rows of a Parquet table skips row groups.
+        """
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value):
+            with patch('pyarrow.parquet.ParquetFile.read_row_group',
+                       autospec=True, side_effect=pyarrow.parquet.ParquetFile.read_row_group) as mock_read:
+                self._read_columns_filters('test_arrow', chunksize=30)
+                # Only the last of the 4 row groups has rows with a >= 90.
+                assert [call[0][1] for call in mock_read.call_args_list[:1]] == [3]
+
+    def test_navigation_reads_no_tables(self):
+        """
+        Test that listing a package only uses its contents, parsed once.
+        """
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            foo=['csv', os.path.join(mydir, 'data/foo.csv')],
+            nested=dict(nuts=['csv', os.path.join(mydir, 'data/nuts.csv')]),
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+        build.build_package('test_hdf5', 'navigate', 'build.yml')
+
+        from quilt.data.test_hdf5 import navigate
+        with patch('quilt.tools.store.HDF5PackageStore.dataframe') as mock_dataframe, \
+             patch('json.load', wraps=json.load) as mock_load:
+            assert navigate._dfs() == ['foo']
+            assert navigate._groups() == ['nested']
+            assert navigate.nested._dfs() == ['nuts']
+            assert 'nuts' in dir(navigate.nested)
+            assert not mock_dataframe.called
+            assert mock_load.call_count <= 1
+
+    def test_lazy_tables(self):
+        """
+        Test that tables are only read when used.
+        """
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            foo=['csv', os.path.join(mydir, 'data/foo.csv')],
+            big=['tsv', os.path.join(mydir, 'data/10KRows13Cols.tsv')],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+        build.build_package('test_hdf5', 'lazy', 'build.yml', chunksize=3000)
+
+        pkg_obj = store.get_store('test_hdf5', 'lazy')
+        expected = pkg_obj.get('big')
+        expected_foo = pkg_obj.get('foo')
+        from quilt.data.test_hdf5 import lazy
+        with patch.dict(os.environ, QUILT_LAZY_TABLES='1'):
+            big = lazy.big
+            foo = lazy.foo
+        with patch('quilt.tools.store.HDF5PackageStore.cached_dataframe',
+                   wraps=pkg_obj.cached_dataframe) as mock_dataframe:
+            assert big.shape == expected.shape
+            assert len(big) == len(expected)
+            assert list(big.columns) == list(expected.columns)
+            assert list(big.dtypes) == list(expected.dtypes)
+            assert not big.loaded and not mock_dataframe.called
+
+            assert big.load().equals(expected)
+            assert big.index.equals(expected.index)
+            assert (big[expected.columns[0]] == expected[expected.columns[0]]).all()
+            assert (foo + 1).equals(expected_foo + 1)
+            assert mock_dataframe.call_count == 2
+
+        # Without $QUILT_LAZY_TABLES, tables are DataFrames, which pandas can use as such.
+        assert isinstance(lazy.foo, pd.DataFrame)
+        assert pd.concat([lazy.foo, lazy.foo]).equals(pd.concat([expected_foo, expected_foo]))
+        assert pd.merge(lazy.foo, expected_foo).equals(pd.merge(expected_foo, expected_foo))
+        assert expected_foo.merge(lazy.foo).equals(expected_foo.merge(expected_foo))
+        assert (expected_foo == lazy.foo).all().all()
+        with self.assertRaises(AttributeError):
+            lazy._lazy('nope')
+
+    def test_dataframe_cache(self):
+        """
+        Test that tables read again come from the in-memory cache.
+        """
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            foo=['csv', os.path.join(mydir, 'data/foo.csv')],
+            nuts=['csv', os.path.join(mydir, 'data/nuts.csv')],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+        build.build_package('test_hdf5', 'cached', 'build.yml')
+        pkg_obj = store.get_store('test_hdf5', 'cached')
+        df_cache = cache.dataframe_cache()
+
+        with patch('quilt.tools.store.HDF5PackageStore.dataframe',
+                   wraps=pkg_obj.dataframe) as mock_dataframe:
+            foo = pkg_obj.get('foo')
+            foo[foo.columns[0]] = -1
+            assert not pkg_obj.get('foo').equals(foo)
+            assert mock_dataframe.call_count == 1
+        assert df_cache.stats()['hits'] == 1
+        assert df_cache.stats()['misses'] == 1
+
+        # Copies in use count against the budget, until they're garbage collected.
+        assert df_cache.stats()['loaned'] == df_cache.stats()['size']
+        del foo
+        assert df_cache.stats()['loaned'] == 0
+
+        # Only room for one of the tables, and a copy of it.
+        nuts_size = int(pkg_obj.dataframe(pkg_obj.get_node('/nuts').hashes)
+                        .memory_usage(index=True, deep=True).sum())
+        df_cache.max_size = nuts_size * 2
+        pkg_obj.get('nuts')
+        pkg_obj.get('nuts')
+        stats = df_cache.stats()
+        assert stats['entries'] == 1
+        assert stats['evictions'] == 1
+        assert stats['hits'] == 2
+
+        # No room for a table and a copy of it: it's not cached at all.
+        df_cache.clear()
+        df_cache.max_size = nuts_size * 2 - 1
+        pkg_obj.get('nuts')
+        stats = df_cache.stats()
+        assert stats['entries'] == 0
+        assert stats['evictions'] == 0
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_build_feather(self):
+        """
+        Test that Feather tables are memory-mapped rather than copied.
+        """
+        df = pd.DataFrame(dict(a=range(100000), b=[0.5] * 100000))
+        df.to_csv('numbers.csv', index=False)
+        mydir = os.path.dirname(__file__)
+        tables = dict(
+            numbers=['csv', 'numbers.csv'],
+            nuts=['csv', os.path.join(mydir, 'data/nuts.csv')],
+        )
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=tables), fd)
+
+        with patch.dict(os.environ, QUILT_PACKAGE_FORMAT=PackageFormat.FEATHER.value):
+            build.build_package('test_feather', 'whole', 'build.yml')
+            build.build_package('test_feather', 'sharded', 'build.yml', chunksize=30000,
+                                shard_rows=40000)
+            whole = store.get_store('test_feather', 'whole')
+            sharded = store.get_store('test_feather', 'sharded')
+            assert isinstance(whole, store.FeatherPackageStore)
+
+        allocated = pyarrow.total_allocated_bytes()
+        numbers = whole.get('numbers')
+        assert pyarrow.total_allocated_bytes() - allocated < 1000
+        assert numbers.equals(df)
+        assert not numbers['a'].values.flags.owndata
+
+        assert sharded.get('numbers').reset_index(drop=True).equals(df)
+        assert len(sharded.get_contents().children['numbers'].hashes) == 3
+        nuts = pd.read_csv(os.path.join(mydir, 'data/nuts.csv'))
+        assert whole.get('nuts').equals(nuts)
+        filtered = whole.get('numbers', columns=['b'], filters=[('a', '<', 10)])
+        assert list(filtered.columns) == ['b'] and len(filtered) == 10
+
+    @pytest.mark.skipif("pyarrow is None")
+    def test_metrics(self):
+        """
+        Test that reads and writes are timed when metrics are enabled.
+        """
+        df = pd.DataFrame(dict(a=range(100), b=['x', 'y'] * 50))
+        df.to_csv('rows.csv', index=False)
+        with open('build.yml', 'w') as fd:
+            yaml.dump(dict(tables=dict(rows=['csv', 'rows.csv'])), fd)
+
+        events = []
+        metrics.clear()
+        metrics.add_callback(events.append)
+        env = dict(QUILT_PACKAGE_FORMAT=PackageFormat.ARROW.value, QUILT_READ_THREADS='1')
+        try:
+            with patch.dict(os.environ, env):
+                build.build_package('test_arrow', 'quiet', 'build.yml', shard_rows=50)
+                assert not metrics.get_events()
+
+                with patch.dict(os.environ, QUILT_METRICS='1'):
+                    build.build_package('test_arrow', 'timed', 'build.yml', shard_rows=60)
+                    pkg_obj = store.get_store('test_arrow', 'timed')
+                    pkg_obj.get('rows')
+        finally:
+            metrics.remove_callback(events.append)
+
+        assert events == metrics.get_events()
+        writes = metrics.get_events('write')
+        reads = metrics.get_events('read')
+        assert [event['rows'] for event in writes] == [60, 40]
+        assert [event['rows'] for event in reads] == [60, 40]
+        hashes = pkg_obj.get_contents().children['rows'].hashes
+        assert [event['objhash'] for event in reads] == hashes
+        for event in reads:
+            assert event['store'] == 'ArrowPackageStore'
+            assert event['threads'] == 1
+            assert event['bytes'] > 0
+            assert event['read_time'] >= 0 and event['decode_time'] >= 0
+
+        # Arrow's thread pool is resized to $QUILT_READ_THREADS for the read.
+        saved = pyarrow.cpu_count()
+        pool_sizes = []
+
+        def read_table(*args, **kwargs):
+            pool_sizes.append(pyarrow.cpu_count())
+            return read_parquet(*args, **kwargs)
+
+        read_parquet = pyarrow.parquet.read_table
+        metrics.clear()
+        env = dict(QUILT_READ_THREADS=str(saved + 2), QUILT_METRICS='1')
+        with patch.dict(os.environ, env), \
+             patch('pyarrow.parquet.read_table', side_effect=read_table):
+            assert pkg_obj.dataframe(hashes).equals(pkg_obj.get('rows'))
+        assert pool_sizes == [saved + 2] * 2
+        assert [event['threads'] for event in metrics.get_events('read')] == [saved + 2] * 2
+        assert pyarrow.cpu_count() == saved
+
+        # Reads with Arrow's own pool size don't wait for resized ones.
+        with patch.dict(os.environ, QUILT_READ_THREADS=str(saved)), store._arrow_pool_lock:
+            assert pkg_obj.dataframe(hashes).equals(pkg_obj.get('rows'))
+
+    def test_read_threads(self):
+        """
+        Test that $QUILT_READ_THREADS must be a positive integer.
+        """
+        with patch('quilt.tools.store.cpu_count', return_value=4):
+            assert store.read_threads() == 4
+            with patch.dict(os.environ, QUILT_READ_THREADS='2'):
+                assert store.read_threads() == 2
+            for value in ['0', '-1', 'many']:
+                with patch.dict(os.environ, QUILT_READ_THREADS=value):
+                    with self.assertRaises(store.StoreException):
+                        store.read_threads()
+
+    def test_ingest_modes(self):
+        """
+        Test adding raw files by copying, cloning and hardlinking them.
+        """
+        pkg_obj = store.get_store('test_hdf5', 'files', mode='w')
+
+        def ingest(data, mode):
+            with open('source.txt', 'w') as fd:
+                fd.write(data)
+            objhash = pkg_obj.ingest_file('source.txt', mode)
+            assert objhash == digest_file('source.txt')
+            with open(pkg_obj.file([objhash])) as fd:
+                assert fd.read() == data
+            return os.path.samefile('source.txt', pkg_obj.file([objhash]))
+
+        assert not ingest('copied', 'copy')
+        assert ingest('linked', 'hardlink')
+
+        # Falls back to copying if the filesystem can't clone files.
+        with patch('quilt.tools.store.reflink', side_effect=OSError) as mock_reflink:
+            assert not ingest('not cloned', 'reflink')
+            assert mock_reflink.called
+        with patch('quilt.tools.store.reflink', wraps=shutil.copyfile) as mock_reflink, \
+             patch('quilt.tools.store.copy_and_hash') as mock_copy:
+            assert not ingest('cloned', 'auto')
+            assert mock_reflink.called and not mock_copy.called
+
+        # The clone is too new for its hash to be cached, but the source isn't.
+        with open('old.txt', 'w') as fd:
+            fd.write('old')
+        os.utime('old.txt', (1000, 1000))
+        with patch('quilt.tools.store.reflink', wraps=shutil.copyfile):
+            objhash = pkg_obj.ingest_file('old.txt', 'reflink')
+        assert hash_cache().lookup('old.txt') == objhash
+
+        with self.assertRaises(store.StoreException):
+            pkg_obj.ingest_file('source.txt', 'teleport')
+        assert os.listdir(os.path.join('quilt_packages', 'objs', 'tmp')) == []
+
     def test_generate_buildfile(self):
         mydir = os.path.dirname(__file__)
         path = os.path.join(mydir, 'data')
@@ -111,6 +724,28 @@ class BuildTest(QuiltTestCase):
         build.build_package('test_hdf5', 'generated', buildfilepath)    
         os.remove(buildfilepath)
 
+    def test_generate_buildfile_hashing(self):
+        """
+        Test that only the files read by the build, and not hashed while
+        they're parsed, are hashed ahead of it, and only if the hashes get cached.
+        """
+        os.mkdir('files')
+        for name in ['old.csv', 'old.xlsx', 'new.xlsx', 'image.png', 'README.md']:
+            with open(os.path.join('files', name), 'w') as fd:
+                fd.write(name)
+            os.utime(os.path.join('files', name), (1000, 1000))
+        os.utime(os.path.join('files', 'new.xlsx'), None)
+
+        with patch('quilt.tools.build.digest_files') as mock_digest:
+            build.generate_build_file('files')
+            with patch.dict(os.environ, QUILT_NO_HASH_CACHE='1'):
+                build.generate_build_file('files')
+        assert mock_digest.call_count == 1
+        assert sorted(mock_digest.call_args[0][0]) == sorted([
+            os.path.join('files', 'old.xlsx'),
+            os.path.join('files', '.', 'README.md'),
+        ])
+
     def test_failover(self):
         mydir = os.path.dirname(__file__)
         path = os.path.join(mydir, './build_failover.yml')
@@ -0,0 +1,72 @@
+"""
+Tests for transfer codecs.
+"""
+import io
+import os
+import zlib
+
+import pytest
+
+from quilt.tools import codec
+from .utils import QuiltTestCase, patch
+
+
+class CodecTest(QuiltTestCase):
+    def _roundtrip(self, codec_obj, data, chunk_size=1000):
+        compressed = b''.join(codec_obj.compress(io.BytesIO(data), chunk_size))
+        decompressor = codec_obj.decompressor()
+        output = b''.join(decompressor.decompress(compressed[i:i+chunk_size])
+                          for i in range(0, len(compressed), chunk_size))
+        return compressed, output + decompressor.flush()
+
+    def test_codecs(self):
+        data = os.urandom(5000) * 20
+        for name in codec.available_codecs():
+            codec_obj = codec.get_codec(name, threads=1)
+            _, output = self._roundtrip(codec_obj, data)
+            assert output == data, name
+            _, output = self._roundtrip(codec_obj, b'')
+            assert output == b'', name
+
+    @patch('quilt.tools.codec.GZIP_BLOCK_SIZE', 1024)
+    def test_parallel_gzip(self):
+        data = os.urandom(5000) * 20
+        # Without $QUILT_PARALLEL_GZIP, the output is a single gzip member.
+        compressed, output = self._roundtrip(codec.get_codec('gzip', threads=4), data)
+        assert output == data
+        assert zlib.decompressobj(codec.ZLIB_WBITS).decompress(compressed) == data
+
+        with patch.dict(os.environ, QUILT_PARALLEL_GZIP='1'):
+            compressed, output = self._roundtrip(codec.get_codec('gzip', threads=4), data)
+        assert output == data
+        # Each block is a separate gzip member.
+        assert compressed.count(b'\x1f\x8b\x08') >= len(data) // 1024
+
+    @pytest.mark.skipif("codec.zstandard is not None")
+    def test_missing_module(self):
+        with pytest.raises(codec.CodecException):
+            codec.get_codec('zstd')
+
+    def test_http_encodings(self):
+        """
+        Test decoding the encodings that requests decodes, under their other names.
+        """
+        data = b'0123456789' * 1000
+        assert codec.get_codec('x-gzip').name == 'gzip'
+        for wbits in [zlib.MAX_WBITS, -zlib.MAX_WBITS]:
+            zlib_obj = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            decompressor = codec.get_codec('deflate').decompressor()
+            compressed = zlib_obj.compress(data) + zlib_obj.flush()
+            assert decompressor.decompress(compressed) + decompressor.flush() == data
+
+    def test_unknown_codec(self):
+        with pytest.raises(codec.CodecException):
+            codec.get_codec('brotli')
+
+    def test_is_compressed(self):
+        with open('table.parq', 'wb') as fd:
+            fd.write(b'PAR1' + b'\0' * 100)
+        with open('table.csv', 'wb') as fd:
+            fd.write(b'a,b,c\n1,2,3\n')
+        assert codec.is_compressed('table.parq')
+        assert not codec.is_compressed('table.csv')
@@ -17,6 +17,7 @@ except ImportError:
     h5py = None
 
 from quilt.tools import command, store
+from quilt.tools.core import find_object_hashes
 from .utils import QuiltTestCase, patch
 
 class CommandTest(QuiltTestCase):
@@ -130,6 +131,88 @@ class CommandTest(QuiltTestCase):
 
         command.ls()
 
+    def test_migrate(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+        pkg_obj = store.get_store('foo', 'bar')
+        foo_hashes = pkg_obj.get_contents().children['foo'].hashes
+        expected = pkg_obj.dataframe(foo_hashes)
+
+        # Move the objects back to the old, flat layout.
+        objdir = os.path.join('quilt_packages', 'objs')
+        hashes = []
+        for root, _, files in os.walk(objdir):
+            if root == os.path.join(objdir, 'tmp'):
+                continue
+            for name in files:
+                os.rename(os.path.join(root, name), os.path.join(objdir, name))
+                hashes.append(name)
+        assert hashes
+        assert pkg_obj.dataframe(foo_hashes).equals(expected)
+
+        command.migrate()
+        for objhash in hashes:
+            assert not os.path.exists(os.path.join(objdir, objhash))
+            assert os.path.exists(os.path.join(objdir, objhash[:2], objhash[2:4], objhash))
+        assert pkg_obj.dataframe(foo_hashes).equals(expected)
+
+    def test_verify(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path, shard_rows=1)
+        command.verify('foo/bar', jobs=2)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        hashes = sorted(set(find_object_hashes(pkg_obj.get_contents())))
+        assert len(hashes) >= 2
+        with open(pkg_obj._object_path(hashes[0]), 'ab') as fd:
+            fd.write(b'garbage')
+        os.remove(pkg_obj._object_path(hashes[1]))
+
+        assert pkg_obj.verify_objects(jobs=2) == ([hashes[1]], {hashes[0]: None})
+        with assertRaisesRegex(self, command.CommandException, "1 missing and 1 corrupt"):
+            command.verify('foo/bar')
+
+    @patch('quilt.tools.store.TREE_HASH_THRESHOLD', 0)
+    @patch('quilt.tools.hashing.TREE_CHUNK_SIZE', 64)
+    def test_verify_chunks(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+        pkg_obj = store.get_store('foo', 'bar')
+        # Tree hashes are opt-in.
+        assert 'q_tree_hashes' not in pkg_obj.get_contents().children['foo'].metadata
+
+        with patch.dict(os.environ, QUILT_TREE_HASHES='1'):
+            command.build('foo/bar', build_path)
+            # A rebuild reuses the tree hashes, without reading the objects again.
+            with patch('quilt.tools.store.TreeHasher') as mock_hasher:
+                command.build('foo/bar', build_path)
+                assert not mock_hasher.called
+
+        node = pkg_obj.get_contents().children['foo']
+        objhash = node.hashes[0]
+        tree = node.metadata['q_tree_hashes'][objhash]
+        objpath = pkg_obj._object_path(objhash)
+        assert tree['size'] == os.path.getsize(objpath)
+        assert len(tree['chunks']) == (tree['size'] + 63) // 64 > 2
+        command.verify('foo/bar')
+
+        with open(objpath, 'r+b') as fd:
+            fd.seek(64 * 2 + 10)
+            byte = fd.read(1)
+            fd.seek(-1, os.SEEK_CUR)
+            fd.write(b'x' if byte != b'x' else b'y')
+        assert pkg_obj.verify_objects() == ([], {objhash: [2]})
+        with assertRaisesRegex(self, command.CommandException, "0 missing and 1 corrupt"):
+            command.verify('foo/bar')
+
+        # Tree hashes that weren't saved along with the object (e.g., ones
+        # from a registry) aren't trusted: the whole object is hashed.
+        os.remove(pkg_obj._tree_path(objhash))
+        assert pkg_obj.verify_objects() == ([], {objhash: None})
+
     def test_inspect_valid_package(self):
         mydir = os.path.dirname(__file__)
         build_path = os.path.join(mydir, './build_simple.yml')
@@ -0,0 +1,99 @@
+"""
+Tests for file hashing and the hash cache.
+"""
+import os
+import time
+
+from quilt.tools import command, hashing
+
+from .utils import QuiltTestCase, patch
+
+
+class HashCacheTest(QuiltTestCase):
+    """
+    Unit tests for the persistent hash cache.
+    """
+    def _write(self, path, data, age=60):
+        with open(path, 'w') as fd:
+            fd.write(data)
+        if age:
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+
+    def test_cache_hit(self):
+        self._write('old.txt', 'old')
+        self._write('new.txt', 'new', age=0)
+        expected = {path: hashing._hash_file(path) for path in ['old.txt', 'new.txt']}
+
+        with patch('quilt.tools.hashing._hash_file', wraps=hashing._hash_file) as mock_hash:
+            for _ in range(2):
+                for path in ['old.txt', 'new.txt']:
+                    assert hashing.digest_file(path) == expected[path]
+            # Recently modified files aren't cached.
+            assert [call[0][0] for call in mock_hash.call_args_list] == \
+                ['old.txt', 'new.txt', 'new.txt']
+
+            with patch.dict(os.environ, QUILT_NO_HASH_CACHE='1'):
+                assert hashing.hash_cache() is None
+                assert hashing.digest_file('old.txt') == expected['old.txt']
+            assert mock_hash.call_count == 4
+
+    def test_changed_file(self):
+        self._write('data.txt', 'aaa')
+        old_hash = hashing.digest_file('data.txt')
+        self._write('data.txt', 'bbbb')
+        assert hashing.digest_file('data.txt') != old_hash
+
+    def test_revalidate(self):
+        self._write('good.txt', 'good')
+        self._write('stale.txt', 'stale')
+        self._write('gone.txt', 'gone')
+        for path in ['good.txt', 'stale.txt', 'gone.txt']:
+            hashing.digest_file(path)
+
+        # Change the contents without changing the size or mtime.
+        stat = os.stat('stale.txt')
+        with open('stale.txt', 'w') as fd:
+            fd.write('STALE')
+        os.utime('stale.txt', (stat.st_atime, stat.st_mtime))
+        os.remove('gone.txt')
+
+        assert hashing.hash_cache().revalidate() == (3, 1, 1)
+        assert hashing.digest_file('stale.txt') == hashing._hash_file('stale.txt')
+
+        command.hash_cache_revalidate()
+        command.hash_cache_clear()
+        assert hashing.hash_cache().lookup('good.txt') is None
+
+    def test_digest_files(self):
+        paths = []
+        for i in range(20):
+            path = 'file%d.txt' % i
+            self._write(path, 'data' * i)
+            paths.append(path)
+        expected = [hashing._hash_file(path) for path in paths]
+
+        assert hashing.digest_files(paths, jobs=4) == expected
+        assert hashing.digest_files(paths, jobs=1, use_cache=False) == expected
+        assert hashing.digest_files([]) == []
+
+    def test_tree_hash(self):
+        self._write('data.txt', '0123456789' * 100)
+        tree = hashing.tree_hash('data.txt', chunk_size=64, jobs=4)
+        assert tree['size'] == 1000
+        assert tree['chunk_size'] == 64
+        assert len(tree['chunks']) == 16
+        assert tree['chunks'][0] == hashing._hash_range('data.txt', 0, 64)
+        assert tree['root'] == hashing.tree_root(tree['chunks'])
+        assert hashing.damaged_chunks('data.txt', tree) == []
+
+        hasher = hashing.TreeHasher(chunk_size=64)
+        data = ('0123456789' * 100).encode()
+        for start in range(0, 1000, 70):
+            hasher.update(data[start:start + 70])
+        assert hasher.tree() == tree
+
+        self._write('data.txt', '0123456789' * 20 + 'X123456789' + '0123456789' * 79)
+        assert hashing.damaged_chunks('data.txt', tree) == [3]
+        self._write('data.txt', '0123456789' * 99)
+        assert hashing.damaged_chunks('data.txt', tree) == [15]
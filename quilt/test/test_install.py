@@ -5,16 +5,18 @@ Tests for the install command.
 import hashlib
 import json
 import os
+import re
+import zlib
 
 import requests
 import responses
 from six import assertRaisesRegex
 
-from quilt.tools import command
+from quilt.tools import codec, command, hashing, store
 from quilt.tools.const import HASH_TYPE
 from quilt.tools.core import decode_node, encode_node, hash_contents, GroupNode, TableNode, FileNode
 
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 class InstallTest(QuiltTestCase):
     """
@@ -54,14 +56,286 @@ class InstallTest(QuiltTestCase):
             file_contents = json.load(fd, object_hook=decode_node)
             assert file_contents == contents
 
-        with open('quilt_packages/objs/{hash}'.format(hash=table_hash)) as fd:
+        with open(self._object_file(table_hash)) as fd:
             contents = fd.read()
             assert contents == table_data
 
-        with open('quilt_packages/objs/{hash}'.format(hash=file_hash)) as fd:
+        with open(self._object_file(file_hash)) as fd:
             contents = fd.read()
             assert contents == file_data
 
+    def test_install_parallel(self):
+        """
+        Install a package with many objects using several download threads.
+        """
+        tables = {}
+        for i in range(10):
+            table_data = "table%d" % i
+            h = hashlib.new(HASH_TYPE)
+            h.update(table_data.encode('utf-8'))
+            tables[h.hexdigest()] = table_data
+
+        contents = GroupNode(dict(
+            ('t%d' % i, TableNode([table_hash]))
+            for i, table_hash in enumerate(sorted(tables))
+        ))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, list(tables))
+        for table_hash, table_data in tables.items():
+            self._mock_s3(table_hash, table_data)
+
+        session = requests.Session()
+        command.install(session, 'foo/bar', jobs=3)
+
+        for table_hash, table_data in tables.items():
+            with open(self._object_file(table_hash)) as fd:
+                assert fd.read() == table_data
+
+    def test_install_existing_objects(self):
+        """
+        Install a package where some objects are already in the object store.
+        """
+        old_data = "old table" * 10
+        old_hash = self._hash(old_data)
+        new_data = "new table" * 10
+        new_hash = self._hash(new_data)
+        contents = GroupNode(dict(
+            old=TableNode([old_hash]),
+            new=TableNode([new_hash])
+        ))
+        contents_hash = hash_contents(contents)
+
+        # The old object is still in the flat layout of older versions.
+        os.makedirs('quilt_packages/objs')
+        with open('quilt_packages/objs/{hash}'.format(hash=old_hash), 'w') as fd:
+            fd.write(old_data)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [old_hash, new_hash])
+        # Only the new object should be requested.
+        self._mock_s3(new_hash, new_data)
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        with open(self._object_file(new_hash)) as fd:
+            assert fd.read() == new_data
+        pkg_obj = store.get_store('foo', 'bar')
+        assert pkg_obj.file([old_hash]) == os.path.abspath('quilt_packages/objs/' + old_hash)
+        s3_urls = [call.request.url for call in self.requests_mock.calls
+                   if call.request.url.startswith('https://example.com/')]
+        assert s3_urls == ['https://example.com/%s' % new_hash]
+
+    def test_install_gzip(self):
+        """
+        Install an object stored with 'Content-Encoding: gzip'.
+        """
+        table_data = "table" * 1000
+        table_hash = self._hash(table_data)
+        contents = GroupNode(dict(foo=TableNode([table_hash])))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash])
+        # Two gzip members, as produced by parallel compression.
+        body = (self._gzip(table_data[:1234].encode('utf-8')) +
+                self._gzip(table_data[1234:].encode('utf-8')))
+        self.requests_mock.add(responses.GET, 'https://example.com/%s' % table_hash, body,
+                               headers={'Content-Encoding': 'gzip'})
+
+        session = requests.Session()
+        # It's decoded and hashed as it's downloaded, not read again.
+        with patch('quilt.tools.store.open', create=True, side_effect=open) as mock_open:
+            command.install(session, 'foo/bar')
+        assert not [call for call in mock_open.call_args_list
+                    if call[0][0].endswith('.part') and call[0][1] == 'rb']
+
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+        assert not os.path.exists('quilt_packages/objs/tmp/%s.part' % table_hash)
+
+    def test_resume_download(self):
+        """
+        Resume an interrupted download from its partial file.
+        """
+        table_data = "0123456789" * 100
+        table_hash = self._hash(table_data)
+        contents = GroupNode(dict(foo=TableNode([table_hash])))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash])
+        requested_ranges = self._mock_s3_ranges(table_hash, table_data)
+
+        os.makedirs('quilt_packages/objs/tmp')
+        with open('quilt_packages/objs/tmp/%s.part' % table_hash, 'w') as fd:
+            fd.write(table_data[:300])
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        assert requested_ranges == ['bytes=300-']
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+        assert not os.path.exists('quilt_packages/objs/tmp/%s.part' % table_hash)
+
+    @patch('quilt.tools.store.DOWNLOAD_RANGE_THRESHOLD', 100)
+    @patch('quilt.tools.store.DOWNLOAD_RANGE_SIZE', 64)
+    def test_parallel_ranges(self):
+        """
+        Download a large object as several byte ranges.
+        """
+        table_data = "0123456789" * 100
+        table_hash = self._hash(table_data)
+        contents = GroupNode(dict(foo=TableNode([table_hash])))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash])
+        requested_ranges = self._mock_s3_ranges(table_hash, table_data)
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        assert len(requested_ranges) == 1 + 16  # The initial request, then 16 ranges.
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+
+    @patch('quilt.tools.store.DOWNLOAD_RANGE_THRESHOLD', 100)
+    @patch('quilt.tools.store.DOWNLOAD_RANGE_SIZE', 64)
+    def test_ranges_remove_stale_part(self):
+        """
+        Remove the partial file of an earlier download once the object has
+        been fetched as byte ranges instead.
+        """
+        table_data = "0123456789" * 100
+        table_hash = self._hash(table_data)
+        contents = GroupNode(dict(foo=TableNode([table_hash])))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash])
+
+        def callback(request):
+            # Open-ended ranges are ignored, so the partial file isn't resumed.
+            headers = {'Accept-Ranges': 'bytes'}
+            start, end = re.match(r'bytes=(\d+)-(\d*)$', request.headers['Range']).groups()
+            if not end:
+                headers['Content-Length'] = str(len(table_data))
+                return (200, headers, table_data)
+            start, end = int(start), int(end)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(table_data))
+            return (206, headers, table_data[start:end+1])
+
+        s3_url = 'https://example.com/%s' % table_hash
+        self.requests_mock.add_callback(responses.GET, s3_url, callback=callback)
+
+        os.makedirs('quilt_packages/objs/tmp')
+        with open('quilt_packages/objs/tmp/%s.part' % table_hash, 'w') as fd:
+            fd.write("garbage")
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+        assert not os.path.exists('quilt_packages/objs/tmp/%s.part' % table_hash)
+
+    def test_repair_download(self):
+        """
+        Fetch only the damaged chunks of an object that arrives corrupted.
+        """
+        table_data = "0123456789" * 100
+        table_hash = self._hash(table_data)
+        contents = GroupNode(dict(foo=TableNode([table_hash], self._tree_metadata(table_data))))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash])
+        # The whole object arrives with one bad byte; ranges are fine.
+        requested_ranges = self._mock_s3_ranges(table_hash, table_data,
+                                                 table_data[:300] + 'X' + table_data[301:])
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        assert requested_ranges == [None, 'bytes=256-319']
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+
+    def test_malformed_trees(self):
+        """
+        Ignore tree hashes that are malformed, and download the objects whole.
+        """
+        tables = {}
+        for i in range(4):
+            table_data = "table%d" % i * 100
+            tables[self._hash(table_data)] = table_data
+        hashes = sorted(tables)
+        good_tree = self._tree_metadata(tables[hashes[0]])['q_tree_hashes'][hashes[0]]
+        contents = GroupNode(dict(
+            t0=TableNode([hashes[0]], dict(q_tree_hashes="bogus")),
+            t1=TableNode([hashes[1]], dict(q_tree_hashes={hashes[1]: dict(root='abc')})),
+            t2=TableNode([hashes[2]], dict(q_tree_hashes={
+                hashes[2]: dict(good_tree, chunks=['not hex'])
+            })),
+            t3=TableNode([hashes[3]], dict(q_tree_hashes={hashes[3]: [good_tree]})),
+        ))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, hashes)
+        for table_hash, table_data in tables.items():
+            self._mock_s3(table_hash, table_data)
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+
+        for table_hash, table_data in tables.items():
+            with open(self._object_file(table_hash)) as fd:
+                assert fd.read() == table_data
+        assert store._find_tree_hashes(contents) == {}
+
+    def test_install_repair(self):
+        """
+        Repair the damaged chunks of an installed object.
+        """
+        table_data = "0123456789" * 100
+        table_hash = self._hash(table_data)
+        file_data = "file" * 10
+        file_hash = self._hash(file_data)
+        contents = GroupNode(dict(
+            foo=TableNode([table_hash], self._tree_metadata(table_data)),
+            bar=FileNode([file_hash])
+        ))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, contents, [table_hash, file_hash])
+        requested_ranges = self._mock_s3_ranges(table_hash, table_data)
+        self._mock_s3(file_hash, file_data)
+
+        session = requests.Session()
+        command.install(session, 'foo/bar')
+        assert requested_ranges == [None]
+
+        # Damage the table (without a tree hash, the file is downloaded again).
+        with open(self._object_file(table_hash), 'r+') as fd:
+            fd.seek(700)
+            fd.write('X')
+        with open(self._object_file(file_hash), 'w') as fd:
+            fd.write('damaged')
+
+        command.install(session, 'foo/bar', repair=True)
+
+        assert requested_ranges == [None, 'bytes=640-703']
+        with open(self._object_file(table_hash)) as fd:
+            assert fd.read() == table_data
+        with open(self._object_file(file_hash)) as fd:
+            assert fd.read() == file_data
+
     def test_bad_contents_hash(self):
         """
         Test that a package with a bad contents hash fails installation.
@@ -111,6 +385,28 @@ class InstallTest(QuiltTestCase):
             command.install(session, 'foo/bar')
 
         assert not os.path.exists('quilt_packages/foo/bar.json')
+        # Nothing should be left behind in the object store.
+        assert not os.path.exists(self._object_file(obj_hash))
+        assert os.listdir('quilt_packages/objs/tmp') == []
+
+    def _object_file(self, objhash):
+        return 'quilt_packages/objs/{0}/{1}/{2}'.format(objhash[:2], objhash[2:4], objhash)
+
+    def _tree_metadata(self, data):
+        with open('tree_data', 'w') as fd:
+            fd.write(data)
+        tree = hashing.tree_hash('tree_data', chunk_size=64)
+        os.remove('tree_data')
+        return dict(q_tree_hashes={self._hash(data): tree})
+
+    def _hash(self, data):
+        h = hashlib.new(HASH_TYPE)
+        h.update(data.encode('utf-8'))
+        return h.hexdigest()
+
+    def _gzip(self, data):
+        zlib_obj = zlib.compressobj(codec.ZLIB_LEVEL, codec.ZLIB_METHOD, codec.ZLIB_WBITS)
+        return zlib_obj.compress(data) + zlib_obj.flush()
 
     def _mock_tag(self, package, tag, pkg_hash):
         tag_url = '%s/api/tag/%s/%s' % (command.QUILT_PKG_URL, package, tag)
@@ -129,3 +425,29 @@ class InstallTest(QuiltTestCase):
     def _mock_s3(self, pkg_hash, contents):
         s3_url = 'https://example.com/%s' % pkg_hash
         self.requests_mock.add(responses.GET, s3_url, contents)
+
+    def _mock_s3_ranges(self, pkg_hash, contents, full_contents=None):
+        """
+        Mocks an S3 object that supports range requests; returns the list of
+        requested ranges. `full_contents`, if given, is sent instead of
+        `contents` for requests without a range.
+        """
+        requested_ranges = []
+
+        def callback(request):
+            headers = {'Accept-Ranges': 'bytes'}
+            range_header = request.headers.get('Range')
+            requested_ranges.append(range_header)
+            if range_header is None:
+                body = contents if full_contents is None else full_contents
+                headers['Content-Length'] = str(len(body))
+                return (200, headers, body)
+            start, end = re.match(r'bytes=(\d+)-(\d*)$', range_header).groups()
+            start = int(start)
+            end = int(end) if end else len(contents) - 1
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(contents))
+            return (206, headers, contents[start:end+1])
+
+        s3_url = 'https://example.com/%s' % pkg_hash
+        self.requests_mock.add_callback(responses.GET, s3_url, callback=callback)
+        return requested_ranges
@@ -8,10 +8,10 @@ import os
 import requests
 import responses
 
-from quilt.tools import command, store
+from quilt.tools import cache, codec, command, store
 from quilt.tools.core import find_object_hashes
 
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 def upload_urls(contents):
     all_hashes = set(find_object_hashes(contents))
@@ -49,6 +49,171 @@ class PushTest(QuiltTestCase):
         session = requests.Session()
         command.push(session, 'foo/bar')
 
+    def test_push_streaming(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        contents = pkg_obj.get_contents()
+        urls = upload_urls(contents)
+        uploaded = {}
+        for objhash, url in urls.items():
+            self._mock_s3_capture(url, objhash, uploaded)
+
+        self._mock_put_package('foo/bar', pkg_hash, contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        session = requests.Session()
+        # Without the upload cache, objects are compressed into temporary files.
+        with patch.dict(os.environ, QUILT_UPLOAD_CACHE_SIZE='0'):
+            command.push(session, 'foo/bar')
+
+        assert set(uploaded) == set(urls)
+        assert not os.path.exists(cache.UPLOAD_CACHE_DIR)
+        for objhash, data in uploaded.items():
+            with open(pkg_obj._object_path(objhash), 'rb') as fd:
+                decompressor = codec.GzipCodec().decompressor()
+                assert decompressor.decompress(data) + decompressor.flush() == fd.read()
+
+    def test_push_no_space(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        contents = pkg_obj.get_contents()
+        urls = upload_urls(contents)
+        uploaded = {}
+        encodings = {}
+        for objhash, url in urls.items():
+            self._mock_s3_capture(url, objhash, uploaded, encodings)
+        self._mock_put_package('foo/bar', pkg_obj.get_hash(), contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        # Without room to compress them into, objects are sent uncompressed,
+        # rather than compressed twice.
+        with patch.dict(os.environ, QUILT_UPLOAD_CACHE_SIZE='0'), \
+             patch('quilt.tools.store._free_space', return_value=0), \
+             patch('quilt.tools.codec.GzipCodec.compress', side_effect=AssertionError):
+            command.push(requests.Session(), 'foo/bar')
+
+        for objhash, data in uploaded.items():
+            assert encodings[objhash] is None
+            with open(pkg_obj._object_path(objhash), 'rb') as fd:
+                assert data == fd.read()
+
+    @patch('quilt.tools.store.TREE_HASH_THRESHOLD', 0)
+    def test_push_tree_hashes(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        with patch.dict(os.environ, QUILT_TREE_HASHES='1'):
+            command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        contents = pkg_obj.get_contents()
+        urls = upload_urls(contents)
+        assert set(pkg_obj.tree_hashes()) == set(urls)
+        uploaded = {}
+        encodings = {}
+        for objhash, url in urls.items():
+            self._mock_s3_capture(url, objhash, uploaded, encodings)
+        self._mock_put_package('foo/bar', pkg_obj.get_hash(), contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        # Objects with tree hashes aren't compressed, so they can be repaired by chunk.
+        command.push(requests.Session(), 'foo/bar')
+        for objhash, data in uploaded.items():
+            assert encodings[objhash] is None
+            with open(pkg_obj._object_path(objhash), 'rb') as fd:
+                assert data == fd.read()
+
+    def test_push_cache(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        contents = pkg_obj.get_contents()
+        urls = upload_urls(contents)
+        first_upload = {}
+        for objhash, url in urls.items():
+            self._mock_s3_capture(url, objhash, first_upload)
+        self._mock_put_package('foo/bar', pkg_hash, contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        session = requests.Session()
+        command.push(session, 'foo/bar')
+        assert len(os.listdir(cache.UPLOAD_CACHE_DIR)) == len(urls)
+
+        # Push again: nothing should get compressed.
+        self.requests_mock.reset()
+        second_upload = {}
+        for objhash, url in urls.items():
+            self._mock_s3_capture(url, objhash, second_upload)
+        self._mock_put_package('foo/bar', pkg_hash, contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        with patch('quilt.tools.codec.GzipCodec.compress', side_effect=AssertionError):
+            command.push(session, 'foo/bar')
+        assert second_upload == first_upload
+
+    def test_upload_cache_eviction(self):
+        upload_cache = cache.UploadCache(max_size=250)
+        for i in range(2):
+            chunks = upload_cache.add('hash%d' % i, 'gzip', [b'x' * 100], 100)
+            assert b''.join(chunks) == b'x' * 100
+            entry = os.path.join(cache.UPLOAD_CACHE_DIR, 'hash%d.gzip' % i)
+            os.utime(entry, (1000 + i, 1000 + i))
+
+        # Use the oldest entry, then go over the limit.
+        upload_cache.open('hash0', 'gzip').close()
+        list(upload_cache.add('hash2', 'gzip', [b'x' * 100], 100))
+
+        assert sorted(os.listdir(cache.UPLOAD_CACHE_DIR)) == ['hash0.gzip', 'hash2.gzip']
+
+    @patch('time.sleep')
+    def test_push_retry(self, mock_sleep):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        contents = pkg_obj.get_contents()
+        urls = upload_urls(contents)
+        for url in urls.values():
+            # Fail once, then succeed.
+            self.requests_mock.add(responses.PUT, url, status=503)
+            self._mock_s3(url)
+
+        self._mock_put_package('foo/bar', pkg_hash, contents)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        session = requests.Session()
+        command.push(session, 'foo/bar', jobs=2)
+
+        assert mock_sleep.call_count == len(urls)
+
+    @patch('time.sleep')
+    def test_push_not_implemented(self, mock_sleep):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.get_store('foo', 'bar')
+        contents = pkg_obj.get_contents()
+        for url in upload_urls(contents).values():
+            self.requests_mock.add(responses.PUT, url, status=501)
+        self._mock_put_package('foo/bar', pkg_obj.get_hash(), contents)
+
+        # Retrying won't help.
+        with self.assertRaises(command.CommandException):
+            command.push(requests.Session(), 'foo/bar', jobs=1)
+        assert not mock_sleep.called
+
     def _mock_put_package(self, package, pkg_hash, contents):
         pkg_url = '%s/api/package/%s/%s' % (command.QUILT_PKG_URL, package, pkg_hash)
         self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(
@@ -61,3 +226,18 @@ class PushTest(QuiltTestCase):
 
     def _mock_s3(self, s3_url):
         self.requests_mock.add(responses.PUT, s3_url)
+
+    def _mock_s3_capture(self, s3_url, objhash, uploaded, encodings=None):
+        def callback(request):
+            # S3 rejects chunked encoding: the body must have a length.
+            assert 'Transfer-Encoding' not in request.headers
+            body = request.body
+            if hasattr(body, 'read'):
+                body = body.read()
+            assert int(request.headers['Content-Length']) == len(body)
+            uploaded[objhash] = body
+            if encodings is not None:
+                encodings[objhash] = request.headers.get('Content-Encoding')
+            return (200, {}, '')
+
+        self.requests_mock.add_callback(responses.PUT, s3_url, callback=callback)
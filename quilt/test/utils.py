@@ -16,6 +16,8 @@ except ImportError:
 
 import responses
 
+from quilt.tools.cache import DataFrameCache
+
 
 class QuiltTestCase(unittest.TestCase):
     """
@@ -31,7 +33,21 @@ class QuiltTestCase(unittest.TestCase):
         self.requests_mock = responses.RequestsMock(assert_all_requests_are_fired=False)
         self.requests_mock.start()
 
+        # Keep local caches inside the test directory.
+        self._cache_patcher = patch('quilt.tools.cache.UPLOAD_CACHE_DIR',
+                                    os.path.join(self._test_dir, 'upload_cache'))
+        self._cache_patcher.start()
+        self._dataframe_cache_patcher = patch('quilt.tools.cache._dataframe_cache',
+                                              DataFrameCache())
+        self._dataframe_cache_patcher.start()
+        self._hash_cache_patcher = patch('quilt.tools.hashing.HASH_CACHE_PATH',
+                                         os.path.join(self._test_dir, 'hash_cache.sqlite'))
+        self._hash_cache_patcher.start()
+
     def tearDown(self):
+        self._hash_cache_patcher.stop()
+        self._dataframe_cache_patcher.stop()
+        self._cache_patcher.stop()
         self.requests_mock.stop()
 
         os.chdir(self._old_dir)
@@ -1,19 +1,141 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import itertools
+import json
 import os
 import re
 
+import numpy as np
 import yaml
 import pandas as pd
 
-from .store import get_store, VALID_NAME_RE, StoreException
-from .const import PACKAGE_DIR_NAME, TARGET
+from .store import get_store, table_metadata, VALID_NAME_RE, StoreException
+from .const import HASH_TYPE, PACKAGE_DIR_NAME, TARGET
+from .hashing import (digest_file, digest_files, hash_cache, tree_hashes_enabled, HashCache,
+                      HashingReader)
 from .util import FileWithReadProgress
 
+# Number of rows hashed together to find content-defined shard boundaries.
+CDC_WINDOW = 16
+# Number of rows used to estimate the size of a row, for `shard_size`.
+SIZE_SAMPLE_ROWS = 1000
+
 class BuildException(Exception):
     """
     Build-time exception class
     """
     pass
 
+class BuildCache(object):
+    """
+    Remembers which object each source file was converted into, so that
+    tables whose source hasn't changed are not parsed again.
+
+    Entries are keyed by the source path, and are only used if the parser
+    settings, the package format, the sharding, whether there are tree
+    hashes, and the file's size and mtime - or, failing that, its content
+    hash - all match.
+
+    The shards of sharded tables are also remembered by their rows (see
+    `_shard_key`), so unchanged shards of a changed table are reused, too.
+    """
+    def __init__(self, store, chunksize=None, shard_rows=None, shard_size=None,
+                 content_defined=False):
+        self._store = store
+        self._chunksize = chunksize
+        self._shard_rows = shard_rows
+        self._shard_size = shard_size
+        self._content_defined = content_defined
+        self._path = store.build_cache_path()
+        try:
+            with open(self._path) as fd:
+                self._entries = json.load(fd)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def _parse_key(self, ext, target):
+        logic = TARGET.get(target, {}).get(ext.lower())
+        key = json.dumps([type(self._store).__name__, target, ext.lower(), logic, self._chunksize,
+                          self._shard_rows, self._shard_size, self._content_defined,
+                          tree_hashes_enabled()],
+                         sort_keys=True)
+        return hashlib.new(HASH_TYPE, key.encode()).hexdigest()
+
+    @staticmethod
+    def _mtime_ns(stat):
+        return getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+
+    def lookup(self, path, ext, target):
+        """
+        Returns the hashes of the objects built from `path` last time and
+        the table's metadata, or None if it needs to be built again.
+        """
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is None or entry['parse_key'] != self._parse_key(ext, target):
+            return None
+        if 'metadata' not in entry or not all(self._store.has_object(h) for h in entry['hashes']):
+            return None
+
+        stat = os.stat(path)
+        if stat.st_size != entry['size']:
+            return None
+        mtime_ns = self._mtime_ns(stat)
+        if mtime_ns != entry['mtime_ns']:
+            # Touched, but not necessarily modified.
+            if digest_file(path) != entry['content_hash']:
+                return None
+            entry['mtime_ns'] = mtime_ns
+        return entry['hashes'], entry['metadata']
+
+    def add(self, path, ext, target, hashes, metadata, shard_keys=None, content_hash=None):
+        """
+        Records the objects built from `path`, and the `_shard_key`s of
+        their rows, if it's sharded. `content_hash` is the hash of the
+        file, if it was computed while parsing it; otherwise, it's read
+        again.
+        """
+        stat = os.stat(path)
+        self._entries[os.path.abspath(path)] = dict(
+            size=stat.st_size,
+            mtime_ns=self._mtime_ns(stat),
+            content_hash=content_hash or digest_file(path),
+            parse_key=self._parse_key(ext, target),
+            hashes=hashes,
+            metadata=metadata,
+            shard_keys=shard_keys
+        )
+
+    def shards(self):
+        """
+        Returns the hashes of the shards built so far, keyed by `_shard_key`.
+        """
+        return {
+            key: objhash
+            for entry in self._entries.values()
+            for key, objhash in zip(entry.get('shard_keys') or [], entry['hashes'])
+        }
+
+    def trees(self):
+        """
+        Returns the tree hashes of the objects built so far, keyed by hash.
+        """
+        return {
+            objhash: tree
+            for entry in self._entries.values()
+            for objhash, tree in (entry.get('metadata') or {}).get('q_tree_hashes', {}).items()
+        }
+
+    def save(self):
+        """
+        Writes the cache to disk.
+        """
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as fd:
+            json.dump(self._entries, fd)
+        if os.path.exists(self._path) and os.name == 'nt':
+            os.remove(self._path)
+        os.rename(temp_path, self._path)
+
 def _pythonize_name(name):
     safename = re.sub('[^A-Za-z0-9_]+', '_', name)
     starts_w_number = re.match('^[0-9].*', safename)
@@ -26,37 +148,404 @@ def _pythonize_name(name):
         raise BuildException("Unable to determine a Python-legal name for %s" % name)
     return safename
 
-def _build_file(build_dir, store, name, rel_path, target='file'):
+def _build_file(build_dir, store, name, rel_path, target='file', ingest_mode=None):
     path = os.path.join(build_dir, rel_path)
-    store.save_file(path, name, name, target)
+    store.save_file(path, name, name, target, ingest_mode)
 
-def _build_table(build_dir, store, name, table, target='pandas'):
+def _table_specs(build_dir, name, table, target='pandas'):
+    """
+    Flattens a (nested) table definition into a list of
+    (name, ext, path, target) tuples, in the order of the build file.
+    """
     if isinstance(table, list):
         if len(table) != 2:
             raise BuildException(
                 "Table definition must be a list of [type, path]")
         ext, rel_path = table
         path = os.path.join(build_dir, rel_path)
-        # read source file into DataFrame
-        print("Reading %s..." % path)
-        df = _file_to_data_frame(ext, path, target)
-        # serialize DataFrame to file(s)
-        print("Writing the dataframe...")
-        store.save_df(df, name, path, ext, target)
+        return [(name, ext, path, target)]
 
     elif isinstance(table, dict):
         # TODO the problem with this, it does not seem to iterate
         # in the same order as the entries in the file, which is
         # weird as users might expect error/success messages to be in
         # file order
+        specs = []
         for child_name, child_table in table.items():
             if not isinstance(child_name, str) or not VALID_NAME_RE.match(child_name):
                 raise StoreException("Invalid table name: %r" % child_name)
-            _build_table(build_dir, store, name + '/' + child_name, child_table)
+            specs += _table_specs(build_dir, name + '/' + child_name, child_table)
+        return specs
     else:
         raise BuildException("Table definition must be a list or dict")
 
-def _file_to_data_frame(ext, path, target):
+def _rows_per_shard(frames, shard_size):
+    """
+    Returns the number of rows that take up about `shard_size` bytes in
+    memory, judging by the first SIZE_SAMPLE_ROWS rows of an iterable of
+    DataFrames - however they're split into DataFrames - and an iterable
+    of the same DataFrames.
+    """
+    frames = iter(frames)
+    sample = []
+    sample_rows = 0
+    for frame in frames:
+        sample.append(frame)
+        sample_rows += len(frame)
+        if sample_rows >= SIZE_SAMPLE_ROWS:
+            break
+    frames = itertools.chain(sample, frames)
+    if not sample_rows:
+        return 1, frames
+    head = pd.concat(sample) if len(sample) > 1 else sample[0]
+    head = head.iloc[:SIZE_SAMPLE_ROWS]
+    row_size = float(head.memory_usage(index=False, deep=True).sum()) / len(head)
+    return max(1, int(shard_size // max(row_size, 1))), frames
+
+def _split_shards(frames, shard_rows=None, shard_size=None):
+    """
+    Regroups an iterable of DataFrames into shards of `shard_rows` rows
+    (or, if only `shard_size` is given, of about `shard_size` bytes; see
+    `_rows_per_shard`).
+
+    Shard boundaries only depend on row numbers, so changing some rows of
+    a table only changes the shards that contain them.
+    """
+    if shard_rows is None:
+        shard_rows, frames = _rows_per_shard(frames, shard_size)
+    pending = []
+    pending_rows = 0
+    last = None
+    for frame in frames:
+        last = frame
+        while len(frame):
+            piece = frame.iloc[:shard_rows - pending_rows]
+            frame = frame.iloc[len(piece):]
+            pending.append(piece)
+            pending_rows += len(piece)
+            if pending_rows == shard_rows:
+                yield pd.concat(pending) if len(pending) > 1 else pending[0]
+                pending = []
+                pending_rows = 0
+                last = None
+    if pending:
+        yield pd.concat(pending) if len(pending) > 1 else pending[0]
+    elif last is not None and not len(last):
+        # An empty table still needs one (empty) shard for its columns.
+        yield last
+
+def _content_cuts(hashes, tail, shard_rows):
+    """
+    Returns a boolean array that's True for the rows (given their `hashes`)
+    after which a content-defined shard may end, and the new `tail`: the
+    hashes of the last rows, for the next call.
+
+    A shard may end where the sum of the hashes of the last CDC_WINDOW rows
+    is a multiple of `shard_rows`, so it happens every `shard_rows` rows on
+    average, and only depends on the rows right before it.
+    """
+    values = np.concatenate([tail, hashes])
+    # uint64 sums wrap around, which is fine for hashing.
+    sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(values, dtype=np.uint64)])
+    ends = np.arange(len(tail), len(values)) + 1
+    window = sums[ends] - sums[np.maximum(ends - CDC_WINDOW, 0)]
+    return window % np.uint64(shard_rows) == 0, values[-(CDC_WINDOW - 1):]
+
+def _split_content_defined(frames, shard_rows=None, shard_size=None, info=None):
+    """
+    Same as `_split_shards`, but the shard boundaries depend on the rows'
+    contents (see `_content_cuts`), and `shard_rows` is the average number
+    of rows per shard; shards are 4 times smaller or bigger at most.
+
+    Inserting or deleting rows only changes the shards around them, since
+    the boundaries after them stay with the same rows. So that the shards
+    don't depend on their row numbers either, a default (0, 1, 2...) index
+    starts over at 0 in each shard; if so, `info['positional']` is set to
+    True (see `store._shard_offsets`).
+    """
+    if shard_rows is None:
+        shard_rows, frames = _rows_per_shard(frames, shard_size)
+    min_rows = max(1, shard_rows // 4)
+    max_rows = shard_rows * 4
+    pending = []
+    pending_rows = 0
+    last = None
+    positional = None
+    tail = np.zeros(0, dtype=np.uint64)
+
+    def make_shard(pieces):
+        shard = pd.concat(pieces) if len(pieces) > 1 else pieces[0]
+        if positional:
+            shard = shard.copy(deep=False)
+            shard.index = pd.RangeIndex(len(shard))
+        return shard
+
+    for frame in frames:
+        last = frame
+        if positional is None:
+            positional = (isinstance(frame.index, pd.RangeIndex) and
+                          frame.index.equals(pd.RangeIndex(len(frame))))
+            if info is not None:
+                info['positional'] = positional
+
+        cuts, tail = _content_cuts(pd.util.hash_pandas_object(frame, index=False).values,
+                                   tail, shard_rows)
+        ends = np.flatnonzero(cuts) + 1
+        start = 0
+        while start < len(frame):
+            limit = start + max_rows - pending_rows
+            idx = np.searchsorted(ends, start + max(1, min_rows - pending_rows))
+            end = min(ends[idx], limit) if idx < len(ends) else limit
+            if end > len(frame):
+                pending.append(frame.iloc[start:])
+                pending_rows += len(frame) - start
+                break
+            pending.append(frame.iloc[start:end])
+            yield make_shard(pending)
+            pending = []
+            pending_rows = 0
+            start = end
+            last = None
+    if pending:
+        yield make_shard(pending)
+    elif last is not None and not len(last):
+        yield last
+
+def _shard_key(store, shard):
+    """
+    Returns a hash of a shard's rows (including the index), columns, and
+    dtypes, and of the store's format: shards with the same key are
+    serialized the same way, even by formats that aren't byte-for-byte
+    reproducible, like HDF5.
+    """
+    header = json.dumps([type(store).__name__, [str(column) for column in shard.columns],
+                         [str(dtype) for dtype in shard.dtypes], type(shard.index).__name__])
+    h = hashlib.new(HASH_TYPE, header.encode())
+    h.update(pd.util.hash_pandas_object(shard, index=True).values.tobytes())
+    return h.hexdigest()
+
+def _write_shards(store, name, frames, shard_rows, shard_size, content_defined=False,
+                  known_shards=None):
+    """
+    Writes each shard into its own object, unless `known_shards` (see
+    `BuildCache.shards`) has one with the same rows. Returns the lists of
+    hashes and of `_shard_key`s, and the metadata to add to the table's:
+    if the shards' indexes start over at 0, `q_positional_index` and the
+    number of rows of each shard (`q_shard_rows`), so they can be
+    renumbered when read.
+    """
+    info = {}
+    if content_defined:
+        shards = _split_content_defined(frames, shard_rows, shard_size, info)
+    else:
+        shards = _split_shards(frames, shard_rows, shard_size)
+    known_shards = known_shards or {}
+    hashes = []
+    keys = []
+    rows = []
+    for idx, shard in enumerate(shards):
+        key = _shard_key(store, shard)
+        objhash = known_shards.get(key)
+        if objhash is None or not store.has_object(objhash):
+            objhash = store.write_df(shard, '%s.%d' % (name, idx))
+        hashes.append(objhash)
+        keys.append(key)
+        rows.append(len(shard))
+    if info.get('positional'):
+        return hashes, keys, dict(q_positional_index=True, q_shard_rows=rows)
+    return hashes, keys, {}
+
+def _convert_table(store, name, ext, path, target, chunksize=None, shard_rows=None,
+                   shard_size=None, progress=True, content_defined=False, known_shards=None):
+    """
+    Reads a source file and serializes it into one or more objects.
+    Returns the list of object hashes, the table's metadata, the
+    `_shard_key`s of the objects (None if the table isn't sharded), and
+    the hash of the source file, computed while parsing it (or None, if
+    the parser didn't read it from start to end).
+
+    With `chunksize`, delimited files are read and written `chunksize` rows
+    at a time, so memory use doesn't depend on the size of the file.
+
+    With `shard_rows` or `shard_size`, the table is split into shards of
+    that many rows or bytes, each stored as a separate object; or that
+    many on average, with content-defined boundaries if `content_defined`
+    is True. Shards that are in `known_shards` aren't written again.
+    """
+    sharded = shard_rows is not None or shard_size is not None
+    handler, kwargs, failover = _ingest_logic(ext, target)
+    if chunksize is None or handler is not pd.read_csv:
+        df, content_hash = _file_to_data_frame(ext, path, target, progress)
+        if progress:
+            print("Writing the dataframe...")
+        if sharded:
+            hashes, keys, shard_metadata = _write_shards(store, name, [df], shard_rows,
+                                                         shard_size, content_defined,
+                                                         known_shards)
+            metadata = table_metadata(df)
+            metadata.update(shard_metadata)
+            return hashes, metadata, keys, content_hash
+        return [store.write_df(df, name)], table_metadata(df), None, content_hash
+
+    metadata = {}
+    content_hash = None
+
+    def read_chunks(path_or_fd, handler_kwargs, dtypes):
+        metadata.clear()
+        rows = 0
+        for chunk in handler(path_or_fd, chunksize=chunksize, **handler_kwargs):
+            # Chunks are parsed on their own, e.g., ints only become floats in
+            # the chunks with missing values; they all get the same dtypes.
+            changed = {column: dtype for column, dtype in dtypes.items()
+                       if chunk[column].dtype != dtype}
+            if changed:
+                chunk = chunk.astype(changed)
+                for column, dtype in changed.items():
+                    if dtype == object:
+                        # Numbers in a column that's text in other chunks are
+                        # text, too; the table formats can't mix them.
+                        values = chunk[column]
+                        chunk[column] = values.astype(str).where(values.notnull(), values)
+            rows += len(chunk)
+            if not metadata:
+                metadata.update(table_metadata(chunk))
+            metadata['q_shape'][0] = rows
+            yield chunk
+
+    def write_chunks(chunks, string_sizes):
+        if sharded:
+            hashes, keys, shard_metadata = _write_shards(store, name, chunks, shard_rows,
+                                                         shard_size, content_defined,
+                                                         known_shards)
+            metadata.update(shard_metadata)
+            return hashes, metadata, keys, content_hash
+        return [store.write_df_chunks(chunks, name, string_sizes)], metadata, None, content_hash
+
+    # The file is parsed twice: once to find the dtypes that fit every chunk
+    # (and hash it), and once to write the chunks.
+    try:
+        with HashingReader(open(path, 'rb')) as fd:
+            dtypes, string_sizes = _scan_chunks(handler(fd, chunksize=chunksize, **kwargs))
+        content_hash = fd.hexdigest(path)
+        with (FileWithReadProgress(path) if progress else open(path, 'rb')) as fd:
+            return write_chunks(read_chunks(fd, kwargs, dtypes), string_sizes)
+    except UnicodeDecodeError as error:
+        if not failover:
+            raise error
+        warning = "Warning: failed fast parse on input %s.\n" % path
+        warning += "Switching to Python engine."
+        print(warning)
+
+    failover_args = {}
+    failover_args.update(failover)
+    failover_args.update(kwargs)
+    dtypes, string_sizes = _scan_chunks(handler(path, chunksize=chunksize, **failover_args))
+    return write_chunks(read_chunks(path, failover_args, dtypes), string_sizes)
+
+def _common_dtype(dtype1, dtype2):
+    """
+    Returns a dtype that can hold the values of both dtypes.
+    """
+    if dtype1 == dtype2:
+        return dtype1
+    if dtype1.kind in 'iuf' and dtype2.kind in 'iuf':
+        return np.result_type(dtype1, dtype2)
+    return np.dtype(object)
+
+def _scan_chunks(chunks):
+    """
+    Reads through the chunks of a table, and returns the dtypes that fit all
+    of them, and the length (in UTF-8 bytes) of the longest string in each
+    string column.
+    """
+    dtypes = {}
+    string_sizes = {}
+    for chunk in chunks:
+        for column, dtype in chunk.dtypes.items():
+            dtypes[column] = _common_dtype(dtypes.get(column, dtype), dtype)
+            if dtype == object:
+                values = chunk[column].dropna()
+                if len(values):
+                    size = int(values.astype(str).str.encode('utf-8').str.len().max())
+                    string_sizes[column] = max(string_sizes.get(column, 0), size)
+    return dtypes, string_sizes
+
+def _convert_table_worker(store_cls, username, package, name, ext, path, target, chunksize,
+                          shard_rows, shard_size, content_defined, known_shards):
+    """
+    Runs `_convert_table` in a worker process.
+    """
+    store = store_cls(username, package, 'w')
+    hashes, metadata, keys, content_hash = _convert_table(store, name, ext, path, target,
+                                                          chunksize, shard_rows, shard_size,
+                                                          False, content_defined, known_shards)
+    return hashes, _add_trees(metadata, store.written_trees(hashes)), keys, content_hash
+
+def _add_trees(metadata, trees):
+    """
+    Returns a copy of a table's metadata with the given tree hashes (see
+    `PackageStore.written_trees`) added to it.
+    """
+    if not trees:
+        return metadata
+    metadata = dict(metadata)
+    metadata['q_tree_hashes'] = dict(metadata.get('q_tree_hashes', {}), **trees)
+    return metadata
+
+def _build_tables(build_dir, store, username, package, tables, jobs, chunksize,
+                  shard_rows=None, shard_size=None, content_defined=False):
+    specs = _table_specs(build_dir, '', tables)
+    cache = BuildCache(store, chunksize, shard_rows, shard_size, content_defined)
+    known_shards = cache.shards()
+    # Reused shards aren't read again, so their tree hashes come from the cache.
+    known_trees = cache.trees()
+
+    # Each table is either reused from the cache (hashes and metadata), built
+    # in a worker process (a Future), or built right here, later (None).
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    results = []
+    try:
+        for name, ext, path, target in specs:
+            result = cache.lookup(path, ext, target)
+            if result is None and executor is not None:
+                result = executor.submit(_convert_table_worker, type(store), username, package,
+                                         name, ext, path, target, chunksize,
+                                         shard_rows, shard_size, content_defined, known_shards)
+            results.append(result)
+
+        # Report the tables (and add them to the contents) in the order of the build file.
+        for (name, ext, path, target), result in zip(specs, results):
+            if isinstance(result, tuple):
+                hashes, metadata = result
+                print("Reusing %s (unchanged)" % path)
+            else:
+                if result is None:
+                    print("Reading %s..." % path)
+                    hashes, metadata, keys, content_hash = _convert_table(
+                        store, name, ext, path, target, chunksize, shard_rows, shard_size,
+                        content_defined=content_defined, known_shards=known_shards)
+                    metadata = _add_trees(metadata, store.written_trees(hashes))
+                else:
+                    hashes, metadata, keys, content_hash = result.result()
+                    print("Built %s from %s" % (name.lstrip('/'), path))
+                metadata = _add_trees(metadata, {objhash: known_trees[objhash]
+                                                 for objhash in hashes if objhash in known_trees})
+                cache.add(path, ext, target, hashes, metadata, keys, content_hash)
+            store.add_table(name, hashes, path, ext, target, metadata)
+    finally:
+        if executor is not None:
+            for result in results:
+                if isinstance(result, Future):
+                    result.cancel()
+            executor.shutdown()
+        # Even after a failure, the tables built so far can be reused next time.
+        cache.save()
+
+def _ingest_logic(ext, target):
+    """
+    Returns the pandas function that reads a file type, its arguments,
+    and the arguments to use if it fails to parse the file.
+    """
     ext = ext.lower() #ensure that case doesn't matter
     platform = TARGET.get(target)
     if platform is None:
@@ -70,12 +559,22 @@ def _file_to_data_frame(ext, path, target):
     handler = getattr(pd, fname, None)
     if handler is None:
         raise BuildException("Invalid ingest function: %r" % fname)
+    return handler, kwargs, failover
+
+def _file_to_data_frame(ext, path, target, progress=True):
+    """
+    Parses a file into a DataFrame. Returns the DataFrame, and the hash of
+    the file if the parser read it from start to end (or None).
+    """
+    handler, kwargs, failover = _ingest_logic(ext, target)
 
     df = None
+    content_hash = None
     try_again = False
     try:
-        with FileWithReadProgress(path) as fd:
+        with HashingReader(FileWithReadProgress(path) if progress else open(path, 'rb')) as fd:
             df = handler(fd, **kwargs)
+        content_hash = fd.hexdigest(path)
     except UnicodeDecodeError as error:
         if failover:
             warning = "Warning: failed fast parse on input %s.\n" % path
@@ -91,12 +590,20 @@ def _file_to_data_frame(ext, path, target):
         failover_args.update(kwargs)
         df = handler(path, **failover_args)
 
-    return df
+    return df, content_hash
 
-def build_package(username, package, yaml_path):
+def build_package(username, package, yaml_path, jobs=1, chunksize=None, shard_rows=None,
+                  shard_size=None, ingest_mode=None, content_defined=False):
     """
     Builds a package from a given Yaml file and installs it locally.
 
+    Tables are converted by `jobs` worker processes. If `chunksize` is given,
+    delimited files are streamed into the store `chunksize` rows at a time.
+    If `shard_rows` or `shard_size` is given, tables are split into shards
+    of that many rows or bytes; with `content_defined`, that's the average,
+    and the boundaries depend on the rows (see `_split_content_defined`).
+    Raw files are added using `ingest_mode` (see `PackageStore.ingest_file`).
+
     Returns the name of the package.
     """
     build_dir = os.path.dirname(yaml_path)
@@ -112,12 +619,20 @@ def build_package(username, package, yaml_path):
     readme = files.get('README') if files else None
     if not isinstance(tables, dict):
         raise BuildException("'tables' must be a dictionary")
-
+    if shard_rows is not None and shard_size is not None:
+        raise BuildException("Shard by either rows or size, not both")
+    if (shard_rows is not None and shard_rows < 1) or (shard_size is not None and shard_size < 1):
+        raise BuildException("Shard rows and size must be positive")
+    if content_defined and shard_rows is None and shard_size is None:
+        raise BuildException("Content-defined sharding needs shard rows or size")
+
+    # The contents are built in memory, and saved once the whole build succeeds.
     with get_store(username, package, pkgformat, 'w') as store:
         store.clear_contents()
-        _build_table(build_dir, store, '', tables)
+        _build_tables(build_dir, store, username, package, tables, jobs, chunksize,
+                      shard_rows, shard_size, content_defined)
         if readme is not None:
-            _build_file(build_dir, store, 'README', rel_path=readme)
+            _build_file(build_dir, store, 'README', rel_path=readme, ingest_mode=ingest_mode)
 
 def splitext_no_dot(filename):
     """
@@ -128,11 +643,17 @@ def splitext_no_dot(filename):
     ext.strip('.')
     return name, ext.strip('.')
 
-def generate_build_file(startpath, outfilename='build.yml'):
+def generate_build_file(startpath, outfilename='build.yml', jobs=None):
     """
     Generate a build file (yaml) based on the contents of a
     directory tree.
+
+    The README and the table sources that can't be hashed while they're
+    parsed (e.g., Excel files) are also hashed by `jobs` threads, into the
+    hash cache (if it's enabled), so that the build doesn't have to hash
+    them one at a time.
     """
+    prehashpaths = []
     buildfiles = {}
     buildtables = {}
 
@@ -179,6 +700,9 @@ def generate_build_file(startpath, outfilename='build.yml'):
             # separate files into tables and raw
             if ext.lower() in TARGET['pandas']:
                 tablefiles.append(file)
+                # Delimited files are hashed as they're read.
+                if TARGET['pandas'][ext.lower()]['attr'] != 'read_csv':
+                    prehashpaths.append(os.path.join(root, file))
             else:
                 rawfiles.append(file)
 
@@ -195,6 +719,14 @@ def generate_build_file(startpath, outfilename='build.yml'):
                     contents[key] = contents[node][key]
                 del contents[node]
 
+    if hash_cache() is not None:
+        # Other raw files aren't read by build_package.
+        readme = buildfiles.get('README')
+        if isinstance(readme, str):
+            prehashpaths.append(os.path.join(startpath, readme))
+        # Hashes of files that were just modified wouldn't be cached.
+        digest_files([path for path in prehashpaths if HashCache.cacheable(os.stat(path))], jobs)
+
     contents = dict(files=buildfiles, tables=buildtables)
     buildfilepath = os.path.join(startpath, outfilename)
     with open(buildfilepath, 'w') as outfile:
@@ -0,0 +1,262 @@
+"""
+Caches of objects: compressed objects uploaded by push (on disk), and
+DataFrames read from the store (in memory).
+"""
+from collections import OrderedDict
+import os
+import tempfile
+import threading
+import weakref
+
+from .util import BASE_DIR
+
+UPLOAD_CACHE_DIR = os.path.join(BASE_DIR, 'upload_cache')
+DEFAULT_UPLOAD_CACHE_SIZE = 5 * 1024 * 1024 * 1024
+DEFAULT_DATAFRAME_CACHE_SIZE = 1024 * 1024 * 1024
+TEMP_EXT = '.tmp'
+
+
+class UploadCache(object):
+    """
+    LRU cache of compressed objects, keyed by the object hash and the codec.
+
+    Objects are content-addressed, so entries never go stale; the least
+    recently used ones are evicted once the cache grows over `max_size`
+    bytes (default: $QUILT_UPLOAD_CACHE_SIZE, or 5GB). A size of 0 disables
+    the cache.
+    """
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = UPLOAD_CACHE_DIR
+        if max_size is None:
+            max_size = int(os.environ.get('QUILT_UPLOAD_CACHE_SIZE', DEFAULT_UPLOAD_CACHE_SIZE))
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def _entry_path(self, objhash, codec_name):
+        return os.path.join(self._path, '%s.%s' % (objhash, codec_name))
+
+    def open(self, objhash, codec_name):
+        """
+        Returns an open file with the cached compressed object, or None
+        if it's not in the cache.
+        """
+        path = self._entry_path(objhash, codec_name)
+        with self._lock:
+            try:
+                fd = open(path, 'rb')
+            except IOError:
+                return None
+            # Mark it as recently used.
+            os.utime(path, None)
+        return fd
+
+    def fits(self, size):
+        """
+        Returns True if an object of `size` (uncompressed) bytes gets cached
+        by `add`.
+        """
+        return bool(self._max_size) and size <= self._max_size
+
+    def add(self, objhash, codec_name, chunks, size):
+        """
+        Generator that passes `chunks` through, while saving them into the
+        cache. The entry is only added once all of the chunks are consumed.
+
+        `size` is the uncompressed size; objects bigger than the whole cache
+        are not cached.
+        """
+        if not self.fits(size):
+            for chunk in chunks:
+                yield chunk
+            return
+
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+        handle, temp_path = tempfile.mkstemp(dir=self._path, suffix=TEMP_EXT)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+                    yield chunk
+        except:
+            # Including GeneratorExit, if the upload was aborted.
+            os.remove(temp_path)
+            raise
+
+        with self._lock:
+            os.rename(temp_path, self._entry_path(objhash, codec_name))
+            self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its size.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self._path):
+            if name.endswith(TEMP_EXT):
+                continue
+            stat = os.stat(os.path.join(self._path, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total_size <= self._max_size:
+                break
+            os.remove(os.path.join(self._path, name))
+            total_size -= size
+
+
+class DataFrameCache(object):
+    """
+    In-memory LRU cache of DataFrames, keyed by the hashes of the objects
+    they were read from.
+
+    Objects are content-addressed, so entries never go stale; the least
+    recently used ones are evicted once the DataFrames take up more than
+    `max_size` bytes (default: $QUILT_DATAFRAME_CACHE_SIZE, or 1GB). A size
+    of 0 disables the cache.
+
+    Callers get a copy of the cached DataFrame, so modifying it doesn't
+    affect the cache. Those copies (and the DataFrames passed to `add`) count
+    against the budget too, for as long as they're in use - i.e., until
+    they're garbage collected - so entries are evicted to make room for
+    them. Tables that don't fit in the cache alongside a copy of themselves
+    are not cached.
+    """
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = int(os.environ.get('QUILT_DATAFRAME_CACHE_SIZE',
+                                          DEFAULT_DATAFRAME_CACHE_SIZE))
+        self._max_size = max_size
+        self._entries = OrderedDict()  # key -> (DataFrame, size), oldest first
+        self._size = 0
+        self._loaned = 0  # Size of the copies still in use.
+        self._loans = {}  # id(weakref) -> (weakref, size) of the copies in use.
+        # Reentrant, since copies can be garbage collected while it's held.
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        """
+        The memory budget, in bytes.
+        """
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        with self._lock:
+            self._max_size = value
+            self._evict()
+
+    def get(self, key):
+        """
+        Returns a copy of the cached DataFrame, or None if it's not cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # Mark it as recently used.
+            self._entries[key] = entry
+            self.hits += 1
+        df, size = entry
+        df = df.copy()
+        with self._lock:
+            self._lend(df, size)
+            self._evict()
+        return df
+
+    def add(self, key, df):
+        """
+        Adds a DataFrame to the cache, unless it doesn't fit in it: `df`
+        itself counts as a copy in use, so tables bigger than half of the
+        cache (minus the copies already in use) are not cached.
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if 2 * size + self._loaned > self._max_size:
+                return
+        cached = df.copy()
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._entries[key] = (cached, size)
+            self._size += size
+            self._lend(df, size)
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all of the entries, and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the hit, miss and eviction counts, the
+        number and total size of the cached DataFrames, and the size of the
+        copies still in use (`loaned`).
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                size=self._size,
+                loaned=self._loaned,
+                max_size=self._max_size
+            )
+
+    def _lend(self, df, size):
+        """
+        Counts a DataFrame given to a caller against the budget, until it's
+        garbage collected.
+        """
+        # Not weakref.finalize, which Python 2.7 doesn't have; the weakref
+        # itself has to be kept alive for its callback to run.
+        ref = weakref.ref(df, self._release)
+        self._loans[id(ref)] = (ref, size)
+        self._loaned += size
+
+    def _release(self, ref):
+        with self._lock:
+            _, size = self._loans.pop(id(ref))
+            self._loaned -= size
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until they, and the copies
+        still in use, fit in the cache's size.
+        """
+        while self._size + self._loaned > self._max_size and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+
+_dataframe_cache = None
+_dataframe_cache_lock = threading.Lock()
+
+def dataframe_cache():
+    """
+    Returns the process-wide DataFrameCache.
+    """
+    global _dataframe_cache
+    with _dataframe_cache_lock:
+        if _dataframe_cache is None:
+            _dataframe_cache = DataFrameCache()
+        return _dataframe_cache
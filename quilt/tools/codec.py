@@ -0,0 +1,356 @@
+"""
+Transfer codecs: how objects are compressed by push and decompressed by install.
+
+A codec's name is used as the HTTP `Content-Encoding` of the object.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+ZLIB_LEVEL = 2  # Maximum level.
+ZLIB_METHOD = zlib.DEFLATED  # The only supported one.
+ZLIB_WBITS = zlib.MAX_WBITS | 16  # Add a gzip header and checksum.
+# Size of the independently compressed gzip members, with `parallel_gzip_enabled()`.
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+ZSTD_LEVEL = 3
+
+# Magic numbers of formats that are already compressed, and don't benefit
+# from another round of compression.
+COMPRESSED_MAGIC = [
+    b'PAR1',  # Parquet
+    b'\x1f\x8b',  # gzip
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'\x04\x22\x4d\x18',  # lz4 frame
+    b'BZh',  # bzip2
+    b'\xfd7zXZ\x00',  # xz
+    b'PK\x03\x04',  # zip (and xlsx, docx, etc.)
+    b'\x89PNG',
+    b'\xff\xd8\xff',  # JPEG
+]
+MAGIC_SIZE = max(len(magic) for magic in COMPRESSED_MAGIC)
+
+DEFAULT_CODEC = 'gzip'
+# Codecs that every client can decode, including older versions of quilt
+# (which let requests decode objects). Objects are stored in the registry the
+# way they're pushed, so packages pushed with other codecs can only be
+# installed by clients that have them.
+COMPATIBLE_CODECS = ['deflate', 'gzip', 'identity']
+# Other names of codecs, in Content-Encoding headers.
+CODEC_ALIASES = {'x-gzip': 'gzip'}
+
+
+class CodecException(Exception):
+    """
+    Exception class for unknown or unavailable codecs
+    """
+    pass
+
+
+class _IdentityDecompressor(object):
+    """
+    Passes data through unchanged.
+    """
+    @staticmethod
+    def decompress(data):
+        """
+        Returns the data as is.
+        """
+        return data
+
+    @staticmethod
+    def flush():
+        """
+        Returns nothing.
+        """
+        return b''
+
+
+class _GzipDecompressor(object):
+    """
+    Decompresses a gzip stream that may consist of several members.
+    """
+    def __init__(self):
+        self._zlib_obj = zlib.decompressobj(ZLIB_WBITS)
+
+    def decompress(self, data):
+        """
+        Decompresses a chunk of data.
+        """
+        output = []
+        while data:
+            output.append(self._zlib_obj.decompress(data))
+            data = self._zlib_obj.unused_data
+            if data:
+                # The previous member ended; the rest is a new one.
+                self._zlib_obj = zlib.decompressobj(ZLIB_WBITS)
+        return b''.join(output)
+
+    def flush(self):
+        """
+        Returns any remaining decompressed data.
+        """
+        return self._zlib_obj.flush()
+
+
+class _DeflateDecompressor(object):
+    """
+    Decompresses HTTP `deflate` data: a zlib stream, or - from some
+    servers - raw deflate data without the zlib header.
+    """
+    def __init__(self):
+        self._zlib_obj = None
+
+    def decompress(self, data):
+        """
+        Decompresses a chunk of data.
+        """
+        if self._zlib_obj is None:
+            self._zlib_obj = zlib.decompressobj()
+            try:
+                return self._zlib_obj.decompress(data)
+            except zlib.error:
+                self._zlib_obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._zlib_obj.decompress(data)
+
+    def flush(self):
+        """
+        Returns any remaining decompressed data.
+        """
+        return self._zlib_obj.flush() if self._zlib_obj is not None else b''
+
+
+class _Lz4Decompressor(object):
+    """
+    Wraps LZ4FrameDecompressor to give it a `flush` method.
+    """
+    def __init__(self):
+        self._lz4_obj = lz4_frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        """
+        Decompresses a chunk of data.
+        """
+        return self._lz4_obj.decompress(data)
+
+    @staticmethod
+    def flush():
+        """
+        Returns nothing; LZ4FrameDecompressor doesn't buffer output.
+        """
+        return b''
+
+
+def _read_chunks(input_file, chunk_size):
+    return iter(lambda: input_file.read(chunk_size), b'')
+
+
+def _gzip_member(data):
+    zlib_obj = zlib.compressobj(ZLIB_LEVEL, ZLIB_METHOD, ZLIB_WBITS)
+    return zlib_obj.compress(data) + zlib_obj.flush()
+
+
+class Codec(object):
+    """
+    Base class for transfer codecs.
+    """
+    name = None
+    module = True  # The optional module the codec depends on, or None if not installed.
+    module_name = None
+
+    def __init__(self, threads=1):
+        self._threads = threads
+
+    @property
+    def cache_name(self):
+        """
+        Name of the codec's output in the UploadCache.
+        """
+        return self.name
+
+    def compress(self, input_file, chunk_size):
+        """
+        Generator that reads `input_file` and yields compressed chunks.
+        """
+        raise NotImplementedError()
+
+    def decompressor(self):
+        """
+        Returns an object with `decompress(data)` and `flush()` methods.
+        """
+        raise NotImplementedError()
+
+
+class IdentityCodec(Codec):
+    """
+    No compression.
+    """
+    name = 'identity'
+
+    def compress(self, input_file, chunk_size):
+        return _read_chunks(input_file, chunk_size)
+
+    def decompressor(self):
+        return _IdentityDecompressor()
+
+
+def parallel_gzip_enabled():
+    """
+    Returns True if gzip uses several threads; set $QUILT_PARALLEL_GZIP to a
+    non-zero value to turn it on.
+
+    The output is then several gzip members, which some readers stop after
+    the first of - e.g., urllib3 before 1.24, which older installs of quilt
+    may still use - so it's only for registries whose clients can read it.
+    """
+    return os.environ.get('QUILT_PARALLEL_GZIP', '0') not in ('', '0')
+
+
+class GzipCodec(Codec):
+    """
+    gzip. With several threads and `parallel_gzip_enabled()`, the input is
+    split into blocks that are compressed in parallel into separate gzip
+    members, whose concatenation decompresses into the original data.
+    """
+    name = 'gzip'
+
+    def _parallel(self):
+        return self._threads > 1 and parallel_gzip_enabled()
+
+    @property
+    def cache_name(self):
+        return 'gzip-members' if self._parallel() else self.name
+
+    def compress(self, input_file, chunk_size):
+        if not self._parallel():
+            zlib_obj = zlib.compressobj(ZLIB_LEVEL, ZLIB_METHOD, ZLIB_WBITS)
+            for chunk in _read_chunks(input_file, chunk_size):
+                data = zlib_obj.compress(chunk)
+                if data:
+                    yield data
+            yield zlib_obj.flush()
+            return
+
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            # Keep a bounded number of blocks in flight.
+            pending = deque()
+            empty = True
+            for block in _read_chunks(input_file, GZIP_BLOCK_SIZE):
+                empty = False
+                pending.append(executor.submit(_gzip_member, block))
+                if len(pending) > self._threads * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+            if empty:
+                yield _gzip_member(b'')
+
+    def decompressor(self):
+        return _GzipDecompressor()
+
+
+class DeflateCodec(Codec):
+    """
+    HTTP `deflate`, i.e., zlib; single-threaded.
+    """
+    name = 'deflate'
+
+    def compress(self, input_file, chunk_size):
+        zlib_obj = zlib.compressobj(ZLIB_LEVEL)
+        for chunk in _read_chunks(input_file, chunk_size):
+            data = zlib_obj.compress(chunk)
+            if data:
+                yield data
+        yield zlib_obj.flush()
+
+    def decompressor(self):
+        return _DeflateDecompressor()
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard; uses its built-in multi-threaded compression.
+    """
+    name = 'zstd'
+    module = zstandard
+    module_name = 'zstandard'
+
+    def compress(self, input_file, chunk_size):
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=self._threads)
+        zstd_obj = compressor.compressobj()
+        for chunk in _read_chunks(input_file, chunk_size):
+            data = zstd_obj.compress(chunk)
+            if data:
+                yield data
+        yield zstd_obj.flush()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec(Codec):
+    """
+    LZ4 frame format; very fast, but compresses less than gzip or zstd.
+    """
+    name = 'lz4'
+    module = lz4_frame
+    module_name = 'lz4'
+
+    def compress(self, input_file, chunk_size):
+        lz4_obj = lz4_frame.LZ4FrameCompressor()
+        yield lz4_obj.begin()
+        for chunk in _read_chunks(input_file, chunk_size):
+            data = lz4_obj.compress(chunk)
+            if data:
+                yield data
+        yield lz4_obj.flush()
+
+    def decompressor(self):
+        return _Lz4Decompressor()
+
+
+CODECS = {codec_cls.name: codec_cls
+          for codec_cls in [IdentityCodec, DeflateCodec, GzipCodec, ZstdCodec, Lz4Codec]}
+
+
+def get_codec(name, threads=None):
+    """
+    Returns a codec given its name (i.e., the Content-Encoding).
+
+    `threads` defaults to the number of CPUs.
+    """
+    name = CODEC_ALIASES.get(name.lower(), name.lower())
+    codec_cls = CODECS.get(name)
+    if codec_cls is None:
+        raise CodecException("Unsupported codec: %r" % name)
+    if codec_cls.module is None:
+        raise CodecException("Module {mod} is required for the {name} codec.".format(
+            mod=codec_cls.module_name, name=name))
+    return codec_cls(threads or cpu_count())
+
+
+def available_codecs():
+    """
+    Returns the names of all the codecs that can be used.
+    """
+    return sorted(name for name, codec_cls in CODECS.items() if codec_cls.module is not None)
+
+
+def is_compressed(path):
+    """
+    Returns True if the file is in a format that's already compressed.
+    """
+    with open(path, 'rb') as fd:
+        magic = fd.read(MAGIC_SIZE)
+    return any(magic.startswith(prefix) for prefix in COMPRESSED_MAGIC)
@@ -6,6 +6,8 @@ Command line parsing and command dispatch
 from __future__ import print_function
 from builtins import input
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
 import json
 import os
 import stat
@@ -16,12 +18,17 @@ import webbrowser
 import pandas as pd
 import requests
 from packaging.version import Version
+from tqdm import tqdm
 
 from .build import build_package, generate_build_file, BuildException
-from .const import LATEST_TAG
+from .cache import UploadCache
+from .codec import (get_codec, CodecException, IdentityCodec, CODECS, COMPATIBLE_CODECS,
+                    DEFAULT_CODEC)
+from .const import IngestMode, LATEST_TAG, TRANSFER_JOBS
 from .core import hash_contents, GroupNode, TableNode, FileNode, decode_node, encode_node
+from .hashing import hash_cache
 from .store import PackageStore, StoreException, get_store, ls_packages
-from .util import BASE_DIR
+from .util import BASE_DIR, transfer_session
 
 HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
 
@@ -29,6 +36,9 @@ QUILT_PKG_URL = os.environ.get('QUILT_PKG_URL', 'https://pkg.quiltdata.com')
 
 AUTH_FILE_NAME = "auth.json"
 
+UPLOAD_ATTEMPTS = 5
+UPLOAD_BACKOFF = 1  # Seconds; doubles after each failed attempt.
+
 
 class CommandException(Exception):
     """
@@ -166,10 +176,23 @@ def logout():
     else:
         print("Already logged out.")
 
-def build(package, path, directory=None):
+def build(package, path, directory=None, jobs=1, chunksize=None, shard_rows=None,
+          shard_size=None, ingest=None, content_defined=False):
     """
     Compile a Quilt data package
+
+    `jobs` tables are converted in parallel. With `chunksize`, delimited
+    files are streamed in chunks of that many rows instead of being loaded
+    into memory all at once. With `shard_rows` or `shard_size`, tables are
+    split into several objects of that many rows or bytes; with
+    `content_defined`, that many on average, split where the rows' contents
+    say so, so that unchanged rows end up in the same objects across
+    versions. `ingest` is how raw files are added to the object store (an
+    IngestMode value).
     """
+    if jobs < 1:
+        raise CommandException("Number of jobs must be at least 1.")
+
     owner, pkg = _parse_package(package)
     if directory:
         buildfilepath = generate_build_file(directory)
@@ -178,7 +201,8 @@ def build(package, path, directory=None):
         buildpath = path
 
     try:
-        build_package(owner, pkg, buildpath)
+        build_package(owner, pkg, buildpath, jobs, chunksize, shard_rows, shard_size, ingest,
+                      content_defined)
         print("Built %s/%s successfully." % (owner, pkg))
     except BuildException as ex:
         raise CommandException("Failed to build the package: %s" % ex)
@@ -204,10 +228,64 @@ def log(session, package):
         # TODO: convert "created" to local time.
         print(format_str % (entry['hash'], entry['created'], entry['author']))
 
-def push(session, package):
+def _upload_object(session, store, objhash, url, codec, cache):
+    """
+    Compresses and uploads one object, retrying with exponential backoff
+    on connection errors and server-side failures.
+    """
+    with store.upload_stream(objhash, codec, cache) as body:
+        headers = {}
+        if not isinstance(body.codec, IdentityCodec):
+            headers['Content-Encoding'] = body.codec.name
+        backoff = UPLOAD_BACKOFF
+        for attempt in range(UPLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff)
+                backoff *= 2
+                body.rewind()
+            try:
+                # The body has a length, so it's not sent with chunked encoding.
+                response = session.put(url, data=body, headers=headers)
+            except requests.exceptions.RequestException as ex:
+                error = str(ex)
+                continue
+
+            if response.ok:
+                return
+            error = "error %s" % response.status_code
+            if ((response.status_code < 500 and response.status_code not in (408, 429)) or
+                    response.status_code == 501):
+                # Retrying won't help; 501 is, e.g., S3 rejecting chunked encoding.
+                break
+
+    raise CommandException("Upload of {hash} failed: {error}".format(hash=objhash, error=error))
+
+def push(session, package, jobs=TRANSFER_JOBS, codec=None):
     """
     Push a Quilt data package to the server
+
+    `jobs` objects are compressed and uploaded in parallel, so compressing
+    one object overlaps with uploading the others. `codec` is the transfer
+    codec used for objects that aren't already compressed; it defaults to
+    $QUILT_TRANSFER_CODEC, or gzip. Objects are stored in the registry with
+    the codec they're pushed with, so with codecs other than gzip (or
+    deflate, or identity), packages can only be installed by clients that
+    have the codec - not by older versions of quilt.
     """
+    if jobs < 1:
+        raise CommandException("Number of jobs must be at least 1.")
+
+    try:
+        # Split the CPUs between the upload threads.
+        codec_obj = get_codec(codec or os.environ.get('QUILT_TRANSFER_CODEC', DEFAULT_CODEC),
+                              threads=max(1, cpu_count() // jobs))
+    except CodecException as ex:
+        raise CommandException(str(ex))
+    if codec_obj.name not in COMPATIBLE_CODECS:
+        warning = ("Warning: the package will only install on clients that support the "
+                   "{name} codec; older versions of quilt can't install it.")
+        print(warning.format(name=codec_obj.name))
+
     owner, pkg = _parse_package(package)
 
     store = get_store(owner, pkg)
@@ -231,17 +309,24 @@ def push(session, package):
     dataset = response.json()
     upload_urls = dataset['upload_urls']
 
-    headers = {
-        'Content-Encoding': 'gzip'
-    }
-
-    for objhash, url in upload_urls.items():
-        # Create a temporary gzip'ed file.
-        with store.tempfile(objhash) as temp_file:
-            response = requests.put(url, data=temp_file, headers=headers)
-
-            if not response.ok:
-                raise CommandException("Upload failed: error %s" % response.status_code)
+    # Reuse objects compressed by earlier (e.g., interrupted) pushes.
+    cache = UploadCache()
+    # Objects with tree hashes are sent as is, so that `install --repair` can
+    # fetch their damaged chunks by byte range.
+    tree_hashes = store.tree_hashes()
+    with transfer_session(jobs) as upload_session, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_upload_object, upload_session, store, objhash, url,
+                                   IdentityCodec() if objhash in tree_hashes else codec_obj,
+                                   cache)
+                   for objhash, url in upload_urls.items()]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            raise
 
     # Set the "latest" tag.
     response = session.put(
@@ -363,13 +448,23 @@ def tag_remove(session, package, tag):
         )
     )
 
-def install(session, package, hash=None, version=None, tag=None):
+def install(session, package, hash=None, version=None, tag=None, jobs=TRANSFER_JOBS,
+            repair=False):
     """
     Download a Quilt data package from the server and install locally.
 
     At most one of `hash`, `version`, or `tag` can be given. If none are
     given, `tag` defaults to "latest".
+
+    `jobs` is the number of objects downloaded in parallel. With `repair`,
+    an installed package is verified and its damaged objects are fixed.
+    Objects with tree hashes are fixed by fetching only their damaged
+    chunks, if the registry serves them uncompressed (as `push` uploads
+    them); the others are downloaded again.
     """
+    if jobs < 1:
+        raise CommandException("Number of jobs must be at least 1.")
+
     if hash is version is tag is None:
         tag = LATEST_TAG
 
@@ -378,7 +473,7 @@ def install(session, package, hash=None, version=None, tag=None):
     owner, pkg = _parse_package(package)
     store = get_store(owner, pkg, mode='w')
 
-    if store.exists():
+    if store.exists() and not repair:
         print("{owner}/{pkg} already installed.".format(owner=owner, pkg=pkg))
         overwrite = input("Overwrite? (y/n) ")
         if overwrite.lower() != 'y':
@@ -427,11 +522,19 @@ def install(session, package, hash=None, version=None, tag=None):
         raise CommandException("Mismatched hash. Try again.")
 
     try:
-        store.install(response_contents, response_urls)
+        downloaded, skipped, skipped_bytes, repaired = store.install(
+            response_contents, response_urls, jobs, repair)
     except StoreException as ex:
         store.clear_contents()
         raise CommandException("Failed to install the package: %s" % ex)
 
+    print("Downloaded %d objects." % downloaded)
+    if repaired:
+        print("Repaired %d damaged objects." % repaired)
+    if skipped:
+        print("Skipped %d objects already installed (%s saved)." %
+              (skipped, tqdm.format_sizeof(skipped_bytes, 'B')))
+
 def access_list(session, package):
     """
     Print list of users who can access a package.
@@ -473,6 +576,61 @@ def ls():
             prefix = u"└── " if idx == len(packages) - 1 else u"├── "
             print("%s%s/%s" % (prefix, owner, pkg))
 
+def migrate():
+    """
+    Move the objects of all package directories to the fan-out layout
+    """
+    for pkg_dir in PackageStore.find_package_dirs():
+        moved = PackageStore.migrate_objects(pkg_dir)
+        print("%s: moved %d object(s)" % (pkg_dir, moved))
+
+def hash_cache_revalidate():
+    """
+    Re-hash the files in the local hash cache, and fix or drop stale entries
+    """
+    cache = hash_cache()
+    if cache is None:
+        raise CommandException("The hash cache is disabled.")
+    checked, removed, corrected = cache.revalidate()
+    print("Checked %d file(s): removed %d stale entries, corrected %d hash(es)." %
+          (checked, removed, corrected))
+
+def hash_cache_clear():
+    """
+    Empty the local hash cache
+    """
+    cache = hash_cache()
+    if cache is None:
+        raise CommandException("The hash cache is disabled.")
+    cache.clear()
+
+def verify(package, jobs=None):
+    """
+    Re-hash the objects of an installed package, and check them against
+    their names
+    """
+    owner, pkg = _parse_package(package)
+    store = get_store(owner, pkg)
+    if not store.exists():
+        raise CommandException("Package {owner}/{pkg} not found.".format(owner=owner, pkg=pkg))
+    if jobs is not None and jobs < 1:
+        raise CommandException("Number of jobs must be at least 1.")
+
+    missing, corrupt = store.verify_objects(jobs)
+    for objhash in missing:
+        print("Missing: %s" % objhash)
+    for objhash, chunks in sorted(corrupt.items()):
+        if chunks is None:
+            print("Corrupt: %s" % objhash)
+        else:
+            print("Corrupt: %s (chunks %s)" % (objhash, ", ".join(str(idx) for idx in chunks)))
+    if missing or corrupt:
+        raise CommandException("Package {owner}/{pkg} has {missing} missing and {corrupt} "
+                               "corrupt object(s).".format(owner=owner, pkg=pkg,
+                                                           missing=len(missing),
+                                                           corrupt=len(corrupt)))
+    print("All objects of {owner}/{pkg} are intact.".format(owner=owner, pkg=pkg))
+
 def inspect(package):
     """
     Inspect package details
@@ -521,6 +679,8 @@ def main():
     """
     parser = argparse.ArgumentParser(description="Quilt Command Line")
     parser.set_defaults(need_session=True)
+    parser.add_argument("--no-hash-cache", action='store_true',
+                        help="Hash every file from scratch, ignoring the local hash cache")
     subparsers = parser.add_subparsers(title="Commands", dest='cmd')
     subparsers.required = True
 
@@ -539,14 +699,33 @@ def main():
     buildpath_group = build_p.add_mutually_exclusive_group(required=True)
     buildpath_group.add_argument("-d", "--directory", type=str, help="Source file directory")
     buildpath_group.add_argument("path", type=str, nargs='?', help="Path to the Yaml build file")
+    build_p.add_argument("-j", "--jobs", type=int, default=1,
+                         help="Number of tables to convert in parallel")
+    build_p.add_argument("--chunksize", type=int,
+                         help="Stream CSV/TSV files into the package this many rows at a time")
+    shard_group = build_p.add_mutually_exclusive_group()
+    shard_group.add_argument("--shard-rows", type=int,
+                             help="Split tables into objects of this many rows")
+    shard_group.add_argument("--shard-size", type=int,
+                             help="Split tables into objects of about this many bytes (in memory)")
+    build_p.add_argument("--content-defined", action="store_true",
+                         help="Pick shard boundaries by the rows' contents, so that inserting "
+                         "or deleting rows only changes the shards around them")
+    build_p.add_argument("--ingest", type=str, choices=[mode.value for mode in IngestMode],
+                         help="How to add raw files: copy-on-write clone (if possible) or copy " +
+                         "(auto, the default), copy, reflink, or hardlink (the source files " +
+                         "must not be modified afterwards)")
     build_p.set_defaults(func=build, need_session=False)
 
     push_p = subparsers.add_parser("push")
     push_p.add_argument("package", type=str, help="Owner/Package Name")
-    push_p.set_defaults(func=push)
-
-    push_p = subparsers.add_parser("push")
-    push_p.add_argument("package", type=str, help="Owner/Package Name")
+    push_p.add_argument("-j", "--jobs", type=int, default=TRANSFER_JOBS,
+                        help="Number of parallel uploads")
+    push_p.add_argument("-c", "--codec", type=str, choices=sorted(CODECS),
+                        help="Transfer compression - defaults to 'gzip'. Objects are " +
+                        "stored compressed this way, so packages pushed with other codecs " +
+                        "than gzip, deflate or identity only install on clients that support " +
+                        "them (not on older versions of quilt)")
     push_p.set_defaults(func=push)
 
     version_p = subparsers.add_parser("version")
@@ -589,6 +768,12 @@ def main():
     install_group.add_argument("-x", "--hash", type=str, help="Package hash")
     install_group.add_argument("-v", "--version", type=str, help="Package version")
     install_group.add_argument("-t", "--tag", type=str, help="Package tag - defaults to 'latest'")
+    install_p.add_argument("-j", "--jobs", type=int, default=TRANSFER_JOBS,
+                           help="Number of parallel downloads")
+    install_p.add_argument("--repair", action="store_true",
+                           help="Verify an installed package, and fix its damaged objects; " +
+                           "only objects with tree hashes that the registry serves " +
+                           "uncompressed are fixed by chunk, the others are downloaded again")
 
     access_p = subparsers.add_parser("access")
     access_subparsers = access_p.add_subparsers(title="Access", dest='cmd')
@@ -611,6 +796,25 @@ def main():
     ls_p = subparsers.add_parser("ls")
     ls_p.set_defaults(func=ls, need_session=False)
 
+    migrate_p = subparsers.add_parser("migrate")
+    migrate_p.set_defaults(func=migrate, need_session=False)
+
+    hash_cache_p = subparsers.add_parser("hash-cache")
+    hash_cache_subparsers = hash_cache_p.add_subparsers(title="hash-cache", dest='cmd')
+    hash_cache_subparsers.required = True
+
+    hash_cache_revalidate_p = hash_cache_subparsers.add_parser("revalidate")
+    hash_cache_revalidate_p.set_defaults(func=hash_cache_revalidate, need_session=False)
+
+    hash_cache_clear_p = hash_cache_subparsers.add_parser("clear")
+    hash_cache_clear_p.set_defaults(func=hash_cache_clear, need_session=False)
+
+    verify_p = subparsers.add_parser("verify")
+    verify_p.add_argument("package", type=str, help="Owner/Package Name")
+    verify_p.add_argument("-j", "--jobs", type=int,
+                          help="Number of hashing threads (default: number of CPUs)")
+    verify_p.set_defaults(func=verify, need_session=False)
+
     inspect_p = subparsers.add_parser("inspect")
     inspect_p.add_argument("package", type=str, help="Owner/Package Name")
     inspect_p.set_defaults(func=inspect, need_session=False)
@@ -624,6 +828,10 @@ def main():
 
     func = kwargs.pop('func')
 
+    if kwargs.pop('no_hash_cache'):
+        # Also applies to any worker processes.
+        os.environ['QUILT_NO_HASH_CACHE'] = '1'
+
     try:
         # Create a session if needed.
         if kwargs.pop('need_session'):
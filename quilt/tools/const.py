@@ -12,14 +12,29 @@ class PackageFormat(Enum):
     FASTPARQUET = 'FAST_PARQUET'
     ARROW = 'ARROW_PARQUET'
     SPARK = 'SPARK_PARQUET'
+    FEATHER = 'ARROW_FEATHER'
     default = HDF5
 
+class IngestMode(Enum):
+    """
+    How raw files are added to the object store.
+    """
+    AUTO = 'auto'  # A copy-on-write clone if possible, otherwise a copy.
+    COPY = 'copy'
+    REFLINK = 'reflink'
+    # Source and object share their data: editing the source corrupts the object!
+    HARDLINK = 'hardlink'
+    default = AUTO
+
 DATEF = '%F'
 TIMEF = '%T'
 DTIMEF = '%s %s' % (DATEF, TIMEF)
 LATEST_TAG = 'latest'
 PACKAGE_DIR_NAME = 'quilt_packages'
 
+# Default number of objects transferred in parallel by install/push
+TRANSFER_JOBS = 4
+
 # SHA-2 Family
 HASH_TYPE = 'sha256'
 # RSA digital signature key Size
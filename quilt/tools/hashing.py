@@ -1,8 +1,261 @@
+import binascii
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+from multiprocessing import cpu_count
+import os
+import sqlite3
+import threading
+import time
 
 from .const import HASH_TYPE
+from .util import BASE_DIR
 
-def digest_file(fname):
+HASH_CACHE_PATH = os.path.join(BASE_DIR, 'hash_cache.sqlite')
+# Big reads mean fewer calls into hashlib, which releases the GIL for each one.
+HASH_BUFFER_SIZE = 1024 * 1024
+# Files modified more recently than this could be modified again without
+# changing their mtime (given the filesystem's timestamp granularity),
+# so their hashes aren't cached.
+RACY_WINDOW_NS = 2 * 10**9
+# Size of the chunks hashed by `tree_hash`.
+TREE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class HashCache(object):
+    """
+    Persistent cache of file hashes, keyed by (device, inode, size, mtime).
+
+    A hit skips reading the file entirely. Set $QUILT_NO_HASH_CACHE (or
+    pass --no-hash-cache to quilt) to hash every file from scratch.
+    """
+    def __init__(self, path=None):
+        self._path = path or HASH_CACHE_PATH
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections can't be shared across threads or forked processes.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            dirname = os.path.dirname(self._path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                "path TEXT, hash TEXT, PRIMARY KEY (dev, ino))"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _stat_key(stat):
+        mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+        return (stat.st_dev, stat.st_ino, stat.st_size, mtime_ns)
+
+    def lookup(self, path):
+        """
+        Returns the cached hash of a file, or None.
+        """
+        dev, ino, size, mtime_ns = self._stat_key(os.stat(path))
+        try:
+            row = self._connection().execute(
+                "SELECT hash FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                (dev, ino, size, mtime_ns)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row is not None else None
+
+    def add(self, path, filehash, stat):
+        """
+        Caches the hash of a file, given its `os.stat` from before it was hashed.
+        The hash isn't cached if the file has changed since, or might still
+        be changing.
+        """
+        key = self._stat_key(stat)
+        if self._stat_key(os.stat(path)) != key:
+            return
+        if not self.cacheable(stat):
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                             key + (os.path.abspath(path), filehash))
+        except sqlite3.Error:
+            # E.g., a read-only or locked cache; it's only an optimization.
+            pass
+
+    @classmethod
+    def cacheable(cls, stat):
+        """
+        Returns False if a file with the given `os.stat` was modified too
+        recently for its hash to be cached.
+        """
+        return cls._stat_key(stat)[3] <= time.time() * 1e9 - RACY_WINDOW_NS
+
+    def revalidate(self):
+        """
+        Re-hashes every file in the cache. Entries for files that no longer
+        exist, or have changed, are removed; wrong hashes are corrected.
+
+        Returns a tuple of (entries checked, entries removed, hashes corrected).
+        """
+        conn = self._connection()
+        rows = conn.execute("SELECT dev, ino, size, mtime_ns, path, hash FROM hashes").fetchall()
+        removed = corrected = 0
+        for dev, ino, size, mtime_ns, path, filehash in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is None or self._stat_key(stat) != (dev, ino, size, mtime_ns):
+                with conn:
+                    conn.execute("DELETE FROM hashes WHERE dev = ? AND ino = ?", (dev, ino))
+                removed += 1
+                continue
+            actual_hash = _hash_file(path)
+            if actual_hash != filehash:
+                with conn:
+                    conn.execute("UPDATE hashes SET hash = ? WHERE dev = ? AND ino = ?",
+                                 (actual_hash, dev, ino))
+                corrected += 1
+        return len(rows), removed, corrected
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM hashes")
+
+
+_hash_caches = {}
+_hash_caches_lock = threading.Lock()
+
+def hash_cache():
+    """
+    Returns the HashCache, or None if it's disabled.
+    """
+    if os.environ.get('QUILT_NO_HASH_CACHE', '0') not in ('', '0'):
+        return None
+    with _hash_caches_lock:
+        # Keyed by path, so tests (or users) can move it.
+        cache = _hash_caches.get(HASH_CACHE_PATH)
+        if cache is None:
+            cache = _hash_caches[HASH_CACHE_PATH] = HashCache(HASH_CACHE_PATH)
+        return cache
+
+def tree_hashes_enabled():
+    """
+    Returns True if new objects get tree hashes; set $QUILT_TREE_HASHES to a
+    non-zero value to turn them on.
+    """
+    return os.environ.get('QUILT_TREE_HASHES', '0') not in ('', '0')
+
+def digest_file(fname, use_cache=True, tree=None):
+    """
+    Returns the hash of a file, from the HashCache if it's there (and
+    `use_cache` is True).
+
+    If `tree` (a TreeHasher) is given, the file is read even if its hash is
+    cached, and the tree is computed in the same pass.
+
+    See `_hash_file`.
+    """
+    cache = hash_cache() if use_cache else None
+    if cache is None or tree is not None:
+        return _hash_file(fname, tree)
+    filehash = cache.lookup(fname)
+    if filehash is None:
+        stat = os.stat(fname)
+        filehash = _hash_file(fname)
+        cache.add(fname, filehash, stat)
+    return filehash
+
+def digest_files(paths, jobs=None, use_cache=True):
+    """
+    Hashes files in a pool of `jobs` threads (default: the number of CPUs).
+    Returns the list of hashes, in the same order as `paths`.
+    """
+    return _map_threads(lambda path: digest_file(path, use_cache), paths, jobs)
+
+def tree_hash(fname, chunk_size=None, jobs=None):
+    """
+    Hashes a file as a list of fixed-size chunks, in a pool of `jobs`
+    threads (default: the number of CPUs).
+
+    Returns a dictionary with the file's `size`, the `chunk_size`, the
+    hashes of the `chunks` (TREE_CHUNK_SIZE bytes by default), and the
+    `root` hash of the chunk hashes. Unlike the hash of the whole file, it
+    can be computed in parallel, and tells which parts of a damaged copy are
+    wrong; see `damaged_chunks`.
+    """
+    chunk_size = chunk_size or TREE_CHUNK_SIZE
+    size = os.path.getsize(fname)
+    chunks = _map_threads(lambda start: _hash_range(fname, start, chunk_size),
+                          range(0, size, chunk_size), jobs)
+    return dict(size=size, chunk_size=chunk_size, chunks=chunks, root=tree_root(chunks))
+
+def damaged_chunks(fname, tree, jobs=None):
+    """
+    Returns the (sorted) indices of the chunks of a file that don't match
+    its `tree_hash`. If the file has the wrong size, its last chunk is
+    considered damaged, too.
+    """
+    size = tree['size']
+    chunk_size = tree['chunk_size']
+    actual = _map_threads(
+        lambda start: _hash_range(fname, start, min(chunk_size, size - start)),
+        range(0, size, chunk_size), jobs
+    )
+    damaged = [idx for idx, (expected, chunk) in enumerate(zip(tree['chunks'], actual))
+               if chunk != expected]
+    last = len(tree['chunks']) - 1
+    if os.path.getsize(fname) != size and last >= 0 and last not in damaged:
+        damaged.append(last)
+    return damaged
+
+def tree_root(chunks):
+    """
+    Hashes a list of (hex) chunk hashes; see `tree_hash`.
+    """
+    h = hashlib.new(HASH_TYPE)
+    for chunk in chunks:
+        h.update(binascii.unhexlify(chunk))
+    return h.hexdigest()
+
+def _hash_range(fname, start, length):
+    """
+    Hashes (at most) `length` bytes of a file, starting at `start`.
+    """
+    h = hashlib.new(HASH_TYPE)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(length, HASH_BUFFER_SIZE))
+            if not data:
+                break
+            h.update(data)
+            length -= len(data)
+    return h.hexdigest()
+
+def _map_threads(func, items, jobs=None):
+    """
+    Returns `[func(item) for item in items]`, computed by a pool of `jobs`
+    threads (default: the number of CPUs).
+    """
+    items = list(items)
+    jobs = min(jobs or cpu_count(), len(items))
+    if jobs <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+def _hash_file(fname, tree=None):
     """
     Digest files using SHA-2 (256-bit)
     TESTING
@@ -13,15 +266,187 @@ def digest_file(fname):
       * empty file, file with one space, file with one return all produce
       * distinct output
     PERF takes about 20 seconds to hash 3.3GB file
-    on an empty file and on build.py
+    on an empty file and on build.py (with 4KB reads; now HASH_BUFFER_SIZE)
     INSPIRATION: http://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
     WARNING: not clear if we need to pad file bytes for proper cryptographic
       hashing
     """
-    #chunk size in bytes
-    SIZE = 4096
     h = hashlib.new(HASH_TYPE)
     with open(fname, 'rb') as f:
-        for chunk in iter(lambda: f.read(SIZE), b''):
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            h.update(chunk)
+            if tree is not None:
+                tree.update(chunk)
+    return h.hexdigest()
+
+
+def copy_and_hash(src, dst, tree=None):
+    """
+    Copies a file, and returns the hash of its contents; the file is only
+    read once. `tree` (a TreeHasher), if given, is updated with the contents.
+    """
+    h = hashlib.new(HASH_TYPE)
+    with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+        for chunk in iter(lambda: input_file.read(HASH_BUFFER_SIZE), b''):
             h.update(chunk)
+            if tree is not None:
+                tree.update(chunk)
+            output_file.write(chunk)
     return h.hexdigest()
+
+
+class TreeHasher(object):
+    """
+    Computes the `tree_hash` of data as it's written or read sequentially,
+    alongside another pass over it, rather than reading it again.
+    """
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or TREE_CHUNK_SIZE
+        self.size = 0
+        self._chunks = []
+        self._hash = None
+
+    def update(self, data):
+        """
+        Hashes the next bytes of the data.
+        """
+        data = memoryview(data)
+        while len(data):
+            if self._hash is None:
+                self._hash = hashlib.new(HASH_TYPE)
+                self._left = self.chunk_size
+            piece = data[:self._left]
+            self._hash.update(piece)
+            self._left -= len(piece)
+            self.size += len(piece)
+            data = data[len(piece):]
+            if not self._left:
+                self._chunks.append(self._hash.hexdigest())
+                self._hash = None
+
+    def tree(self):
+        """
+        Returns the tree hash of everything so far; see `tree_hash`.
+        """
+        chunks = list(self._chunks)
+        if self._hash is not None:
+            chunks.append(self._hash.hexdigest())
+        return dict(size=self.size, chunk_size=self.chunk_size, chunks=chunks,
+                    root=tree_root(chunks))
+
+
+class HashingWriter(object):
+    """
+    Wraps a file opened for writing, and hashes the data as it's written;
+    `tree` (a TreeHasher), if given, is updated with it, too.
+    """
+    def __init__(self, fd, tree=None):
+        self._fd = fd
+        self._hash = hashlib.new(HASH_TYPE)
+        self._tree = tree
+        self._size = 0
+
+    def write(self, data):
+        """
+        Writes and hashes the data.
+        """
+        self._hash.update(data)
+        if self._tree is not None:
+            self._tree.update(data)
+        self._size += len(data)
+        return self._fd.write(data)
+
+    def tell(self):
+        """
+        Returns the number of bytes written so far.
+        """
+        return self._size
+
+    def flush(self):
+        """
+        Flushes the underlying file.
+        """
+        self._fd.flush()
+
+    def close(self):
+        """
+        Closes the underlying file.
+        """
+        self._fd.close()
+
+    @property
+    def closed(self):
+        """
+        True if the underlying file is closed.
+        """
+        return self._fd.closed
+
+    def hexdigest(self):
+        """
+        Returns the hash of everything written so far.
+        """
+        return self._hash.hexdigest()
+
+
+class HashingReader(object):
+    """
+    Wraps a file opened for reading, and hashes the data as it's read, so
+    that a parser's pass over the file also hashes it. Other attributes are
+    the underlying file's; seeking elsewhere makes the hash unusable.
+    """
+    def __init__(self, fd):
+        self._fd = fd
+        self._hash = hashlib.new(HASH_TYPE)
+        self._sequential = True
+        self.size = 0
+
+    def read(self, size=-1):
+        """
+        Reads and hashes the data.
+        """
+        return self._update(self._fd.read(size))
+
+    def readline(self, *args):
+        """
+        Reads and hashes a line.
+        """
+        return self._update(self._fd.readline(*args))
+
+    def _update(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def __getattr__(self, name):
+        attr = getattr(self._fd, name)
+        if name != 'seek':
+            return attr
+
+        def seek(*args):
+            """
+            Seeks in the underlying file; unless it's to where the hashed data
+            ends, the hash no longer matches the file.
+            """
+            result = attr(*args)
+            if self._fd.tell() != self.size:
+                self._sequential = False
+            return result
+        return seek
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._fd.close()
+
+    def hexdigest(self, path):
+        """
+        Returns the hash of the file at `path`, if it was read from start to
+        end without seeking; None otherwise.
+        """
+        if not self._sequential or self.size != os.path.getsize(path):
+            return None
+        return self._hash.hexdigest()
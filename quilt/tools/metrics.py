@@ -0,0 +1,91 @@
+"""
+Optional timing metrics for objects read and written by package stores.
+
+Disabled by default; set $QUILT_METRICS to a non-zero value, or call
+`enable()`, to turn them on. Each event is a dictionary with its `event`
+type ('read' or 'write'), a `timestamp`, and event-specific fields:
+
+read: store, objhash, bytes, rows, threads, read_time, decode_time (None
+      for formats that decode while reading)
+write: store, objhash, bytes, rows, write_time
+
+Events are kept in memory (up to MAX_EVENTS of them; see `get_events`),
+and passed to any callbacks registered with `add_callback`.
+"""
+from collections import deque
+import os
+import threading
+import time
+
+MAX_EVENTS = 10000
+
+_events = deque(maxlen=MAX_EVENTS)
+_callbacks = []
+_lock = threading.Lock()
+_enabled = None
+
+
+def enabled():
+    """
+    Returns True if metrics are being recorded.
+    """
+    if _enabled is None:
+        return os.environ.get('QUILT_METRICS', '0') not in ('', '0')
+    return _enabled
+
+
+def enable(value=True):
+    """
+    Turns metrics on or off, overriding $QUILT_METRICS. `None` goes back
+    to using the environment variable.
+    """
+    global _enabled
+    _enabled = value
+
+
+def add_callback(callback):
+    """
+    Registers a function to be called with every event, as it's recorded.
+    Callbacks may be called from several threads at once.
+    """
+    with _lock:
+        _callbacks.append(callback)
+
+
+def remove_callback(callback):
+    """
+    Unregisters a function added by `add_callback`.
+    """
+    with _lock:
+        _callbacks.remove(callback)
+
+
+def record(event, **fields):
+    """
+    Records an event, if metrics are enabled.
+    """
+    if not enabled():
+        return
+    fields.update(event=event, timestamp=time.time())
+    with _lock:
+        _events.append(fields)
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback(fields)
+
+
+def get_events(event=None):
+    """
+    Returns the recorded events, oldest first; only the ones of type
+    `event`, if given.
+    """
+    with _lock:
+        return [item for item in _events if event is None or item['event'] == event]
+
+
+def clear():
+    """
+    Forgets the recorded events.
+    """
+    with _lock:
+        _events.clear()
@@ -1,16 +1,23 @@
 """
 Build: parse and add user-supplied files to store
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import hashlib
 import json
+import math
+from multiprocessing import cpu_count
+import operator
 import os
 import re
-from shutil import copyfile
+import shutil
 import tempfile
+import threading
 import time
-import zlib
 
 import pandas as pd
 import requests
+from six import integer_types, string_types
 
 try:
     import fastparquet
@@ -28,18 +35,51 @@ try:
 except ImportError:
     SparkSession = None
 
-from .const import TargetType, PackageFormat, PACKAGE_DIR_NAME
-from .core import decode_node, encode_node, hash_contents, FileNode, GroupNode, TableNode
-from .hashing import digest_file
+from . import metrics
+from .cache import dataframe_cache
+from .codec import get_codec, is_compressed, CodecException, IdentityCodec
+from .const import HASH_TYPE, IngestMode, TargetType, PackageFormat, PACKAGE_DIR_NAME, TRANSFER_JOBS
+from .core import (decode_node, encode_node, find_object_hashes, hash_contents,
+                   FileNode, GroupNode, TableNode)
+from .hashing import (copy_and_hash, damaged_chunks, digest_file, digest_files, hash_cache,
+                      tree_hashes_enabled, tree_root, HashingWriter, TreeHasher)
+from .util import reflink, transfer_session
 
 # start with alpha (_ may clobber attrs), continue with alphanumeric or _
 VALID_NAME_RE = re.compile(r'^[a-zA-Z]\w*$')
-CHUNK_SIZE = 4096
-ZLIB_LEVEL = 2  # Maximum level.
-ZLIB_METHOD = zlib.DEFLATED  # The only supported one.
-ZLIB_WBITS = zlib.MAX_WBITS | 16  # Add a gzip header and checksum.
+# Names of objects in the old, flat layout of the object dir.
+LEGACY_OBJECT_RE = re.compile(r'^[0-9a-f]{16,}$')
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+# Objects bigger than this are downloaded as several byte ranges in parallel.
+DOWNLOAD_RANGE_THRESHOLD = 256 * 1024 * 1024
+DOWNLOAD_RANGE_SIZE = 64 * 1024 * 1024
+DOWNLOAD_RANGE_JOBS = 4
+# With $QUILT_TREE_HASHES, new objects at least this big get a tree hash (see
+# `hashing.tree_hash`) in the metadata of their nodes, so they can be verified
+# and repaired by chunk.
+TREE_HASH_THRESHOLD = 64 * 1024 * 1024
+PART_EXT = '.part'
 CONTENTS_FILE = 'contents.json'
 
+# Column names that can be used in HDF5 `where` expressions.
+WHERE_COLUMN_RE = re.compile(r'^[a-zA-Z_]\w*$')
+# HDF5 `where` operators for the filters that can be pushed down; `in` is
+# `==` with a list.
+WHERE_OPS = {'==': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+             'in': '==', 'not in': '!='}
+
+# Operators allowed in the (column, op, value) filters of `dataframe`.
+FILTER_OPS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda series, values: series.isin(values),
+    'not in': lambda series, values: ~series.isin(values),
+}
+
 class StoreException(Exception):
     """
     Exception class for store I/O
@@ -55,8 +95,18 @@ class PackageStore(object):
     """
     PACKAGE_FILE_EXT = '.json'
     BUILD_DIR = 'build'
+    BUILD_CACHE_FILE = 'build_cache.json'
     OBJ_DIR = 'objs'
     TMP_OBJ_DIR = 'objs/tmp'
+    # Tree hashes of local objects, saved once they're known to match the
+    # objects' hashes; see `_save_tree`.
+    TREE_DIR = 'objs/trees'
+    # Objects are stored in nested dirs named after the start of their hashes
+    # (e.g., objs/ab/cd/abcd...), so that no dir gets too many entries.
+    OBJ_FANOUT_LEVELS = 2
+    OBJ_FANOUT_WIDTH = 2
+    # Whether the DataFrames read by `dataframe` can be kept in the DataFrameCache.
+    CACHE_DATAFRAMES = True
 
     @classmethod
     def find_package_dirs(cls, start='.'):
@@ -87,13 +137,32 @@ class PackageStore(object):
         self._mode = mode
         self._pkg_dir = None
         self._path = None
+        self._transaction = False
+        self._pending_contents = None
+        # The parsed contents, and the stat() key of the file they were read from.
+        self._contents_cache = None
+        # Tree hashes of the objects written by this store; see `written_trees`.
+        self._trees = {}
         self._find_path_read()
 
     def __enter__(self):
+        """
+        Starts a build transaction: changes to the package's contents are
+        kept in memory, and only written to disk when the transaction ends.
+        """
+        self._transaction = True
         return self
 
     def __exit__(self, type, value, traceback):
-        pass
+        """
+        Commits the pending contents, unless the block raised an exception.
+        """
+        contents = self._pending_contents
+        self._transaction = False
+        self._pending_contents = None
+        if type is None and contents is not None:
+            self._find_path_write()
+            self.save_contents(contents)
 
     def file(self, hash_list):
         """
@@ -102,63 +171,284 @@ class PackageStore(object):
         assert isinstance(hash_list, list)
         assert len(hash_list) == 1, "File objects must be contained in one file."
         filehash = hash_list[0]
-        objpath = os.path.join(self._pkg_dir, self.OBJ_DIR, filehash)
+        objpath = self._object_path(filehash)
         return objpath
 
-    def dataframe(self, hash_list):
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
         """
         Creates a DataFrame from a set of objects (identified by hashes).
+
+        `columns` is a list of the columns to read. `filters` is a list of
+        (column, op, value) tuples, all of which must be true for a row to
+        be read; `op` is one of `FILTER_OPS`. Stores read as little of the
+        objects as their format allows.
+
+        `offsets`, if given, are the row numbers the shards start at, for
+        shards whose indexes start over at 0 (see `_shard_offsets`).
         """
         raise NotImplementedError()
 
+    def cached_dataframe(self, hash_list, offsets=None):
+        """
+        Same as `dataframe`, but goes through the process-wide DataFrameCache.
+        """
+        if not self.CACHE_DATAFRAMES:
+            return self.dataframe(hash_list, offsets=offsets)
+        cache = dataframe_cache()
+        # The offsets only depend on the shards' contents.
+        key = (type(self).__name__,) + tuple(hash_list)
+        df = cache.get(key)
+        if df is None:
+            df = self.dataframe(hash_list, offsets=offsets)
+            cache.add(key, df)
+        return df
+
+    def read_table(self, node, columns=None, filters=None):
+        """
+        Reads the DataFrame of a TableNode; see `get`.
+        """
+        offsets = _shard_offsets(node)
+        if columns is None and not filters:
+            return self.cached_dataframe(node.hashes, offsets)
+        return self.dataframe(node.hashes, columns, _check_filters(filters), offsets)
+
+    def _read_shards(self, hash_list, read_object, parallel=True):
+        """
+        Calls `read_object(path)` on each of the objects of a table, in
+        parallel if `parallel` is True, and returns the results in order.
+        """
+        paths = [self._object_path(objhash) for objhash in hash_list]
+        threads = read_threads()
+        if not parallel or len(paths) == 1 or threads == 1:
+            return [read_object(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=min(threads, len(paths))) as executor:
+            return list(executor.map(read_object, paths))
+
+    def _record_read(self, path, rows, threads, read_time, decode_time=None):
+        """
+        Records the metrics of an object that's been read.
+        """
+        if metrics.enabled():
+            metrics.record('read', store=type(self).__name__, objhash=os.path.basename(path),
+                           bytes=os.path.getsize(path), rows=rows, threads=threads,
+                           read_time=read_time, decode_time=decode_time)
+
+    def _record_write(self, objhash, rows, starttime):
+        """
+        Records the metrics of an object that's been written.
+        """
+        if metrics.enabled():
+            metrics.record('write', store=type(self).__name__, objhash=objhash,
+                           bytes=os.path.getsize(self._object_path(objhash)), rows=rows,
+                           write_time=time.time() - starttime)
+
     def save_df(self, df, name, path, ext, target):
         """
         Save a DataFrame to the store.
         """
+        filehash = self.write_df(df, name)
+        self.add_table(name, [filehash], path, ext, target, table_metadata(df))
+
+    def write_df(self, df, name):
+        """
+        Serializes a DataFrame into an object in the store, without adding it
+        to the package's contents. Returns the object's hash.
+
+        Safe to call from several processes at once, as long as the names are
+        different.
+        """
         raise NotImplementedError()
 
-    def save_file(self, srcfile, name, path, target):
+    def write_df_chunks(self, chunks, name, string_sizes=None):
+        """
+        Serializes an iterable of DataFrames (with the same columns and
+        dtypes) into one object, appending them one at a time so that only one
+        chunk needs to be in memory. Returns the object's hash.
+
+        `string_sizes` maps string columns to the length of their longest
+        value, in UTF-8 bytes, for formats with fixed-width strings.
+        """
+        raise StoreException("Streaming builds are not supported by %s." % type(self).__name__)
+
+    def add_table(self, name, hashes, path, ext, target, metadata=None):
+        """
+        Adds a table to the package's contents, given the hashes of the
+        objects (written by `write_df`) holding its shards, in order.
+
+        `metadata` (see `table_metadata`) describes the table without
+        having to read it.
+        """
+        self._find_path_write()
+        buildfile = name.lstrip('/').replace('/', '.')
+        self._add_to_contents(buildfile, hashes, ext, path, target, metadata)
+
+    def save_file(self, srcfile, name, path, target, ingest_mode=None):
         """
         Save a (raw) file to the store.
+
+        See `ingest_file` for `ingest_mode`.
+        """
+        self.save_files([(srcfile, name, path)], target, ingest_mode)
+
+    def save_files(self, files, target, ingest_mode=None, jobs=None):
+        """
+        Save several (raw) files to the store, given a list of
+        (srcfile, name, path) tuples. The files are hashed and ingested by
+        a pool of `jobs` threads (default: the number of CPUs).
         """
         self._find_path_write()
-        filehash = digest_file(srcfile)
-        fullname = name.lstrip('/').replace('/', '.')
-        self._add_to_contents(fullname, filehash, '', path, target)
-        objpath = os.path.join(self._pkg_dir, self.OBJ_DIR, filehash)
-        if not os.path.exists(objpath):
-            copyfile(srcfile, objpath)
+        files = list(files)
+        jobs = min(jobs or cpu_count(), len(files))
+        if jobs <= 1:
+            hashes = [self.ingest_file(srcfile, ingest_mode) for srcfile, _, _ in files]
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                hashes = list(executor.map(lambda item: self.ingest_file(item[0], ingest_mode),
+                                           files))
+
+        for (_, name, path), filehash in zip(files, hashes):
+            fullname = name.lstrip('/').replace('/', '.')
+            self._add_to_contents(fullname, [filehash], '', path, target)
+
+    def ingest_file(self, srcfile, ingest_mode=None):
+        """
+        Adds a file to the object store, and returns its hash.
+
+        `ingest_mode` is an IngestMode value (default: $QUILT_INGEST_MODE, or
+        'auto'). Links and clones are hashed in place, without copying any
+        data; if the filesystem can't make them, the file is copied and
+        hashed in a single pass. Files already in the HashCache, and in the
+        object store, aren't read at all.
+        """
+        try:
+            mode = IngestMode(ingest_mode or os.environ.get('QUILT_INGEST_MODE',
+                                                            IngestMode.default.value))
+        except ValueError:
+            raise StoreException("Unsupported ingest mode: %r" % ingest_mode)
+
+        self._find_path_write()
+        cache = hash_cache()
+        if cache is not None:
+            filehash = cache.lookup(srcfile)
+            if filehash is not None and self.has_object(filehash):
+                return filehash
+
+        srcstat = os.stat(srcfile)
+        handle, storepath = tempfile.mkstemp(dir=os.path.join(self._pkg_dir, self.TMP_OBJ_DIR))
+        os.close(handle)
+        try:
+            linked = False
+            if mode is IngestMode.HARDLINK:
+                os.remove(storepath)
+                try:
+                    os.link(srcfile, storepath)
+                    linked = True
+                except OSError:
+                    pass
+            if not linked and mode in (IngestMode.AUTO, IngestMode.REFLINK, IngestMode.HARDLINK):
+                try:
+                    reflink(srcfile, storepath)
+                    linked = True
+                except EnvironmentError:
+                    pass
+            tree = self._tree_hasher()
+            if linked:
+                filehash = digest_file(storepath, tree=tree)
+            else:
+                filehash = copy_and_hash(srcfile, storepath, tree)
+            if cache is not None:
+                # A fresh clone is too new to be cached, but the source isn't.
+                cache.add(srcfile, filehash, srcstat)
+            self._record_tree(filehash, tree)
+        except:
+            if os.path.exists(storepath):
+                os.remove(storepath)
+            raise
+
+        if self.has_object(filehash):
+            os.remove(storepath)
+        else:
+            self._move_to_object(storepath, filehash)
+        return filehash
 
     def get_contents(self):
         """
         Returns a dictionary with the contents of the package.
         """
+        if self._pending_contents is not None:
+            return self._pending_contents
+
+        # Parsing a big contents file is slow, so the tree is kept until
+        # the file changes.
+        stat_key = self._contents_stat_key()
+        if self._contents_cache is not None and self._contents_cache[0] == stat_key:
+            return self._contents_cache[1]
+
         try:
             with open(self._path, 'r') as contents_file:
                 contents = json.load(contents_file, object_hook=decode_node)
         except IOError:
             contents = GroupNode(dict())
 
+        if stat_key is not None:
+            self._contents_cache = (stat_key, contents)
         return contents
 
+    def _contents_stat_key(self):
+        """
+        Returns a key that changes whenever the contents file is replaced or
+        modified, or None if it doesn't exist.
+        """
+        if self._path is None:
+            return None
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+        return (self._path, stat.st_ino, stat.st_size, mtime_ns)
+
     def clear_contents(self):
         """
         Removes the package's contents file.
+
+        In a transaction, the file is left alone until the new contents
+        replace it.
         """
+        if self._transaction:
+            self._pending_contents = GroupNode(dict())
+            return
+
         if self._path:
             os.remove(self._path)
         self._path = None
+        self._contents_cache = None
 
     def save_contents(self, contents):
         """
         Saves an updated version of the package's contents.
+
+        In a transaction, this only updates the pending contents. Otherwise,
+        the contents file is written to a temporary file, then renamed over
+        the old one, so readers never see a partially written file.
         """
-        with open(self._path, 'w') as contents_file:
+        if self._transaction:
+            self._pending_contents = contents
+            return
+
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as contents_file:
             json.dump(contents, contents_file, default=encode_node, indent=2, sort_keys=True)
+        if os.path.exists(self._path) and os.name == 'nt':
+            # Windows can't rename over an existing file.
+            os.remove(self._path)
+        os.rename(temp_path, self._path)
+        self._contents_cache = (self._contents_stat_key(), contents)
 
-    def get(self, path):
+    def get_node(self, path):
         """
-        Read a group or object from the store.
+        Returns the node of the contents tree at `path`, without reading
+        any objects.
         """
         if not self.exists():
             raise StoreException("Package not found")
@@ -169,18 +459,33 @@ class PackageStore(object):
         path_so_far = []
         for node_name in ipath:
             path_so_far += [node_name]
-            ptr = ptr.children.get(node_name)
+            if not isinstance(ptr, GroupNode):
+                ptr = None
+            else:
+                ptr = ptr.children.get(node_name)
             if ptr is None:
                 raise StoreException("Key {path} Not Found in Package {owner}/{pkg}".format(
                     path="/".join(path_so_far),
                     owner=self._user,
                     pkg=self._package))
-        node = ptr
+        return ptr
+
+    def get(self, path, columns=None, filters=None):
+        """
+        Read a group or object from the store.
+
+        For tables, only the given `columns` and the rows matching `filters`
+        are read; see `dataframe`.
+        """
+        node = self.get_node(path)
+
+        if not isinstance(node, TableNode) and (columns is not None or filters):
+            raise StoreException("Only tables can be read by column or filtered")
 
         if isinstance(node, GroupNode):
             return node
         elif isinstance(node, TableNode):
-            return self.dataframe(node.hashes)
+            return self.read_table(node, columns, filters)
         elif isinstance(node, FileNode):
             return self.file(node.hashes)
         else:
@@ -204,66 +509,502 @@ class PackageStore(object):
         """
         return not self._path is None
 
-    def install(self, contents, urls):
+    def install(self, contents, urls, jobs=TRANSFER_JOBS, repair=False):
         """
         Download and install a package locally.
+
+        Objects are downloaded by a pool of `jobs` threads sharing one
+        keep-alive connection pool. Objects that are already in the local
+        object store (e.g., from another version of the package) are skipped;
+        with `repair`, they're verified first, and damaged ones are fixed.
+        Objects with saved tree hashes (see `_save_tree`) are fixed by
+        fetching only their damaged chunks, the others are downloaded again.
+        Downloads that arrive damaged are fixed by chunk, too, if the
+        package's metadata has tree hashes for them.
+
+        Returns a tuple of (objects downloaded, objects skipped, bytes skipped,
+        objects repaired).
         """
         self._find_path_write()
         local_filename = self.get_path()
         with open(local_filename, 'w') as contents_file:
             json.dump(contents, contents_file, default=encode_node)
 
+        # Objects are content-addressed, so an existing file with the right
+        # name already has the right contents.
+        missing_hashes = []
+        skipped_bytes = 0
+        all_hashes = sorted(set(find_object_hashes(contents)))
+        trees = _find_tree_hashes(contents)
+        saved_trees = self._saved_trees(all_hashes)
+        damaged = {}
+        if repair:
+            _, damaged = self._verify(all_hashes, saved_trees)
+        for objhash in all_hashes:
+            objpath = self._object_path(objhash)
+            if objhash in damaged:
+                continue
+            if os.path.exists(objpath):
+                skipped_bytes += os.path.getsize(objpath)
+            else:
+                missing_hashes.append(objhash)
+
         # Download individual object files and store
         # in object dir. Verify individual file hashes.
         # Verify global hash?
+        with transfer_session(jobs * DOWNLOAD_RANGE_JOBS) as session:
+            repaired = []
+            for objhash, chunks in damaged.items():
+                if chunks is not None and self._repair_object(session, objhash, urls[objhash],
+                                                              saved_trees[objhash]):
+                    repaired.append(objhash)
+                else:
+                    os.remove(self._object_path(objhash))
+                    missing_hashes.append(objhash)
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(self._download_object, session, objhash, urls[objhash],
+                                           trees.get(objhash))
+                           for objhash in missing_hashes]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except:
+                    # Don't start any more downloads; the running ones finish on their own.
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        skipped = len(all_hashes) - len(missing_hashes) - len(repaired)
+        return len(missing_hashes), skipped, skipped_bytes, len(repaired)
+
+    def _download_object(self, session, download_hash, url, tree=None):
+        """
+        Downloads one object into the object dir and verifies its hash.
+
+        The raw (still encoded) response body is written to a `.part` file in
+        the temporary object dir, so an interrupted download is resumed with
+        a `Range` request the next time. Large objects are fetched as several
+        byte ranges in parallel.
+
+        The hash is computed as the bytes arrive (and are decoded), except
+        for resumed or multi-range downloads of encoded objects, which are
+        decoded and hashed from the raw files once they're complete. The
+        object is renamed into the object dir only if the hash matches. If
+        it doesn't, and the object has a `tree` hash, the damaged chunks are
+        fetched again.
+
+        With a `tree`, the object's own tree hash is computed alongside its
+        hash, and saved once the hash matches.
+        """
+        part_path = self._temporary_object_path(download_hash + PART_EXT)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
 
-        def install_table(node, urls):
+        response = self._get_object(session, download_hash, url, offset)
+        encoding = response.headers.get('Content-Encoding', IdentityCodec.name)
+        try:
+            codec = get_codec(encoding)
+        except CodecException as ex:
+            response.close()
+            raise StoreException("Cannot decode {hash}: {ex}".format(hash=download_hash, ex=ex))
+
+        obj_path = self._temporary_object_path(download_hash)
+        file_hash = None
+        hasher = TreeHasher(tree['chunk_size']) if tree is not None else None
+        size = int(response.headers.get('Content-Length', 0))
+        if (response.status_code != requests.codes.partial_content and
+                response.headers.get('Accept-Ranges') == 'bytes' and
+                size > DOWNLOAD_RANGE_THRESHOLD):
+            response.close()
+            raw_paths = self._download_ranges(session, download_hash, url, size)
+        else:
+            # Either a resumed download, or the whole object in one response.
+            mode = 'ab' if response.status_code == requests.codes.partial_content else 'wb'
+            if isinstance(codec, IdentityCodec):
+                # The part file is the object itself; no need for another pass.
+                file_hash = self._write_response(response, part_path, mode,
+                                                 hashlib.new(HASH_TYPE), tree=hasher)
+                if file_hash != download_hash and tree is not None:
+                    hasher = TreeHasher(tree['chunk_size'])
+                    file_hash = (self._repair_file(session, download_hash, url, part_path, tree,
+                                                   hasher)
+                                 or file_hash)
+                self._promote_object(download_hash, part_path, file_hash, hasher)
+                return
+            if mode == 'wb':
+                # The part file is still written, in case the download is interrupted.
+                file_hash = self._write_response(response, part_path, mode,
+                                                 hashlib.new(HASH_TYPE), codec.decompressor(),
+                                                 obj_path, hasher)
+            else:
+                self._write_response(response, part_path, mode)
+            raw_paths = [part_path]
+
+        if file_hash is None:
+            # Stitch the raw files together and decode them, hashing as we go.
+            decoder = codec.decompressor()
+            hash_obj = hashlib.new(HASH_TYPE)
+            with open(obj_path, 'wb') as output_file:
+                for raw_path in raw_paths:
+                    with open(raw_path, 'rb') as raw_file:
+                        for chunk in iter(lambda: raw_file.read(TRANSFER_CHUNK_SIZE), b''):
+                            data = decoder.decompress(chunk)
+                            hash_obj.update(data)
+                            if hasher is not None:
+                                hasher.update(data)
+                            output_file.write(data)
+                data = decoder.flush()
+                hash_obj.update(data)
+                if hasher is not None:
+                    hasher.update(data)
+                output_file.write(data)
+            file_hash = hash_obj.hexdigest()
+        for raw_path in raw_paths:
+            os.remove(raw_path)
+
+        if file_hash != download_hash and tree is not None:
+            hasher = TreeHasher(tree['chunk_size'])
+            file_hash = (self._repair_file(session, download_hash, url, obj_path, tree, hasher)
+                         or file_hash)
+        self._promote_object(download_hash, obj_path, file_hash, hasher)
+
+    def _repair_object(self, session, objhash, url, tree):
+        """
+        Fixes the damaged chunks of an object in the object dir, working on
+        a copy so the object is replaced atomically (and any links to it are
+        left alone). Returns True if the repaired object is intact; its tree
+        hash is saved again.
+        """
+        handle, path = tempfile.mkstemp(dir=os.path.join(self._pkg_dir, self.TMP_OBJ_DIR))
+        os.close(handle)
+        try:
+            try:
+                reflink(self._object_path(objhash), path)
+            except EnvironmentError:
+                shutil.copyfile(self._object_path(objhash), path)
+            hasher = TreeHasher(tree['chunk_size'])
+            if self._repair_file(session, objhash, url, path, tree, hasher) != objhash:
+                os.remove(path)
+                return False
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        os.remove(self._object_path(objhash))
+        self._move_to_object(path, objhash)
+        self._save_tree(objhash, hasher.tree())
+        return True
+
+    def _repair_file(self, session, download_hash, url, path, tree, hasher=None):
+        """
+        Fetches the chunks of a file that don't match its `tree` hash, and
+        writes them in place. Returns the hash of the resulting file, or None
+        if the chunks couldn't be fetched (e.g., the server sends the object
+        encoded, so byte ranges don't line up with the file).
+
+        `tree` only says which chunks to fetch; the result is only as good as
+        its hash. `hasher` (a TreeHasher), if given, is updated with the
+        resulting file.
+        """
+        size = tree['size']
+        chunk_size = tree['chunk_size']
+        with open(path, 'r+b') as output_file:
+            output_file.truncate(size)
+
+        def fetch_chunk(idx):
             """
-            Downloads and installs the set of objects for one table.
+            Downloads one chunk into its place in the file.
             """
-            for download_hash in node.hashes:
-                url = urls[download_hash]
-
-                # download and install
-                response = requests.get(url, stream=True)
-                if not response.ok:
-                    msg = "Download {hash} failed: error {code}"
-                    raise StoreException(msg.format(hash=download_hash, code=response.status_code))
-
-                local_filename = os.path.join(self._pkg_dir,
-                                              self.OBJ_DIR,
-                                              download_hash)
-
-                with open(local_filename, 'wb') as output_file:
-                    # `requests` will automatically un-gzip the content, as long as
-                    # the 'Content-Encoding: gzip' header is set.
-                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                        if chunk: # filter out keep-alive new chunks
-                            output_file.write(chunk)
-
-                file_hash = digest_file(local_filename)
-                if file_hash != download_hash:
-                    os.remove(local_filename)
-                    raise StoreException("Mismatched hash! Expected %s, got %s." %
-                                         (download_hash, file_hash))
-
-        def install_tables(contents, urls):
+            start = idx * chunk_size
+            end = min(start + chunk_size, size) - 1
+            response = self._get_object(session, download_hash, url, start, end)
+            encoding = response.headers.get('Content-Encoding', IdentityCodec.name)
+            if (response.status_code != requests.codes.partial_content or
+                    encoding != IdentityCodec.name):
+                response.close()
+                return False
+            with open(path, 'r+b') as output_file:
+                output_file.seek(start)
+                for data in response.raw.stream(TRANSFER_CHUNK_SIZE, decode_content=False):
+                    output_file.write(data)
+            return True
+
+        chunks = damaged_chunks(path, tree)
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_RANGE_JOBS) as executor:
+            if not all(executor.map(fetch_chunk, chunks)):
+                return None
+        return digest_file(path, use_cache=False, tree=hasher)
+
+    def _get_object(self, session, download_hash, url, offset=0, end=None):
+        """
+        Sends a GET request for an object, starting at byte `offset`.
+        """
+        headers = {}
+        if offset or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (offset, '' if end is None else end)
+        response = session.get(url, stream=True, headers=headers)
+        if response.status_code == requests.codes.requested_range_not_satisfiable and end is None:
+            # The partial file is already complete, or is garbage; start over.
+            response.close()
+            os.remove(self._temporary_object_path(download_hash + PART_EXT))
+            response = session.get(url, stream=True)
+        if not response.ok:
+            msg = "Download {hash} failed: error {code}"
+            raise StoreException(msg.format(hash=download_hash, code=response.status_code))
+        return response
+
+    def _download_ranges(self, session, download_hash, url, size):
+        """
+        Downloads an object as several byte ranges in parallel, and returns
+        the list of files holding the ranges, in order.
+        """
+        part_path = self._temporary_object_path(download_hash + PART_EXT)
+        ranges = [
+            ("%s.%d" % (part_path, idx), start, min(start + DOWNLOAD_RANGE_SIZE, size) - 1)
+            for idx, start in enumerate(range(0, size, DOWNLOAD_RANGE_SIZE))
+        ]
+
+        def download_range(args):
             """
-            Parses package contents and calls install_table for each table.
+            Downloads (the rest of) one range into its own file.
             """
-            for node in contents.children.values():
-                if isinstance(node, GroupNode):
-                    install_tables(node, urls)
-                else:
-                    install_table(node, urls)
+            range_path, start, end = args
+            offset = os.path.getsize(range_path) if os.path.exists(range_path) else 0
+            if start + offset > end:
+                return
+            response = self._get_object(session, download_hash, url, start + offset, end)
+            if response.status_code != requests.codes.partial_content:
+                response.close()
+                msg = "Download {hash} failed: range request not supported"
+                raise StoreException(msg.format(hash=download_hash))
+            self._write_response(response, range_path, 'ab')
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_RANGE_JOBS) as executor:
+            list(executor.map(download_range, ranges))
+
+        return [range_path for range_path, _, _ in ranges]
+
+    @staticmethod
+    def _write_response(response, path, mode, hash_obj=None, decoder=None, decoded_path=None,
+                        tree=None):
+        """
+        Writes the raw, undecoded body of a response to a file.
+
+        If `hash_obj` is given, it is updated with the whole contents of the
+        file (including any bytes already there when appending), and the
+        resulting hex digest is returned.
+
+        If `decoder` (a codec's decompressor) is given, the body is also
+        decoded into `decoded_path` as it arrives, and `hash_obj` is updated
+        with the decoded data instead; `mode` must be 'wb'.
+
+        `tree` (a TreeHasher), if given, is updated with the same data as
+        `hash_obj`.
+        """
+        if hash_obj is not None and mode == 'ab' and os.path.exists(path):
+            with open(path, 'rb') as input_file:
+                for chunk in iter(lambda: input_file.read(TRANSFER_CHUNK_SIZE), b''):
+                    hash_obj.update(chunk)
+                    if tree is not None:
+                        tree.update(chunk)
+
+        decoded_file = open(decoded_path, 'wb') if decoder is not None else None
+        try:
+            with open(path, mode) as output_file:
+                for chunk in response.raw.stream(TRANSFER_CHUNK_SIZE, decode_content=False):
+                    output_file.write(chunk)
+                    if decoded_file is not None:
+                        chunk = decoder.decompress(chunk)
+                        decoded_file.write(chunk)
+                    if hash_obj is not None:
+                        hash_obj.update(chunk)
+                    if tree is not None:
+                        tree.update(chunk)
+            if decoded_file is not None:
+                chunk = decoder.flush()
+                decoded_file.write(chunk)
+                if hash_obj is not None:
+                    hash_obj.update(chunk)
+                if tree is not None:
+                    tree.update(chunk)
+        finally:
+            if decoded_file is not None:
+                decoded_file.close()
+
+        return hash_obj.hexdigest() if hash_obj is not None else None
+
+    def _promote_object(self, download_hash, path, file_hash, tree=None):
+        """
+        Atomically moves a downloaded file into the object dir if its hash
+        matches the expected one; deletes it otherwise. `tree` (a TreeHasher
+        that hashed the same data as `file_hash`), if given, is saved along
+        with it.
+
+        Either way, the object's `.part` file is removed, so a stale one
+        (e.g., left by an interrupted download that's since been fetched by
+        range) isn't resumed the next time.
+        """
+        part_path = self._temporary_object_path(download_hash + PART_EXT)
+        if file_hash != download_hash:
+            for stale_path in {path, part_path}:
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            raise StoreException("Mismatched hash! Expected %s, got %s." %
+                                 (download_hash, file_hash))
+        self._move_to_object(path, download_hash)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        if tree is not None:
+            self._save_tree(download_hash, tree.tree())
+
+    def has_object(self, objhash):
+        """
+        Returns True if the object is in the local object store.
+        """
+        return os.path.exists(self._object_path(objhash))
+
+    def verify_objects(self, jobs=None):
+        """
+        Re-hashes the package's objects, `jobs` at a time, bypassing the
+        hash cache.
 
-        return install_tables(contents, urls)
+        Returns a tuple of (missing hashes, corrupt objects); the latter maps
+        the hashes of corrupt objects to the indices of their damaged chunks,
+        or None for objects without saved tree hashes.
+        """
+        contents = self.get_contents()
+        all_hashes = sorted(set(find_object_hashes(contents)))
+        return self._verify(all_hashes, self._saved_trees(all_hashes), jobs)
+
+    def _verify(self, all_hashes, trees, jobs=None):
+        """
+        See `verify_objects`. Objects with tree hashes are checked chunk by
+        chunk, by all of the threads; `trees` must only have trees from
+        `_saved_trees`, which are known to match the objects' hashes.
+        """
+        present = [objhash for objhash in all_hashes if self.has_object(objhash)]
+        missing = sorted(set(all_hashes) - set(present))
+        corrupt = {}
+        plain = [objhash for objhash in present if objhash not in trees]
+        actual = digest_files([self._object_path(objhash) for objhash in plain], jobs,
+                              use_cache=False)
+        for objhash, filehash in zip(plain, actual):
+            if filehash != objhash:
+                corrupt[objhash] = None
+        for objhash in present:
+            if objhash in trees:
+                chunks = damaged_chunks(self._object_path(objhash), trees[objhash], jobs)
+                if chunks:
+                    corrupt[objhash] = chunks
+        return missing, corrupt
+
+    def _tree_path(self, objhash):
+        return os.path.join(self._pkg_dir, self.TREE_DIR, objhash + self.PACKAGE_FILE_EXT)
+
+    def _save_tree(self, objhash, tree):
+        """
+        Saves the tree hash of a local object. It must have been computed in
+        the same pass as the object's hash, so it's known to match the
+        object; unlike the tree hashes in a package's metadata, which aren't
+        covered by its hash, saved ones can be trusted by `_verify`.
+        """
+        treedir = os.path.join(self._pkg_dir, self.TREE_DIR)
+        if not os.path.isdir(treedir):
+            try:
+                os.makedirs(treedir)
+            except OSError:
+                if not os.path.isdir(treedir):
+                    raise
+        handle, path = tempfile.mkstemp(dir=os.path.join(self._pkg_dir, self.TMP_OBJ_DIR))
+        with os.fdopen(handle, 'w') as tree_file:
+            json.dump(tree, tree_file)
+        if os.name == 'nt' and os.path.exists(self._tree_path(objhash)):
+            os.remove(self._tree_path(objhash))
+        os.rename(path, self._tree_path(objhash))
+
+    def _saved_trees(self, hashes):
+        """
+        Returns the saved tree hashes of the objects (out of `hashes`) that
+        have them, keyed by object hash.
+        """
+        trees = {}
+        for objhash in hashes:
+            try:
+                with open(self._tree_path(objhash)) as tree_file:
+                    trees[objhash] = json.load(tree_file)
+            except (IOError, ValueError):
+                continue
+        return trees
+
+    def build_cache_path(self):
+        """
+        Returns the path to the build cache of the package directory.
+        """
+        self._find_path_write()
+        return os.path.join(self._pkg_dir, self.BUILD_CACHE_FILE)
+
+    @classmethod
+    def _fanout_object_path(cls, pkg_dir, objhash):
+        """
+        Returns the path to an object in the fan-out layout.
+        """
+        width = cls.OBJ_FANOUT_WIDTH
+        prefixes = [objhash[idx * width:(idx + 1) * width] for idx in range(cls.OBJ_FANOUT_LEVELS)]
+        return os.path.join(pkg_dir, cls.OBJ_DIR, *(prefixes + [objhash]))
 
     def _object_path(self, objhash):
         """
         Returns the path to an object file based on its hash.
+
+        That's the fan-out layout path, unless the object is still in the old,
+        flat layout (i.e., the object dir hasn't been migrated yet).
+        """
+        path = self._fanout_object_path(self._pkg_dir, objhash)
+        if not os.path.exists(path):
+            legacy_path = os.path.join(self._pkg_dir, self.OBJ_DIR, objhash)
+            if os.path.exists(legacy_path):
+                return legacy_path
+        return path
+
+    def _move_to_object(self, path, objhash):
+        """
+        Renames a complete temporary file to its object path.
         """
-        return os.path.join(self._pkg_dir, self.OBJ_DIR, objhash)
+        objpath = self._object_path(objhash)
+        objdir = os.path.dirname(objpath)
+        if not os.path.isdir(objdir):
+            try:
+                os.makedirs(objdir)
+            except OSError:
+                # Another thread or process may have just created it.
+                if not os.path.isdir(objdir):
+                    raise
+        if os.path.exists(objpath) and os.name == 'nt':
+            # Same hash, same contents.
+            os.remove(path)
+            return
+        os.rename(path, objpath)
+
+    @classmethod
+    def migrate_objects(cls, pkg_dir):
+        """
+        Moves the objects of a package dir from the old, flat layout of the
+        object dir to the fan-out layout. Returns the number of objects moved.
+        """
+        objdir = os.path.join(pkg_dir, cls.OBJ_DIR)
+        if not os.path.isdir(objdir):
+            return 0
+        moved = 0
+        for name in os.listdir(objdir):
+            path = os.path.join(objdir, name)
+            if not LEGACY_OBJECT_RE.match(name) or not os.path.isfile(path):
+                continue
+            newpath = cls._fanout_object_path(pkg_dir, name)
+            if not os.path.isdir(os.path.dirname(newpath)):
+                os.makedirs(os.path.dirname(newpath))
+            os.rename(path, newpath)
+            moved += 1
+        return moved
 
     def _temporary_object_path(self, name):
         """
@@ -271,33 +1012,94 @@ class PackageStore(object):
         """
         return os.path.join(self._pkg_dir, self.TMP_OBJ_DIR, name)
 
-    class UploadFile(object):
+    class UploadStream(object):
         """
-        Helper class to manage temporary package files uploaded by push.
+        Helper class to manage the compressed body of an object uploaded by push.
+
+        Presigned S3 URLs don't accept chunked transfer encoding, so the body
+        needs a length: the object is compressed once, into the (optional,
+        size capped) upload cache if it fits, or else into a temporary file
+        next to the objects, and sent from there. If there isn't enough disk
+        space for it, the object is sent uncompressed rather than compressed
+        twice. Objects that are already compressed (e.g., Parquet) are sent
+        as is.
         """
-        def __init__(self, store, objhash):
-            self._store = store
+        def __init__(self, store, objhash, codec, cache):
+            self._path = store._object_path(objhash)
+            self._tmp_dir = os.path.join(store._pkg_dir, store.TMP_OBJ_DIR)
             self._hash = objhash
+            self._cache = cache
+            self._input_file = None
+            self._size = None
+            self.codec = IdentityCodec() if is_compressed(self._path) else codec
 
         def __enter__(self):
-            self._temp_file = tempfile.TemporaryFile()
-            with open(self._store._object_path(self._hash), 'rb') as input_file:
-                zlib_obj = zlib.compressobj(ZLIB_LEVEL, ZLIB_METHOD, ZLIB_WBITS)
-                for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b''):
-                    self._temp_file.write(zlib_obj.compress(chunk))
-                self._temp_file.write(zlib_obj.flush())
-            self._temp_file.seek(0)
-            return self._temp_file
+            if not isinstance(self.codec, IdentityCodec):
+                if self._cache is not None:
+                    self._input_file = self._cache.open(self._hash, self.codec.cache_name)
+                if self._input_file is None:
+                    self._input_file = self._compress()
+            if self._input_file is None:
+                self.codec = IdentityCodec()
+                self._input_file = open(self._path, 'rb')
+            self._size = os.fstat(self._input_file.fileno()).st_size
+            return self
 
         def __exit__(self, type, value, traceback):
-            self._temp_file.close()
+            self._input_file.close()
 
-    def tempfile(self, objhash):
-        """
-        Create and return a temporary file for uploading to a registry.
+        def _compress(self):
+            """
+            Returns an open file with the compressed object, or None if
+            there's no room for it.
+            """
+            size = os.path.getsize(self._path)
+            with open(self._path, 'rb') as source:
+                chunks = self.codec.compress(source, TRANSFER_CHUNK_SIZE)
+                if self._cache is not None and self._cache.fits(size):
+                    for _ in self._cache.add(self._hash, self.codec.cache_name, chunks, size):
+                        pass
+                    # None if another upload has evicted it already.
+                    return self._cache.open(self._hash, self.codec.cache_name)
+
+                free = _free_space(self._tmp_dir)
+                if free is not None and free < size:
+                    return None
+                compressed = tempfile.TemporaryFile(dir=self._tmp_dir)
+                try:
+                    for chunk in chunks:
+                        compressed.write(chunk)
+                    compressed.seek(0)
+                except:
+                    compressed.close()
+                    raise
+                return compressed
+
+        def rewind(self):
+            """
+            Goes back to the beginning, to send the object again.
+            """
+            self._input_file.seek(0)
+
+        def __len__(self):
+            return self._size
+
+        def read(self, size=-1):
+            return self._input_file.read(size)
+
+        def __iter__(self):
+            return iter(lambda: self._input_file.read(TRANSFER_CHUNK_SIZE), b'')
+
+    def upload_stream(self, objhash, codec, cache=None):
         """
-        return self.UploadFile(self, objhash)
+        Returns a context manager for uploading an object to a registry. It's
+        a file-like object (with a length) of the compressed object; its
+        `codec` attribute is the codec actually used.
 
+        If `cache` (an `UploadCache`) is given, the compressed object is
+        read from it, or saved into it if it fits.
+        """
+        return self.UploadStream(self, objhash, codec, cache)
 
     def _find_path_read(self):
         """
@@ -334,15 +1136,20 @@ class PackageStore(object):
         for name in [self._user, self.OBJ_DIR, self.TMP_OBJ_DIR]:
             path = os.path.join(package_dir, name)
             if not os.path.isdir(path):
-                os.makedirs(path)
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Another process (e.g., a build worker) may have just created it.
+                    if not os.path.isdir(path):
+                        raise
 
         self._path = os.path.join(package_dir, self._user, self._package + self.PACKAGE_FILE_EXT)
         self._pkg_dir = package_dir
         return
 
-    def _add_to_contents(self, fullname, objhash, ext, path, target):
+    def _add_to_contents(self, fullname, hashes, ext, path, target, metadata=None):
         """
-        Adds an object (name-hash mapping) to the package's contents.
+        Adds a node (name-hashes mapping) to the package's contents.
         """
         contents = self.get_contents()
         ipath = fullname.split('.')
@@ -363,17 +1170,64 @@ class PackageStore(object):
         except ValueError:
             raise StoreException("Unrecognized target {tgt}".format(tgt=target))
 
+        node_metadata = dict(metadata or {})
+        node_metadata.update(
+            q_ext=ext,
+            q_path=path,
+            q_target=target
+        )
+        trees = dict(node_metadata.get('q_tree_hashes', {}))
+        trees.update(self.written_trees(hashes))
+        if trees:
+            node_metadata.update(q_tree_hashes=trees)
         ptr.children[leaf] = node_cls(
-            hashes=[objhash],
-            metadata=dict(
-                q_ext=ext,
-                q_path=path,
-                q_target=target
-            )
+            hashes=hashes,
+            metadata=node_metadata
         )
 
         self.save_contents(contents)
 
+    def tree_hashes(self):
+        """
+        Returns the tree hashes in the metadata of the package's nodes, keyed
+        by object hash; see `written_trees`.
+        """
+        return _find_tree_hashes(self.get_contents())
+
+    def written_trees(self, hashes):
+        """
+        Returns the tree hashes of the objects (out of `hashes`) that this
+        store wrote or ingested, keyed by object hash. They're computed while
+        the objects are written or hashed, for objects of at least
+        TREE_HASH_THRESHOLD bytes, if $QUILT_TREE_HASHES is set.
+        """
+        return {objhash: self._trees[objhash] for objhash in hashes if objhash in self._trees}
+
+    @staticmethod
+    def _tree_hasher():
+        """
+        Returns a TreeHasher for a new object, or None if tree hashes are off.
+        """
+        return TreeHasher() if tree_hashes_enabled() else None
+
+    def _record_tree(self, objhash, tree):
+        """
+        Remembers (and saves) the tree hash of a new object, if it's big
+        enough. `tree` must have hashed the same data as `objhash`.
+        """
+        if tree is not None and tree.size >= TREE_HASH_THRESHOLD:
+            self._trees[objhash] = tree.tree()
+            self._save_tree(objhash, self._trees[objhash])
+
+    def _hash_object_file(self, path):
+        """
+        Hashes a new object file, along with its tree hash.
+        """
+        tree = self._tree_hasher()
+        filehash = digest_file(path, tree=tree)
+        self._record_tree(filehash, tree)
+        return filehash
+
     @classmethod
     def ls_packages(cls, pkg_dir):
         """
@@ -382,6 +1236,7 @@ class PackageStore(object):
         packages = [
             (user, pkg[:-len(PackageStore.PACKAGE_FILE_EXT)])
             for user in os.listdir(pkg_dir)
+            if os.path.isdir(os.path.join(pkg_dir, user))
             for pkg in os.listdir(os.path.join(pkg_dir, user))
             if pkg.endswith(PackageStore.PACKAGE_FILE_EXT)]
         return packages
@@ -397,27 +1252,86 @@ class HDF5PackageStore(PackageStore):
         super(HDF5PackageStore, self).__init__(user, package, mode)
         self.__store = None
 
-    def dataframe(self, hash_list):
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
         """
         Creates a DataFrame from a set of objects (identified by hashes).
+
+        Objects in the HDF5 table format (i.e., streamed builds) are read by
+        column, and filters on their data columns are passed to PyTables as
+        `where` terms, so only the matching rows are read. Fixed-format
+        objects are read whole. Either way, all of the filters are applied
+        once the rows are in memory.
         """
-        assert len(hash_list) == 1, "Multi-file DFs not supported in HDF5."
-        filehash = hash_list[0]
-        with pd.HDFStore(self._object_path(filehash), 'r') as store:
-            return store.get(self.DF_NAME)
+        read_columns = _columns_to_read(columns, filters)
+
+        def read_object(path):
+            starttime = time.time()
+            with pd.HDFStore(path, 'r') as store:
+                storer = store.get_storer(self.DF_NAME)
+                if storer.is_table:
+                    where = _where_terms(filters, storer.data_columns)
+                    try:
+                        df = store.select(self.DF_NAME, where=where or None,
+                                          columns=read_columns)
+                    except (TypeError, ValueError):
+                        # E.g., a value that doesn't fit the column's type.
+                        df = store.select(self.DF_NAME, columns=read_columns)
+                else:
+                    df = store.get(self.DF_NAME)
+            # PyTables decodes as it reads.
+            self._record_read(path, len(df), 1, time.time() - starttime)
+            return _apply_filters(df, columns, filters)
 
-    def save_df(self, df, name, path, ext, target):
+        # The HDF5 library isn't thread-safe, so shards are read one at a time.
+        return _concat_shards(self._read_shards(hash_list, read_object, parallel=False), offsets)
+
+    def write_df(self, df, name):
         """
-        Save a DataFrame to the store.
+        Serializes a DataFrame into an object in the store.
         """
+        starttime = time.time()
         self._find_path_write()
         buildfile = name.lstrip('/').replace('/', '.')
         storepath = self._temporary_object_path(buildfile)
         with pd.HDFStore(storepath, mode=self._mode) as store:
             store[self.DF_NAME] = df
-        filehash = digest_file(storepath)
-        self._add_to_contents(buildfile, filehash, ext, path, target)
-        os.rename(storepath, self._object_path(filehash))
+        filehash = self._hash_object_file(storepath)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, len(df), starttime)
+        return filehash
+
+    def write_df_chunks(self, chunks, name, string_sizes=None):
+        """
+        Appends DataFrames to an HDF5 table, with every column as a data
+        column so that rows can be filtered on when read. String columns
+        are sized by `string_sizes`, since they can't grow once the table
+        is created.
+
+        HDF5 writes aren't sequential, so the object is hashed once it's complete.
+        """
+        starttime = time.time()
+        self._find_path_write()
+        buildfile = name.lstrip('/').replace('/', '.')
+        storepath = self._temporary_object_path(buildfile)
+        rows = 0
+        try:
+            with pd.HDFStore(storepath, mode=self._mode) as store:
+                for chunk in chunks:
+                    min_itemsize = {
+                        column: max(size, 1) for column, size in (string_sizes or {}).items()
+                        if column in chunk and chunk[column].dtype == object
+                    }
+                    store.append(self.DF_NAME, chunk, format='table', data_columns=True,
+                                 index=False, min_itemsize=min_itemsize or None)
+                    rows += len(chunk)
+        except:
+            if os.path.exists(storepath):
+                os.remove(storepath)
+            raise
+        filehash = self._hash_object_file(storepath)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, rows, starttime)
+        return filehash
 
 
 class FastParquetPackageStore(PackageStore):
@@ -429,33 +1343,75 @@ class FastParquetPackageStore(PackageStore):
             raise StoreException("Module fastparquet is required for FastParquetPackageStore.")
         super(FastParquetPackageStore, self).__init__(user, package, mode)
 
-    def save_df(self, df, name, path, ext, target):
+    def write_df(self, df, name):
         """
-        Save a DataFrame to the store.
+        Serializes a DataFrame into an object in the store.
         """
+        starttime = time.time()
         self._find_path_write()
         buildfile = name.lstrip('/').replace('/', '.')
         storepath = self._temporary_object_path(buildfile)
         fastparquet.write(storepath, df)
 
-        filehash = digest_file(storepath)
-        self._add_to_contents(buildfile, filehash, ext, path, target)
-        os.rename(storepath, self._object_path(filehash))
+        filehash = self._hash_object_file(storepath)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, len(df), starttime)
+        return filehash
+
+    def write_df_chunks(self, chunks, name, string_sizes=None):
+        """
+        Appends DataFrames to a Parquet file as separate row groups.
 
-    def dataframe(self, hash_list):
+        Appending rewrites the file footer, so the object is hashed once
+        it's complete.
+        """
+        starttime = time.time()
+        self._find_path_write()
+        buildfile = name.lstrip('/').replace('/', '.')
+        storepath = self._temporary_object_path(buildfile)
+        rows = 0
+        try:
+            for idx, chunk in enumerate(chunks):
+                fastparquet.write(storepath, chunk, append=idx > 0)
+                rows += len(chunk)
+        except:
+            if os.path.exists(storepath):
+                os.remove(storepath)
+            raise
+        filehash = self._hash_object_file(storepath)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, rows, starttime)
+        return filehash
+
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
         """
         Creates a DataFrame from a set of objects (identified by hashes).
+
+        Only the requested columns are read, and row groups whose statistics
+        rule out the filters are skipped.
         """
-        assert len(hash_list) == 1, "Multi-file DFs not supported yet."
-        filehash = hash_list[0]
-        pfile = fastparquet.ParquetFile(self._object_path(filehash))
-        return pfile.to_pandas()
+        read_columns = _columns_to_read(columns, filters)
+
+        def read_object(path):
+            starttime = time.time()
+            df = fastparquet.ParquetFile(path).to_pandas(columns=read_columns,
+                                                         filters=filters or [])
+            # fastparquet decodes as it reads.
+            self._record_read(path, len(df), 1, time.time() - starttime)
+            return _apply_filters(df, columns, filters)
+
+        return _concat_shards(self._read_shards(hash_list, read_object), offsets)
 
 
 class SparkPackageStore(FastParquetPackageStore):
     """
     Spark Implementation of PackageStore.
+
+    Spark reads objects lazily, in the JVM, so no read metrics are recorded.
     """
+    # Spark DataFrames are lazy, and live in the JVM.
+    CACHE_DATAFRAMES = False
+
     def __init__(self, user, package, mode):
         super(SparkPackageStore, self).__init__(user, package, mode)
 
@@ -463,14 +1419,25 @@ class SparkPackageStore(FastParquetPackageStore):
             raise StoreException("Module SparkSession from pyspark.sql is required for " +
                                  "SparkPackageStore.")
 
-    def dataframe(self, hash_list):
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
         """
         Creates a DataFrame from a set of objects (identified by hashes).
+
+        Spark pushes the column selection and filters down into the
+        Parquet reader itself.
         """
         spark = SparkSession.builder.getOrCreate()
-        assert len(hash_list) == 1, "Multi-file DFs not supported yet."
-        filehash = hash_list[0]
-        df = spark.read.parquet(self._object_path(filehash))
+        paths = [self._object_path(filehash) for filehash in hash_list]
+        df = spark.read.parquet(*paths)
+        for column, op, value in filters or []:
+            if op == 'in':
+                df = df.filter(df[column].isin(list(value)))
+            elif op == 'not in':
+                df = df.filter(~df[column].isin(list(value)))
+            else:
+                df = df.filter(FILTER_OPS[op](df[column], value))
+        if columns is not None:
+            df = df.select(*columns)
         return df
 
 class ArrowPackageStore(PackageStore):
@@ -485,10 +1452,11 @@ class ArrowPackageStore(PackageStore):
             raise StoreException("Module pyarrow is required for ArrowPackageStore.")
         super(ArrowPackageStore, self).__init__(user, package, mode)
 
-    def save_df(self, df, name, path, ext, target):
+    def write_df(self, df, name):
         """
-        Save a DataFrame to the store.
+        Serializes a DataFrame into an object in the store.
         """
+        starttime = time.time()
         self._find_path_write()
 
         # Save the dataframe to a local build file
@@ -497,39 +1465,431 @@ class ArrowPackageStore(PackageStore):
         table = pa.Table.from_pandas(df)
         parquet.write_table(table, storepath)
 
-        # Calculate the file hash and add it to the package contents
-        filehash = digest_file(storepath)
-        self._add_to_contents(buildfile, filehash, ext, path, target)
+        # Calculate the file hash, then move the build file to the
+        # object store and rename it to its hash
+        filehash = self._hash_object_file(storepath)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, len(df), starttime)
+        return filehash
 
-        # Move the build file to the object store and rename it to
-        # its hash
-        objpath = self._object_path(filehash)
-        os.rename(storepath, objpath)
-
-    def dataframe(self, hash_list):
+    def write_df_chunks(self, chunks, name, string_sizes=None):
+        """
+        Writes DataFrames to a Parquet file as separate row groups, hashing
+        the bytes as they're written.
+        """
+        starttime = time.time()
+        self._find_path_write()
+        buildfile = name.lstrip('/').replace('/', '.')
+        storepath = self._temporary_object_path(buildfile)
+        rows = 0
+        try:
+            with open(storepath, 'wb') as output_file:
+                tree = self._tree_hasher()
+                sink = HashingWriter(output_file, tree)
+                writer = None
+                for chunk in chunks:
+                    # Chunks get new indexes, so the index isn't worth keeping.
+                    if writer is None:
+                        schema = _arrow_schema(chunk, preserve_index=False)
+                        writer = parquet.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+                    table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                    writer.write_table(table)
+                    rows += len(chunk)
+                if writer is not None:
+                    writer.close()
+        except:
+            os.remove(storepath)
+            raise
+        filehash = sink.hexdigest()
+        self._record_tree(filehash, tree)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, rows, starttime)
+        return filehash
+
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
         """
         Creates a DataFrame from a set of objects (identified by hashes).
+
+        With `columns` or `filters`, only the requested columns are read,
+        and row groups whose statistics rule out the filters are skipped.
+
+        Each object is read and converted with Arrow's thread pool, resized
+        to `read_threads()` threads, unless that's 1.
         """
-        assert len(hash_list) == 1, "Multi-file DFs not supported for Arrow packages."
-        filehash = hash_list[0]
+        read_columns = _columns_to_read(columns, filters)
+        threads = read_threads()
+        use_threads = threads > 1
+
+        def read_object(path):
+            starttime = time.time()
+            if read_columns is None and not filters:
+                table = parquet.read_table(path, use_threads=use_threads)
+                groups = True
+            else:
+                pfile = parquet.ParquetFile(path)
+                groups = [idx for idx in range(pfile.num_row_groups)
+                          if _row_group_matches(pfile.metadata.row_group(idx), filters)]
+                # Read an empty selection from one row group, to get the columns.
+                table = pa.concat_tables([
+                    pfile.read_row_group(idx, columns=read_columns, use_threads=use_threads,
+                                         use_pandas_metadata=True)
+                    for idx in groups or [0]
+                ])
+            readtime = time.time()
+            df = table.to_pandas(use_threads=use_threads)
+            self._record_read(path, len(df), threads, readtime - starttime,
+                              time.time() - readtime)
+            return _apply_filters(df if groups else df.iloc[:0], columns, filters)
+
+        if not use_threads:
+            return _concat_shards(self._read_shards(hash_list, read_object), offsets)
+        with _arrow_cpu_count(threads):
+            return _concat_shards(self._read_shards(hash_list, read_object), offsets)
+
+
+class FeatherPackageStore(PackageStore):
+    """
+    Arrow IPC (Feather v2) Implementation of PackageStore.
 
-        nt = 8
-        fpath = self._object_path(filehash)
-        starttime = time.time()
-        table = parquet.read_table(fpath, nthreads=nt)
-        finishtime = time.time()
-        elapsed = finishtime - starttime
-        print("Read {path} in {time}s with {nt} threads".format(path=fpath, time=elapsed, nt=nt))
+    Objects are uncompressed Arrow files that are memory-mapped when read,
+    and converted to pandas without copying wherever the types allow
+    (e.g., numeric columns without nulls). Processes reading the same table
+    share the OS page cache rather than each having its own copy.
+    """
+    # Copying into the DataFrameCache would defeat the sharing.
+    CACHE_DATAFRAMES = False
+
+    def __init__(self, user, package, mode):
+        if pa is None:
+            raise StoreException("Module pyarrow is required for FeatherPackageStore.")
+        super(FeatherPackageStore, self).__init__(user, package, mode)
 
+    def write_df(self, df, name):
+        """
+        Serializes a DataFrame into an object in the store.
+        """
+        return self.write_df_chunks([df], name, preserve_index=None)
+
+    def write_df_chunks(self, chunks, name, string_sizes=None, preserve_index=False):
+        """
+        Writes DataFrames to an Arrow file as separate record batches,
+        hashing the bytes as they're written.
+
+        By default, the index isn't kept, since chunks get new indexes.
+        """
         starttime = time.time()
-        df = table.to_pandas()
-        finishtime = time.time()
-        elapsed = finishtime - starttime
-        print("Converted to pandas in {time}s".format(time=elapsed))
-        return df
+        self._find_path_write()
+        buildfile = name.lstrip('/').replace('/', '.')
+        storepath = self._temporary_object_path(buildfile)
+        rows = 0
+        try:
+            with open(storepath, 'wb') as output_file:
+                tree = self._tree_hasher()
+                sink = HashingWriter(output_file, tree)
+                writer = None
+                for chunk in chunks:
+                    if writer is None:
+                        schema = _arrow_schema(chunk, preserve_index)
+                        writer = pa.ipc.new_file(pa.PythonFile(sink, mode='w'), schema)
+                    table = pa.Table.from_pandas(chunk, schema=schema,
+                                                 preserve_index=preserve_index)
+                    writer.write_table(table)
+                    rows += len(chunk)
+                if writer is not None:
+                    writer.close()
+        except:
+            os.remove(storepath)
+            raise
+        filehash = sink.hexdigest()
+        self._record_tree(filehash, tree)
+        self._move_to_object(storepath, filehash)
+        self._record_write(filehash, rows, starttime)
+        return filehash
+
+    def dataframe(self, hash_list, columns=None, filters=None, offsets=None):
+        """
+        Creates a DataFrame from a set of objects (identified by hashes).
+
+        Each shard is converted on its own; combining several shards copies
+        them into contiguous columns.
+        """
+        read_columns = _columns_to_read(columns, filters)
+
+        def read_object(path):
+            starttime = time.time()
+            table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            if read_columns is not None:
+                try:
+                    table = table.select(read_columns)
+                except KeyError as ex:
+                    raise StoreException("No such column: %s" % ex)
+            readtime = time.time()
+            # One block per column, so that columns can point into the mapped file.
+            df = table.to_pandas(split_blocks=True, use_threads=False)
+            self._record_read(path, len(df), 1, readtime - starttime, time.time() - readtime)
+            if columns is None and not filters:
+                return df
+            return _apply_filters(df, columns, filters)
+
+        return _concat_shards(self._read_shards(hash_list, read_object), offsets)
 
 
 # Helper functions
+def _free_space(path):
+    """
+    Returns the free disk space, in bytes, of the filesystem `path` is on;
+    or None if it can't be found out.
+    """
+    try:
+        return shutil.disk_usage(path).free
+    except AttributeError:
+        pass
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+def read_threads():
+    """
+    Returns the number of threads to read objects with: $QUILT_READ_THREADS,
+    or the number of CPUs.
+    """
+    value = os.environ.get('QUILT_READ_THREADS', '')
+    if not value:
+        return cpu_count()
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        raise StoreException("Invalid QUILT_READ_THREADS: %r (must be a positive integer)" % value)
+    return threads
+
+_arrow_pool_lock = threading.Lock()
+_arrow_pool_size = None  # Arrow's own pool size, once it's known.
+
+@contextmanager
+def _arrow_cpu_count(threads):
+    """
+    Sets the size of Arrow's (process-wide) thread pool, and restores it
+    afterwards. Reads that need a different size than Arrow's own take
+    turns; the others don't wait, but may run with the pool of a resized
+    read that overlaps them.
+    """
+    global _arrow_pool_size
+    with _arrow_pool_lock:
+        if _arrow_pool_size is None:
+            _arrow_pool_size = pa.cpu_count()
+    if threads == _arrow_pool_size:
+        yield
+        return
+
+    with _arrow_pool_lock:
+        pa.set_cpu_count(threads)
+        try:
+            yield
+        finally:
+            pa.set_cpu_count(_arrow_pool_size)
+
+def _arrow_schema(df, preserve_index):
+    """
+    Returns the Arrow schema for a DataFrame's dtypes, rather than for its
+    values, so that it fits every chunk of a streamed table: e.g., object
+    columns are strings, even if they're all missing in `df`.
+    """
+    schema = pa.Table.from_pandas(df.iloc[:0], preserve_index=preserve_index).schema
+    for column, dtype in df.dtypes.items():
+        idx = schema.get_field_index(str(column))
+        if dtype == object and idx >= 0:
+            schema = schema.set(idx, pa.field(str(column), pa.string()))
+    return schema
+
+def table_metadata(df, rows=None):
+    """
+    Returns the columns, dtypes and shape of a DataFrame, to be stored in
+    the metadata of its TableNode. `rows` overrides the number of rows,
+    e.g., when `df` is only the first chunk of a table.
+    """
+    return dict(
+        q_columns=[str(column) for column in df.columns],
+        q_dtypes=[str(dtype) for dtype in df.dtypes],
+        q_shape=[len(df) if rows is None else rows, len(df.columns)]
+    )
+
+def _find_tree_hashes(contents):
+    """
+    Returns the tree hashes in the metadata of a package's nodes, keyed by
+    object hash. Malformed trees, and trees whose root doesn't match their
+    chunks, are ignored.
+
+    They aren't covered by the package's hash, so they're only used to
+    decide which chunks of a download to fetch again, never to accept data.
+    """
+    trees = {}
+    for node in contents.children.values():
+        if isinstance(node, GroupNode):
+            trees.update(_find_tree_hashes(node))
+        else:
+            node_trees = node.metadata.get('q_tree_hashes')
+            if not isinstance(node_trees, dict):
+                continue
+            for objhash, tree in node_trees.items():
+                if _valid_tree(tree):
+                    trees[objhash] = tree
+    return trees
+
+def _valid_tree(tree):
+    """
+    Returns True if `tree` has the fields of a tree hash, and its root
+    matches its chunks.
+    """
+    if not isinstance(tree, dict):
+        return False
+    size = tree.get('size')
+    chunk_size = tree.get('chunk_size')
+    chunks = tree.get('chunks')
+    if not (isinstance(size, integer_types) and size >= 0 and
+            isinstance(chunk_size, integer_types) and chunk_size > 0 and
+            isinstance(chunks, list) and isinstance(tree.get('root'), string_types)):
+        return False
+    try:
+        return tree_root(chunks) == tree['root']
+    except (TypeError, ValueError):
+        # Chunk hashes that aren't hex strings.
+        return False
+
+def _check_filters(filters):
+    """
+    Validates a list of (column, op, value) filters.
+    """
+    filters = list(filters or [])
+    for item in filters:
+        if not isinstance(item, (list, tuple)) or len(item) != 3:
+            raise StoreException("Filters must be (column, op, value) tuples: %r" % (item,))
+        if item[1] not in FILTER_OPS:
+            raise StoreException("Unsupported filter operator: %r" % (item[1],))
+    return [tuple(item) for item in filters]
+
+def _columns_to_read(columns, filters):
+    """
+    Returns the columns needed to select `columns` and evaluate `filters`,
+    or None for all of them.
+    """
+    if columns is None:
+        return None
+    read_columns = list(columns)
+    for column, _, _ in filters or []:
+        if column not in read_columns:
+            read_columns.append(column)
+    return read_columns
+
+def _apply_filters(df, columns, filters):
+    """
+    Drops the rows that don't match `filters` and the columns not in `columns`.
+    """
+    try:
+        if filters:
+            mask = pd.Series(True, index=df.index)
+            for column, op, value in filters:
+                mask &= FILTER_OPS[op](df[column], value)
+            df = df[mask.values]
+        if columns is not None:
+            df = df[list(columns)]
+    except KeyError as ex:
+        raise StoreException("No such column: %s" % ex)
+    return df
+
+def _where_value(value):
+    """
+    Returns a literal for a filter value in an HDF5 `where` expression, or
+    None if it has no literal (e.g., timestamps, NaN).
+    """
+    if hasattr(value, 'item') and not hasattr(value, '__len__'):
+        value = value.item()  # A numpy scalar.
+    if isinstance(value, bool) or isinstance(value, integer_types):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if not math.isnan(value) and not math.isinf(value) else None
+    if isinstance(value, string_types):
+        return repr(value)
+    return None
+
+def _where_terms(filters, data_columns):
+    """
+    Translates the filters on `data_columns` into HDF5 `where` expressions,
+    as far as they can be; the others are left to `_apply_filters`.
+    """
+    terms = []
+    for column, op, value in filters or []:
+        if column not in data_columns or not WHERE_COLUMN_RE.match(str(column)):
+            continue
+        if op in ('in', 'not in'):
+            literals = [_where_value(item) for item in value]
+            if not literals or None in literals:
+                continue
+            literal = '[%s]' % ', '.join(literals)
+        else:
+            literal = _where_value(value)
+            if literal is None:
+                continue
+        terms.append('%s %s %s' % (column, WHERE_OPS[op], literal))
+    return terms
+
+def _row_group_matches(row_group, filters):
+    """
+    Returns False if a Parquet row group's min/max statistics show that
+    none of its rows match `filters`.
+    """
+    stats = {}
+    for idx in range(row_group.num_columns):
+        column = row_group.column(idx)
+        if column.is_stats_set and column.statistics.has_min_max:
+            stats[column.path_in_schema] = column.statistics
+
+    for column, op, value in filters or []:
+        column_stats = stats.get(column)
+        if column_stats is None:
+            continue
+        low, high = column_stats.min, column_stats.max
+        try:
+            if op == '==' and not low <= value <= high:
+                return False
+            elif op == 'in' and not any(low <= item <= high for item in value):
+                return False
+            elif (op == '<' and not low < value) or (op == '<=' and not low <= value):
+                return False
+            elif (op == '>' and not high > value) or (op == '>=' and not high >= value):
+                return False
+        except TypeError:
+            # Statistics of an incomparable type; read the row group to be safe.
+            continue
+    return True
+
+def _shard_offsets(node):
+    """
+    Returns the row numbers that the shards of a table start at, if their
+    indexes each start over at 0 (see `build._split_content_defined`), or
+    None.
+    """
+    if not node.metadata.get('q_positional_index'):
+        return None
+    offsets = [0]
+    for rows in node.metadata['q_shard_rows'][:-1]:
+        offsets.append(offsets[-1] + rows)
+    return offsets
+
+def _concat_shards(frames, offsets=None):
+    """
+    Combines the DataFrames read from the shards of a table, shifting their
+    indexes by `offsets` (see `_shard_offsets`), if given.
+    """
+    if offsets is not None:
+        for frame, offset in zip(frames, offsets):
+            if offset:
+                frame.index = frame.index + offset
+    return frames[0] if len(frames) == 1 else pd.concat(frames)
+
 def get_store(user, package, pkgformat=None, mode='r'):
     """
     Return a PackageStore object of the appropriate type for a
@@ -547,6 +1907,8 @@ def get_store(user, package, pkgformat=None, mode='r'):
         return SparkPackageStore(user, package, mode)
     elif pkg_format is PackageFormat.ARROW:
         return ArrowPackageStore(user, package, mode)
+    elif pkg_format is PackageFormat.FEATHER:
+        return FeatherPackageStore(user, package, mode)
     else:
         raise StoreException("Not Implemented")
 
@@ -2,14 +2,39 @@
 Helper functions.
 """
 
+import errno
 import os
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from appdirs import user_data_dir
+import requests
 from tqdm import tqdm
 
+from .codec import available_codecs
+
 APP_NAME = "QuiltCli"
 APP_AUTHOR = "QuiltData"
 BASE_DIR = user_data_dir(APP_NAME, APP_AUTHOR)
+FICLONE = 0x40049409  # Linux ioctl: _IOW(0x94, 9, int)
+
+
+def reflink(src, dst):
+    """
+    Creates `dst` as a copy-on-write clone of `src`, sharing its data
+    blocks until either file is modified.
+
+    Only works on Linux, on filesystems that support it (e.g., Btrfs, XFS);
+    raises an EnvironmentError otherwise.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+        fcntl.ioctl(output_file.fileno(), FICLONE, input_file.fileno())
 
 
 class FileWithReadProgress(object):
@@ -42,6 +67,23 @@ class FileWithReadProgress(object):
         self.close()
 
 
+def transfer_session(pool_size):
+    """
+    Creates a session for transferring objects to/from blob storage.
+
+    Unlike the registry session, it has no auth headers or response hooks,
+    and keeps up to `pool_size` connections alive so that concurrent
+    transfers reuse them instead of reconnecting for every object.
+    It advertises the transfer codecs we can decode.
+    """
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = ', '.join(available_codecs())
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def file_to_str(fname):
     """
     Read a file into a string